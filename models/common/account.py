@@ -0,0 +1,149 @@
+# Push-updated account state for the live bots.
+#
+# place_order used to call the blocking ib.accountSummary() on every order and
+# scan all of its tags for AvailableFunds. TWS already streams the account
+# values to every connected client (ib_insync subscribes at connect and emits
+# accountValueEvent on each change), so AccountState listens to that stream
+# and keeps one typed snapshot: every update is a dict lookup of the tag and
+# an attribute write, every read is an attribute read. The time of the last
+# update of each field is kept so callers can tell a quiet account from a
+# dead subscription; a field older than max_age is refreshed with one
+# blocking accountSummary() call.
+
+import datetime
+import logging
+import threading
+
+try:
+    from common import latency
+except ImportError:  # run as a script from models/common
+    import latency
+
+# account value tags kept, and the snapshot field each one is stored in
+TAGS = {
+    'AvailableFunds': 'available_funds',
+    'NetLiquidation': 'net_liquidation',
+    'InitMarginReq': 'init_margin',
+    'MaintMarginReq': 'maint_margin',
+    'ExcessLiquidity': 'excess_liquidity',
+    'BuyingPower': 'buying_power',
+    'TotalCashValue': 'cash',
+}
+
+
+class AccountSnapshot:
+
+    '''
+    Latest value of each tracked account field, NaN until the first update
+    '''
+
+    __slots__ = tuple(TAGS.values())
+
+    available_funds: float
+    net_liquidation: float
+    init_margin: float
+    maint_margin: float
+    excess_liquidity: float
+    buying_power: float
+    cash: float
+
+    def __init__(self):
+        for field in self.__slots__:
+            setattr(self, field, float('nan'))
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.__slots__}
+
+
+class AccountState:
+
+    '''
+    Account values kept up to date by the broker's push events
+    :param ib: connected ib_insync.IB (or anything with the same account API)
+    :param account: account to track, '' for the only/first one
+    :param currency: currency of the values to keep
+    :param max_age: seconds after which a field is considered stale
+    :param clock: callable returning the current datetime
+    '''
+
+    def __init__(self, ib, account='', currency='USD', max_age=600, clock=None):
+        self._logger = logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self.ib = ib
+        self.account = account
+        self.currency = currency
+        self.max_age = max_age
+        self.clock = clock or datetime.datetime.now
+        self.snapshot = AccountSnapshot()
+        self.updated = {}
+        self.started = False
+
+    def start(self):
+
+        '''
+        Subscribe to the account value events and seed the snapshot from the values TWS already sent
+        '''
+
+        if not self.started:
+            self.ib.accountValueEvent += self.on_value
+            self.ib.accountSummaryEvent += self.on_value
+            self.started = True
+        for value in self.ib.accountValues(self.account):
+            self.on_value(value)
+
+    def stop(self):
+        if self.started:
+            self.ib.accountValueEvent -= self.on_value
+            self.ib.accountSummaryEvent -= self.on_value
+            self.started = False
+
+    def on_value(self, value):
+        field = TAGS.get(value.tag)
+        if field is None or value.currency not in (self.currency, 'BASE'):
+            return
+        if self.account and value.account != self.account:
+            return
+        try:
+            number = float(value.value)
+        except ValueError:
+            return
+        with self._lock:
+            setattr(self.snapshot, field, number)
+            self.updated[field] = self.clock()
+
+    def age(self, field='available_funds'):
+
+        '''
+        Seconds since the field was last updated
+        :return: float, inf before the first update
+        '''
+
+        updated = self.updated.get(field)
+        return float('inf') if updated is None else (self.clock() - updated).total_seconds()
+
+    def stale(self, field='available_funds'):
+        return self.age(field) > self.max_age
+
+    def refresh(self):
+
+        '''
+        Blocking fallback: re-read every value with accountSummary()
+        '''
+
+        with latency.span('accountSummary'):
+            values = self.ib.accountSummary(self.account)
+        for value in values:
+            self.on_value(value)
+
+    def get(self, field='available_funds'):
+
+        '''
+        Current value of a field, refreshed first if it is stale
+        :param field: AccountSnapshot field
+        :return: float
+        '''
+
+        if self.stale(field):
+            self._logger.info("Account %s is stale (%ss old), refreshing", field, round(self.age(field)))
+            self.refresh()
+        return getattr(self.snapshot, field)
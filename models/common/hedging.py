@@ -0,0 +1,157 @@
+# Optional delta hedging of the open book in the underlying.
+#
+# A short strangle is delta neutral only on the day it is opened; as the
+# underlying moves the book picks up delta and the P&L becomes a directional
+# bet. DeltaHedger subscribes to greeks.book, so every reprice hands it the
+# net delta per underlying, and trades the underlying (the stock, or the
+# micro future for the futures bot) when the delta of the options plus the
+# hedge already held leaves a band around zero:
+#   * band / target give the hysteresis: nothing trades while |net delta| is
+#     inside band, a breach trades back to target (closer to zero, 0 for a
+#     full rehedge), so the next trade needs a move of band - target first,
+#   * min_trade skips hedges smaller than that many units of the underlying,
+#   * min_interval seconds between hedges and max_per_hour hedges in any
+#     rolling hour cap the order rate in a fast market,
+#   * only one hedge order works at a time, a tick that arrives while it is
+#     in flight is ignored.
+# Checks are a few comparisons on the greeks the book already computed and
+# the order is sent with the non-blocking ib.placeOrder, so a tick never
+# waits on the broker. The hedge position is kept from the fills.
+
+import collections
+import datetime
+import logging
+
+import numpy as np
+from ib_insync import MarketOrder
+
+try:
+    from common import latency
+except ImportError:  # run as a script from models/common
+    import latency
+
+
+class DeltaHedger:
+
+    '''
+    Keep the net delta of one underlying inside a band by trading the underlying
+    :param ib: connected ib_insync.IB
+    :param contract: qualified contract of the hedge instrument (the underlying)
+    :param book: greeks.PortfolioGreeks to follow, subscribed to when given
+    :param symbol: underlying symbol in the book, defaults to contract.symbol
+    :param band: net delta (in shares of the underlying) that triggers a hedge
+    :param target: net delta a hedge trades back to, must be below band
+    :param min_trade: smallest hedge in units of the hedge instrument
+    :param min_interval: seconds between hedges
+    :param max_per_hour: hedges allowed in any rolling hour
+    :param delta_per_unit: delta of one unit of the hedge instrument (1 for a stock, the multiplier for a future)
+    :param position: units of the hedge instrument already held
+    :param journal: journal.OrderJournal to record the hedge orders in
+    :param strategy: strategy name of the hedge orders in the journal
+    :param clock: callable returning the current datetime
+    '''
+
+    def __init__(self, ib, contract, book=None, symbol=None, band=50.0, target=0.0, min_trade=1, min_interval=60,
+                 max_per_hour=20, delta_per_unit=1.0, position=0, journal=None, strategy='delta_hedge', clock=None):
+        if not 0 <= target < band:
+            raise ValueError(f"target {target} must be in [0, band {band})")
+        self._logger = logging.getLogger(__name__)
+        self.ib = ib
+        self.contract = contract
+        self.symbol = symbol or contract.symbol
+        self.band = band
+        self.target = target
+        self.min_trade = min_trade
+        self.min_interval = min_interval
+        self.max_per_hour = max_per_hour
+        self.delta_per_unit = float(delta_per_unit)
+        self.position = position
+        self.journal = journal
+        self.strategy = strategy
+        self.book = book
+        self.clock = clock or datetime.datetime.now
+        self.option_delta = 0.0
+        self.trade = None
+        self.last_hedge = None
+        self.recent = collections.deque()
+        self.hedges = []
+        if book is not None:
+            book.subscribe(self.on_greeks)
+
+    @property
+    def net_delta(self):
+        return self.option_delta + self.position * self.delta_per_unit
+
+    def on_greeks(self, by_underlying, total):
+
+        '''
+        Greeks book subscriber: take the new option delta of the symbol and check the band
+        '''
+
+        self.option_delta = by_underlying.get(self.symbol, {}).get('delta', 0.0)
+        self.check()
+
+    def hedge_size(self, net_delta=None):
+
+        '''
+        Units of the hedge instrument to trade for a net delta, before the rate limits
+        :param net_delta: net delta of the options and the hedge, defaults to the current one
+        :return: signed units, 0 while the delta is inside the band
+        '''
+
+        net = self.net_delta if net_delta is None else net_delta
+        if not np.isfinite(net) or abs(net) <= self.band:
+            return 0
+        units = int(round((np.sign(net) * self.target - net) / self.delta_per_unit))
+        return units if abs(units) >= self.min_trade else 0
+
+    def check(self):
+
+        '''
+        Place a hedge if the net delta is outside the band and the rate limits allow it
+        :return: the hedge Trade, or None
+        '''
+
+        if self.trade is not None and not self.trade.isDone():
+            return None
+        units = self.hedge_size()
+        if not units:
+            return None
+        now = self.clock()
+        if self.last_hedge is not None and (now - self.last_hedge).total_seconds() < self.min_interval:
+            return None
+        hour_ago = now - datetime.timedelta(hours=1)
+        while self.recent and self.recent[0] <= hour_ago:
+            self.recent.popleft()
+        if len(self.recent) >= self.max_per_hour:
+            self._logger.warning("Delta hedge skipped, %s hedges in the last hour", len(self.recent))
+            return None
+
+        self._logger.info("Net delta %s outside +-%s, hedging %s %s", round(self.net_delta, 2), self.band, units,
+                          self.symbol)
+        order = MarketOrder('BUY' if units > 0 else 'SELL', abs(units))
+        with latency.span('placeOrder'):
+            self.trade = self.ib.placeOrder(self.contract, order)
+        if self.journal is not None:
+            # the underlying price the book was just repriced at is the hedge's mid
+            spot = self.book.spot[self.book.underlyings[self.symbol]] if self.book is not None else np.nan
+            self.journal.submit(self.trade, self.strategy, 'market', 'hedge', spot, now,
+                                multiplier=self.delta_per_unit)
+        self.last_hedge = now
+        self.recent.append(now)
+        self.hedges.append({'time': now, 'units': units, 'option_delta': self.option_delta,
+                            'position': self.position})
+        return self.trade
+
+    def on_fill(self, trade, fill):
+
+        '''
+        execDetailsEvent handler: count fills of the hedge instrument into the position
+        '''
+
+        if fill.contract.conId != self.contract.conId or fill.contract.secType == 'BAG':
+            return
+        side = 1 if fill.execution.side == 'BOT' else -1
+        self.position += side * fill.execution.shares
+        self._logger.info("Hedge filled: %s %s at %s, position %s", side * fill.execution.shares, self.symbol,
+                          fill.execution.price, self.position)
@@ -0,0 +1,318 @@
+# Order journal for the live bots.
+#
+# Latency work only matters if it shows up in the prices we trade at, so every
+# order a bot sends is journaled with the times of its life cycle (the
+# decision that priced it, the submit, the broker's acknowledgement, the first
+# and last fill) next to the theoretical mid the decision used and the price
+# it filled at. An order is written once it is done (filled or cancelled) as
+# one row of a columnar store laid out like research/backtesting/chain_data:
+# a directory with one raw little-endian binary file per column plus a
+# meta.json, appended to and memory-mapped for reading. Strategy names and
+# the categorical columns are stored as small integer codes (names in
+# meta.json), times as int64 microseconds (datetime64[us], NaT when missing).
+#
+# Times are taken from the bot's clock when each event arrives, so they
+# compare with the decision time and replays journal on the virtual clock.
+# Recording a row is a few attribute reads per event and one small append per
+# order; the reports group the whole store with vectorized pandas operations:
+#   python journal.py pyoptiontrader_orders [more journal directories]
+
+import datetime
+import json
+import logging
+import math
+import os
+import sys
+
+import numpy as np
+
+FORMAT_VERSION = 1
+
+STYLES = ('bracket', 'limit', 'market')
+# entry / exit of a position (bracket children are exits), rolls, delta hedges
+PURPOSES = ('entry', 'exit', 'roll', 'hedge')
+STATUSES = ('filled', 'cancelled', 'open')
+
+# column name -> dtype
+COLUMNS = {
+    'order_id': 'int64',
+    'parent_id': 'int64',
+    'strategy': 'int16',
+    'style': 'int8',
+    'purpose': 'int8',
+    'action': 'int8',
+    'quantity': 'float64',
+    'multiplier': 'float64',
+    'decision': 'int64',
+    'submit': 'int64',
+    'ack': 'int64',
+    'first_fill': 'int64',
+    'last_fill': 'int64',
+    'mid': 'float64',
+    'limit': 'float64',
+    'fill_price': 'float64',
+    'filled': 'float64',
+    'status': 'int8',
+}
+
+TIMES = ('decision', 'submit', 'ack', 'first_fill', 'last_fill')
+NAT = np.iinfo(np.int64).min
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+# order states the broker has not confirmed yet
+_UNACKNOWLEDGED = ('', 'PendingSubmit', 'ApiPending', 'PendingCancel')
+
+# latency stages reported: name -> (from, to)
+STAGES = {
+    'decision_to_submit': ('decision', 'submit'),
+    'submit_to_ack': ('submit', 'ack'),
+    'submit_to_fill': ('submit', 'first_fill'),
+    'decision_to_fill': ('decision', 'first_fill'),
+}
+
+
+def _micros(time):
+    if time is None:
+        return NAT
+    if time.tzinfo is not None:
+        time = time.astimezone().replace(tzinfo=None)
+    return (time - _EPOCH) // datetime.timedelta(microseconds=1)
+
+
+class OrderJournal:
+
+    '''
+    Record every order from decision to fill into a columnar store
+    :param path: journal directory (created if needed), one writing process per directory
+    :param multiplier: contract multiplier of the strategy's orders, to turn slippage into dollars
+    :param clock: callable returning the current datetime
+    '''
+
+    def __init__(self, path='pyoptiontrader_orders', multiplier=100, clock=None):
+        self._logger = logging.getLogger(__name__)
+        self.path = path
+        self.multiplier = multiplier
+        self.clock = clock or datetime.datetime.now
+        self.pending = {}
+        os.makedirs(path, exist_ok=True)
+        self.rows = 0
+        self.strategies = []
+        if os.path.exists(os.path.join(path, 'meta.json')):
+            meta = read_meta(path)
+            self.rows = meta['rows']
+            self.strategies = meta['strategies']
+        # drop anything a crash left after the last row the meta counted
+        for name, dtype in COLUMNS.items():
+            file = os.path.join(path, f'{name}.bin')
+            with open(file, 'ab') as f:
+                f.truncate(self.rows * np.dtype(dtype).itemsize)
+
+    def submit(self, trade, strategy, style, purpose='entry', mid=math.nan, decided=None, multiplier=None):
+
+        '''
+        Start tracking an order right after placeOrder (which only queues the message, so now is the submit time)
+        :param trade: Trade returned by placeOrder
+        :param strategy: name of the strategy that sent the order
+        :param style: one of STYLES
+        :param purpose: one of PURPOSES
+        :param mid: theoretical mid the decision priced the order from, NaN when there is none
+        :param decided: datetime of the decision, defaults to now
+        :param multiplier: contract multiplier of this order, defaults to the journal's
+        :return: the pending record
+        '''
+
+        now = self.clock()
+        order = trade.order
+        limit = getattr(order, 'lmtPrice', math.nan)
+        record = {
+            'order_id': order.orderId, 'parent_id': order.parentId, 'strategy': self._strategy_code(strategy),
+            'style': STYLES.index(style), 'purpose': PURPOSES.index(purpose),
+            'action': 1 if order.action == 'BUY' else -1, 'quantity': float(order.totalQuantity),
+            'multiplier': float(self.multiplier if multiplier is None else multiplier),
+            'decision': _micros(decided or now), 'submit': _micros(now), 'ack': NAT, 'first_fill': NAT, 'last_fill': NAT, 'mid': float(mid),
+            # order types without a limit carry the unset double
+            'limit': float(limit) if limit is not None and abs(limit) < 1e300 else math.nan,
+            'fill_price': math.nan, 'filled': 0.0, 'status': STATUSES.index('open'), 'trade': trade,
+        }
+        self.pending[id(trade)] = record
+        # a simulated broker acknowledges and may fill inside placeOrder
+        self._update(record, now)
+        return record
+
+    def on_status(self, trade, *args):
+
+        '''
+        openOrderEvent / orderStatusEvent handler: acknowledgement, cancellation and fills of a tracked order
+        '''
+
+        record = self.pending.get(id(trade))
+        if record is not None:
+            self._update(record, self.clock())
+
+    def on_fill(self, trade, fill):
+
+        '''
+        execDetailsEvent handler
+        '''
+
+        self.on_status(trade)
+
+    def _update(self, record, now):
+        trade = record['trade']
+        if record['ack'] == NAT and trade.orderStatus.status not in _UNACKNOWLEDGED:
+            record['ack'] = _micros(now)
+        # combo orders also report an execution per leg, only the fills at the order's own level count
+        fills = [f for f in trade.fills if f.contract.secType == trade.contract.secType]
+        if len(fills) != record.get('fills', 0):
+            if not record.get('fills'):
+                record['first_fill'] = _micros(now)
+            record['last_fill'] = _micros(now)
+            record['fills'] = len(fills)
+            shares = sum(f.execution.shares for f in fills)
+            record['filled'] = float(shares)
+            record['fill_price'] = sum(f.execution.price * f.execution.shares for f in fills) / shares
+        if trade.isDone():
+            record['status'] = STATUSES.index('filled' if trade.orderStatus.status == 'Filled' else 'cancelled')
+            del self.pending[id(trade)]
+            self._write([record])
+
+    def close(self):
+
+        '''
+        Write the orders still open, e.g. on shutdown
+        '''
+
+        records = list(self.pending.values())
+        self.pending.clear()
+        self._write(records)
+
+    def _strategy_code(self, strategy):
+        if strategy not in self.strategies:
+            self.strategies.append(strategy)
+            self._write_meta()
+        return self.strategies.index(strategy)
+
+    def _write(self, records):
+        if not records:
+            return
+        try:
+            for name, dtype in COLUMNS.items():
+                values = np.array([r[name] for r in records], dtype=np.dtype(dtype).newbyteorder('<'))
+                with open(os.path.join(self.path, f'{name}.bin'), 'ab') as f:
+                    values.tofile(f)
+            self.rows += len(records)
+            self._write_meta()
+        except OSError as e:
+            self._logger.error("Could not journal orders: %s", e)
+
+    def _write_meta(self):
+        meta = {'version': FORMAT_VERSION, 'rows': self.rows, 'columns': COLUMNS, 'strategies': self.strategies,
+                'styles': STYLES, 'purposes': PURPOSES, 'statuses': STATUSES}
+        tmp = os.path.join(self.path, 'meta.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(meta, f, indent=2)
+        os.replace(tmp, os.path.join(self.path, 'meta.json'))
+
+
+def read_meta(path):
+    with open(os.path.join(path, 'meta.json')) as f:
+        return json.load(f)
+
+
+def load_columns(path):
+
+    '''
+    Memory-map every column of a journal
+    :param path: journal directory
+    :return: (dict of column name -> read-only array, meta)
+    '''
+
+    meta = read_meta(path)
+    rows = meta['rows']
+    columns = {}
+    for name, dtype in meta['columns'].items():
+        if rows == 0:
+            columns[name] = np.empty(0, dtype=dtype)
+        else:
+            columns[name] = np.memmap(os.path.join(path, f'{name}.bin'), dtype=np.dtype(dtype).newbyteorder('<'),
+                                      mode='r', shape=(rows,))
+    return columns, meta
+
+
+def load_orders(*paths):
+
+    '''
+    Orders of one or more journals as a DataFrame with decoded labels, datetimes, latencies and slippage
+    :param paths: journal directories
+    :return: DataFrame, one row per order
+    '''
+
+    import pandas as pd
+
+    frames = []
+    for path in paths:
+        columns, meta = load_columns(path)
+        frame = pd.DataFrame({name: np.asarray(values) for name, values in columns.items()})
+        for name, labels in (('strategy', meta['strategies']), ('style', meta['styles']),
+                             ('purpose', meta['purposes']), ('status', meta['statuses'])):
+            frame[name] = pd.Categorical.from_codes(frame[name], categories=labels)
+        frames.append(frame)
+    orders = pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+    for name in ('strategy', 'style', 'purpose', 'status'):
+        orders[name] = orders[name].astype(str)
+    for name in TIMES:
+        orders[name] = orders[name].to_numpy().view('datetime64[us]')
+    for stage, (start, end) in STAGES.items():
+        orders[stage] = (orders[end] - orders[start]).dt.total_seconds()
+    # positive is a cost: paid above the mid on a buy, received below it on a sell (per share and in dollars)
+    orders['slippage'] = orders['action'] * (orders['fill_price'] - orders['mid'])
+    orders['slippage_dollars'] = orders['slippage'] * orders['filled'] * orders['multiplier']
+    orders['hour'] = orders['decision'].dt.hour
+    return orders
+
+
+def latency_report(orders, by=('strategy', 'style'), percentiles=(50, 90, 99)):
+
+    '''
+    Latency percentiles of every stage per group
+    :param orders: load_orders() frame
+    :param by: columns to group by (strategy, style, purpose, hour, ...)
+    :param percentiles: percentiles to report
+    :return: DataFrame indexed by the groups, one column per (stage, percentile) in seconds, plus the order count
+    '''
+
+    groups = orders.groupby(list(by), observed=True)
+    stages = list(STAGES)
+    report = groups[stages].quantile([p / 100 for p in percentiles]).unstack()
+    report.columns = [f'{stage}_p{int(round(q * 100))}' for stage, q in report.columns]
+    report.insert(0, 'orders', groups.size())
+    return report
+
+
+def slippage_report(orders, by=('strategy', 'style')):
+
+    '''
+    Slippage against the decision's mid per group, for the filled orders that had a mid
+    :param orders: load_orders() frame
+    :param by: columns to group by
+    :return: DataFrame indexed by the groups: fills, mean and median slippage per share, total dollars
+    '''
+
+    filled = orders[(orders['status'] == 'filled') & orders['slippage'].notna()]
+    groups = filled.groupby(list(by), observed=True)
+    return groups.agg(fills=('slippage', 'size'), mean=('slippage', 'mean'), median=('slippage', 'median'),
+                      dollars=('slippage_dollars', 'sum'))
+
+
+if __name__ == '__main__':
+    import pandas as pd
+
+    if len(sys.argv) < 2:
+        sys.exit("usage: python journal.py JOURNAL_DIR [JOURNAL_DIR ...]")
+    frame = load_orders(*sys.argv[1:])
+    with pd.option_context('display.width', 200, 'display.max_columns', 50):
+        for keys in (('strategy', 'style'), ('strategy', 'hour')):
+            print(f"\nLatency (seconds) by {' / '.join(keys)}")
+            print(latency_report(frame, by=keys).round(3))
+            print(f"\nSlippage vs decision mid by {' / '.join(keys)}")
+            print(slippage_report(frame, by=keys).round(4))
@@ -0,0 +1,260 @@
+# Per-stage latency instrumentation for the live trading bots.
+#
+# Stages of the decision path (bar callback, strike selection, the blocking
+# ib_insync requests, ...) are timed with span() and recorded into HDR-style
+# log-linear histograms. Recording is a perf_counter_ns() pair plus a list
+# increment so it can stay on in production. A background thread
+# periodically logs a one line summary per stage and writes the histograms
+# in the Prometheus text exposition format (for node_exporter's textfile
+# collector or anything else that scrapes that format).
+
+import functools
+import logging
+import os
+import threading
+import time
+
+# 2^7 sub-buckets per power of two keeps the relative error of any
+# recorded value under 1/64 (~1.6%) while covering ns to hours
+_SUB_BITS = 7
+_SUB_COUNT = 1 << _SUB_BITS
+_HALF_COUNT = _SUB_COUNT >> 1
+_MAX_EXPONENT = 40
+
+# Upper bounds (seconds) of the Prometheus histogram buckets we export
+PROMETHEUS_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                      1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _bucket_index(value):
+    if value < _SUB_COUNT:
+        return value
+    exponent = value.bit_length() - _SUB_BITS
+    return (exponent + 1) * _HALF_COUNT + (value >> exponent) - _HALF_COUNT
+
+
+def _bucket_value(index):
+    if index < _SUB_COUNT:
+        return index
+    exponent = index // _HALF_COUNT - 1
+    return (index - exponent * _HALF_COUNT) << exponent
+
+
+class Histogram:
+
+    '''
+    HDR-style log-linear histogram of durations in nanoseconds.
+    Recording is O(1) and allocation free.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.counts = [0] * ((_MAX_EXPONENT + 2) * _HALF_COUNT)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, nanos):
+        if nanos < 0:
+            nanos = 0
+        index = _bucket_index(nanos)
+        if index >= len(self.counts):
+            index = len(self.counts) - 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += nanos
+        if nanos > self.max:
+            self.max = nanos
+
+    def percentile(self, pct):
+
+        '''
+        Get the value at the given percentile
+        :param pct: percentile between 0 and 100
+        :return: duration in nanoseconds (lower edge of the matching bucket)
+        '''
+
+        if self.count == 0:
+            return 0
+        target = max(1, int(round(self.count * pct / 100.0)))
+        seen = 0
+        for index, n in enumerate(self.counts):
+            seen += n
+            if seen >= target:
+                return min(_bucket_value(index), self.max)
+        return self.max
+
+    def count_le(self, nanos):
+        # number of recorded values whose bucket starts at or below nanos
+        limit = _bucket_index(int(nanos))
+        return sum(self.counts[:limit + 1])
+
+    def reset(self):
+        self.counts = [0] * len(self.counts)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+
+class LatencyRecorder:
+
+    '''
+    Registry of one histogram per stage
+    '''
+
+    def __init__(self):
+        self.histograms = {}
+        self._lock = threading.Lock()
+        self._reporter = None
+
+    def histogram(self, stage):
+        hist = self.histograms.get(stage)
+        if hist is None:
+            with self._lock:
+                hist = self.histograms.setdefault(stage, Histogram(stage))
+        return hist
+
+    def record(self, stage, nanos):
+        self.histogram(stage).record(nanos)
+
+    def span(self, stage):
+
+        '''
+        Time a block of code
+        :param stage: name of the stage being timed
+        :return: context manager that records the elapsed time on exit
+        '''
+
+        return _Span(self.histogram(stage))
+
+    def timed(self, stage=None):
+
+        '''
+        Decorator that times every call of the wrapped function
+        :param stage: name of the stage, defaults to the function name
+        '''
+
+        def decorator(func):
+            hist = self.histogram(stage or func.__name__)
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter_ns()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    hist.record(time.perf_counter_ns() - start)
+            return wrapper
+        return decorator
+
+    def summary(self):
+
+        '''
+        One line summary of every stage
+        :return: string like "get_strike n=3 p50=1.20ms p99=2.31ms max=2.40ms | ..."
+        '''
+
+        parts = []
+        for stage, hist in sorted(self.histograms.items()):
+            if hist.count:
+                parts.append(f"{stage} n={hist.count} p50={_ms(hist.percentile(50))} "
+                             f"p99={_ms(hist.percentile(99))} max={_ms(hist.max)}")
+        return " | ".join(parts)
+
+    def to_prometheus(self, metric="pyoptiontrader_stage_latency_seconds"):
+
+        '''
+        Render every histogram in the Prometheus text exposition format
+        :param metric: base metric name
+        :return: the exposition text
+        '''
+
+        lines = [f"# HELP {metric} Latency of each stage of the trading decision path.",
+                 f"# TYPE {metric} histogram"]
+        quantiles = []
+        for stage, hist in sorted(self.histograms.items()):
+            for bound in PROMETHEUS_BUCKETS:
+                lines.append(f'{metric}_bucket{{stage="{stage}",le="{bound}"}} {hist.count_le(bound * 1e9)}')
+            lines.append(f'{metric}_bucket{{stage="{stage}",le="+Inf"}} {hist.count}')
+            lines.append(f'{metric}_sum{{stage="{stage}"}} {hist.total / 1e9:.9f}')
+            lines.append(f'{metric}_count{{stage="{stage}"}} {hist.count}')
+            for q in (50, 90, 99, 99.9):
+                quantiles.append(f'{metric}_quantile{{stage="{stage}",quantile="{q / 100}"}} '
+                                 f'{hist.percentile(q) / 1e9:.9f}')
+        lines.append(f"# HELP {metric}_quantile Stage latency quantiles from the HDR histogram.")
+        lines.append(f"# TYPE {metric}_quantile gauge")
+        lines.extend(quantiles)
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+
+        '''
+        Atomically write the Prometheus text file so scrapers never see a partial file
+        :param path: destination file, usually ending in .prom
+        :return: None
+        '''
+
+        tmp = f"{path}.tmp"
+        with open(tmp, "w") as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp, path)
+
+    def start_reporting(self, interval=60, path=None, logger=None):
+
+        '''
+        Start a daemon thread that logs the summary and writes the Prometheus file
+        :param interval: seconds between reports
+        :param path: Prometheus text file to write, skipped when None
+        :param logger: logger for the summary line
+        :return: None
+        '''
+
+        logger = logger or logging.getLogger(__name__)
+        if self._reporter is not None:
+            self._reporter.set()
+        stop = threading.Event()
+        self._reporter = stop
+
+        def report():
+            while not stop.wait(interval):
+                try:
+                    line = self.summary()
+                    if line:
+                        logger.info("Latency: %s", line)
+                    if path is not None:
+                        self.write_prometheus(path)
+                except Exception as e:
+                    logger.error("Could not report latency: %s", e)
+
+        threading.Thread(target=report, name="latency-reporter", daemon=True).start()
+
+    def stop_reporting(self):
+        if self._reporter is not None:
+            self._reporter.set()
+            self._reporter = None
+
+
+class _Span:
+
+    __slots__ = ("hist", "start")
+
+    def __init__(self, hist):
+        self.hist = hist
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        self.hist.record(time.perf_counter_ns() - self.start)
+        return False
+
+
+def _ms(nanos):
+    return f"{nanos / 1e6:.2f}ms"
+
+
+# Process wide recorder used by the bots
+recorder = LatencyRecorder()
+span = recorder.span
+timed = recorder.timed
@@ -0,0 +1,173 @@
+# Structured, non-blocking logging for the live trading bots.
+#
+# Every call on the hot path (bar callbacks, order placement) only builds a
+# LogRecord and drops it on a queue. A background listener thread does the
+# expensive work: message formatting, JSON encoding and the write to stdout
+# or a log file. Records are written as JSON-lines so they can be grepped,
+# tailed or loaded straight into pandas with pd.read_json(path, lines=True).
+
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import time
+
+# Same human-readable format the bots used to print with get_timestamp()
+TIMESTAMP_FORMAT = "%Y-%m-%d %I:%M:%S%p"
+
+# Environment variable used to override the configured log level
+LEVEL_ENV_VAR = "PYOPTIONTRADER_LOG_LEVEL"
+
+# Attributes every LogRecord has, anything else was passed through extra={}
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "taskName"}
+
+_listener = None
+
+
+class _SecondCache:
+
+    '''
+    strftime is slow relative to everything else we do per record,
+    so only re-format the timestamp when the wall clock second changes.
+    '''
+
+    def __init__(self, fmt=TIMESTAMP_FORMAT):
+        self.fmt = fmt
+        self._second = None
+        self._text = ""
+
+    def __call__(self, created):
+        second = int(created)
+        if second != self._second:
+            self._second = second
+            self._text = datetime.datetime.fromtimestamp(second).strftime(self.fmt)
+        return self._text
+
+
+class JsonLinesFormatter(logging.Formatter):
+
+    '''
+    Format a LogRecord as a single JSON object per line.
+    Fields passed with extra={...} are added to the object as-is.
+    '''
+
+    def __init__(self, timestamp_format=TIMESTAMP_FORMAT):
+        super().__init__()
+        self._timestamp = _SecondCache(timestamp_format)
+
+    def format(self, record):
+        entry = {
+            "ts": self._timestamp(record.created),
+            "epoch": round(record.created, 6),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+# Argument types that can not change after the call, safe to format later on the listener thread
+_IMMUTABLE = (str, int, float, bool, bytes, type(None), datetime.date, datetime.time, datetime.timedelta)
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+
+    '''
+    The stock QueueHandler formats the message in the calling thread.
+    Hand the raw record to the listener instead so the caller only pays
+    for the queue put, as long as every argument is immutable (numbers,
+    strings, dates). Anything else (an ib_insync Trade or Fill keeps being
+    updated after it is logged) is formatted here, so the line shows the
+    state at the time of the call.
+    '''
+
+    def prepare(self, record):
+        args = record.args
+        if args and not all(isinstance(arg, _IMMUTABLE) for arg in (args.values() if isinstance(args, dict) else args)):
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+
+def setup_logging(level="INFO", path=None, stream=None, timestamp_format=TIMESTAMP_FORMAT):
+
+    '''
+    Route all logging through a queue to a background JSON-lines writer
+    :param level: minimum level to emit (name or number), overridden by $PYOPTIONTRADER_LOG_LEVEL
+    :param path: file to append the JSON-lines to, stdout is used when None
+    :param stream: stream to write to when no path is given (defaults to sys.stdout)
+    :param timestamp_format: strftime format of the cached per-second timestamp
+    :return: the running QueueListener
+    '''
+
+    global _listener
+    if _listener is not None:
+        shutdown_logging()
+
+    level = os.environ.get(LEVEL_ENV_VAR, level)
+    if isinstance(level, str):
+        level = logging.getLevelName(level.upper())
+
+    if path is not None:
+        writer = logging.FileHandler(path, encoding="utf-8")
+    else:
+        writer = logging.StreamHandler(stream if stream is not None else sys.stdout)
+    writer.setFormatter(JsonLinesFormatter(timestamp_format))
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_DeferredQueueHandler(log_queue))
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(log_queue, writer, respect_handler_level=False)
+    _listener.start()
+    return _listener
+
+
+def shutdown_logging():
+
+    '''
+    Flush every queued record and stop the background writer
+    :return: None
+    '''
+
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+
+def measure_log_cost(logger=None, n=10000):
+
+    '''
+    Measure how long a single logger.info() call takes on the calling thread
+    :param logger: logger to measure, a throwaway logger is used when None
+    :param n: number of calls to average over
+    :return: mean cost per call in microseconds
+    '''
+
+    logger = logger or logging.getLogger("pyoptiontrader.benchmark")
+    start = time.perf_counter()
+    for i in range(n):
+        logger.info("New Bar Received... %d", i)
+    return (time.perf_counter() - start) / n * 1e6
+
+
+if __name__ == "__main__":
+    # Benchmark the per-call cost seen by the bar callback
+    setup_logging(path=os.devnull)
+    cost = measure_log_cost()
+    shutdown_logging()
+    print(f"logger.info() cost on the calling thread: {cost:.2f} us/call")
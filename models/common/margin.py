@@ -0,0 +1,210 @@
+# Local initial margin estimates for the option structures the bots trade.
+#
+# place_order used to block on ib.whatIfOrder() before every entry just to
+# read initMarginChange for the position sizing. The functions here compute
+# the requirement locally, vectorized over candidate structures:
+#   * strangle_margin / straddle_margin: Reg-T naked short options, the larger
+#     side's requirement (20% of the underlying less the OTM amount, at least
+#     10% of the underlying for calls and of the strike for puts) plus the
+#     premium of both legs,
+#   * iron_condor_margin: Reg-T defined risk, the wider of the two spreads,
+#   * portfolio_margin: portfolio-margin style, the worst loss of the legs over
+#     the TIMS-like range of underlying moves (+-15% in 10 steps), with a
+#     minimum per contract.
+# The broker does not use exactly these rules (house margins, PM vol shifts,
+# rounding), so MarginModel scales each structure's estimate by the median
+# ratio of the broker's answer to the local one over recent whatIfOrder
+# responses, persisted to a JSON file so the calibration survives restarts.
+# Once calibrated, a what-if is only due every verify_every orders, and the
+# bots run it after the order is placed, off the decision path.
+
+import json
+import logging
+import os
+
+import numpy as np
+
+try:
+    from common import startup
+except ImportError:  # run as a script from models/common
+    import startup
+
+# scipy takes a while to import and is only needed once a portfolio margin is estimated
+special = startup.lazy_import('scipy.special')
+
+# TIMS style underlying moves of portfolio margin for equities and ETFs
+PM_MOVES = np.linspace(-0.15, 0.15, 11)
+PM_MIN_PER_CONTRACT = 37.50
+
+
+def strangle_margin(S, call_strike, put_strike, premium, multiplier=100):
+
+    '''
+    Reg-T initial margin of one short strangle
+    :param S: underlying price
+    :param call_strike: short call strike
+    :param put_strike: short put strike
+    :param premium: premium of both legs together (the combo price)
+    :param multiplier: contract multiplier
+    :return: dollars per strangle, broadcast over the inputs
+    '''
+
+    S = np.asarray(S, dtype=float)
+    call_strike = np.asarray(call_strike, dtype=float)
+    put_strike = np.asarray(put_strike, dtype=float)
+    call = np.maximum(0.20 * S - np.maximum(call_strike - S, 0.0), 0.10 * S)
+    put = np.maximum(0.20 * S - np.maximum(S - put_strike, 0.0), 0.10 * put_strike)
+    return (np.abs(premium) + np.maximum(call, put)) * multiplier
+
+
+def straddle_margin(S, strike, premium, multiplier=100):
+
+    '''
+    Reg-T initial margin of one short straddle
+    :return: dollars per straddle, broadcast over the inputs
+    '''
+
+    return strangle_margin(S, strike, strike, premium, multiplier)
+
+
+def iron_condor_margin(short_call, long_call, short_put, long_put, multiplier=100):
+
+    '''
+    Reg-T initial margin of one short iron condor: the width of the wider spread
+    (only one side can finish in the money)
+    :return: dollars per condor, broadcast over the inputs
+    '''
+
+    call_width = np.abs(np.asarray(long_call, dtype=float) - np.asarray(short_call, dtype=float))
+    put_width = np.abs(np.asarray(short_put, dtype=float) - np.asarray(long_put, dtype=float))
+    return np.maximum(call_width, put_width) * multiplier
+
+
+def portfolio_margin(S, rights, strikes, quantities, T, iv, multiplier=100, moves=PM_MOVES,
+                     min_per_contract=PM_MIN_PER_CONTRACT):
+
+    '''
+    Portfolio-margin style requirement: worst loss of the legs over the underlying moves
+    :param S: underlying price per candidate, shape (candidates,)
+    :param rights: leg rights per candidate ('C'/'P', booleans or signed numbers), shape (candidates, legs)
+    :param strikes: leg strikes, shape (candidates, legs)
+    :param quantities: signed leg contracts (negative short), shape (candidates, legs)
+    :param T: annualized time to expiration, broadcast to (candidates, legs)
+    :param iv: leg implied volatilities, broadcast to (candidates, legs)
+    :param moves: relative underlying moves scanned
+    :param min_per_contract: floor per short contract
+    :return: dollars per candidate
+    '''
+
+    S = np.asarray(S, dtype=float).reshape(-1, 1, 1)
+    rights = np.asarray(rights)
+    call = (np.char.upper(rights.astype(str)) == 'C') if rights.dtype.kind in 'USO' else np.asarray(rights) > 0
+    K = np.asarray(strikes, dtype=float)[:, :, None]
+    qty = np.asarray(quantities, dtype=float)
+    vol_t = np.asarray(iv, dtype=float) * np.sqrt(np.maximum(np.asarray(T, dtype=float), 1e-10))
+    vol_t = np.broadcast_to(vol_t, qty.shape)[:, :, None]
+    call = np.broadcast_to(call, qty.shape)[:, :, None]
+
+    def value(spot):
+        d1 = (np.log(spot / K) + 0.5 * vol_t * vol_t) / vol_t
+        return spot * special.ndtr(d1) - K * special.ndtr(d1 - vol_t) + np.where(call, 0.0, K - spot)
+
+    moved = S * (1.0 + np.asarray(moves, dtype=float)[None, None, :])
+    pnl = ((value(moved) - value(S)) * qty[:, :, None]).sum(axis=1) * multiplier
+    floor = np.maximum(-qty, 0.0).sum(axis=1) * min_per_contract
+    return np.maximum(-pnl.min(axis=1), floor)
+
+
+STRUCTURES = {
+    'strangle': strangle_margin,
+    'straddle': straddle_margin,
+    'iron_condor': iron_condor_margin,
+    'portfolio': portfolio_margin,
+}
+
+
+class MarginModel:
+
+    '''
+    Local margin estimates scaled to the broker's what-if answers
+    :param path: JSON file of the (local, broker) observations, None to keep them in memory only
+    :param verify_every: orders between what-if checks once a structure is calibrated
+    :param min_samples: what-if answers needed before the local estimate is trusted
+    :param max_samples: observations kept per structure
+    '''
+
+    def __init__(self, path='pyoptiontrader_margin.json', verify_every=20, min_samples=3, max_samples=50):
+        self._logger = logging.getLogger(__name__)
+        self.path = path
+        self.verify_every = verify_every
+        self.min_samples = min_samples
+        self.max_samples = max_samples
+        self.samples = {}
+        self.factors = {}
+        self.since_check = {}
+        if path and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.samples = {k: [tuple(s) for s in v] for k, v in json.load(f).items()}
+            except (OSError, ValueError) as e:
+                self._logger.warning("Could not read margin calibration %s: %s", path, e)
+        for structure in self.samples:
+            self._refit(structure)
+
+    def _refit(self, structure):
+        ratios = [broker / local for local, broker in self.samples[structure] if local > 0 and broker > 0]
+        if ratios:
+            self.factors[structure] = float(np.median(ratios))
+
+    def calibrated(self, structure):
+        return len(self.samples.get(structure, ())) >= self.min_samples
+
+    def estimate(self, structure, *args, **kwargs):
+
+        '''
+        Calibrated margin estimate
+        :param structure: key of STRUCTURES
+        :param args: arguments of the structure's margin function (arrays of candidates)
+        :return: (calibrated estimate, raw local estimate)
+        '''
+
+        raw = STRUCTURES[structure](*args, **kwargs)
+        return raw * self.factors.get(structure, 1.0), raw
+
+    def due(self, structure):
+
+        '''
+        Whether this order should be checked against whatIfOrder, counts the order
+        :return: True while uncalibrated and every verify_every orders after that
+        '''
+
+        count = self.since_check.get(structure, 0) + 1
+        self.since_check[structure] = count
+        return not self.calibrated(structure) or count >= self.verify_every
+
+    def observe(self, structure, local, broker):
+
+        '''
+        Record a what-if answer for a local estimate and refit the structure's factor
+        :param local: raw local estimate (second value of estimate())
+        :param broker: the broker's initMarginChange for the same order
+        '''
+
+        local, broker = float(np.squeeze(local)), float(broker)
+        if not (np.isfinite(local) and np.isfinite(broker)) or local <= 0 or broker <= 0:
+            return
+        samples = self.samples.setdefault(structure, [])
+        samples.append((local, broker))
+        del samples[:-self.max_samples]
+        self.since_check[structure] = 0
+        self._refit(structure)
+        self._logger.info("Margin model %s: broker %s, local %s, factor %s", structure, round(broker, 2),
+                          round(local, 2), round(self.factors[structure], 4))
+        if self.path:
+            tmp = f"{self.path}.tmp"
+            try:
+                with open(tmp, 'w') as f:
+                    json.dump(self.samples, f)
+                os.replace(tmp, self.path)
+            except OSError as e:
+                self._logger.warning("Could not save margin calibration %s: %s", self.path, e)
@@ -0,0 +1,183 @@
+# Monte Carlo exit P&L of a short strangle under the live management rules.
+#
+# The underlying is simulated as a geometric Brownian motion with one step
+# per calendar day over the remaining holding period. Both legs are repriced
+# with Black-Scholes on every step of every path, and each path exits at the
+# first step where the combo
+#   * has decayed to take_profit_factor x the entry credit (the bracket's
+#     take profit limit, filled at that price),
+#   * has grown to stop_loss_factor x the entry credit (the bracket's stop,
+#     filled at the mark),
+#   * reaches exit_dte days to expiration (manage_strangle's market close).
+# Paths are generated and priced in chunks that keep the (paths x days)
+# working arrays under max_elements, so a million paths runs in bounded
+# memory. The same call covers a candidate before entry (entry_credit
+# defaults to the model price) and an open position (pass its entry credit
+# and the days left).
+
+import argparse
+import time
+
+import numpy as np
+from scipy.special import ndtr
+
+try:
+    from common import pricing
+except ImportError:  # run as a script from models/common
+    import pricing
+
+TAKE_PROFIT, STOP_LOSS, TIME_EXIT = 0, 1, 2
+EXIT_REASONS = ('take_profit', 'stop_loss', 'exit_dte')
+
+
+class MonteCarloResult:
+
+    '''
+    Exit P&L distribution of one simulated strangle
+    :param pnl: per path P&L in dollars
+    :param reason: per path exit reason code (TAKE_PROFIT, STOP_LOSS, TIME_EXIT)
+    :param days_held: per path calendar days until the exit
+    :param entry_credit: credit per strangle the P&L is measured against
+    '''
+
+    def __init__(self, pnl, reason, days_held, entry_credit):
+        self.pnl = pnl
+        self.reason = reason
+        self.days_held = days_held
+        self.entry_credit = entry_credit
+
+    def probability(self, reason):
+        return float(np.mean(self.reason == reason)) if self.reason.size else 0.0
+
+    def summary(self):
+        pnl = self.pnl
+        p1, p5, p50, p95 = np.percentile(pnl, [1, 5, 50, 95])
+        tail = pnl[pnl <= p5]
+        return {
+            'paths': int(pnl.size),
+            'entry_credit': round(float(self.entry_credit), 4),
+            'expected_pnl': float(np.mean(pnl)),
+            'std_pnl': float(np.std(pnl)),
+            'p1': float(p1), 'p5': float(p5), 'median': float(p50), 'p95': float(p95),
+            'cvar_5': float(np.mean(tail)) if tail.size else float(p5),
+            'prob_profit': float(np.mean(pnl > 0)),
+            'prob_take_profit': self.probability(TAKE_PROFIT),
+            'prob_stop': self.probability(STOP_LOSS),
+            'prob_exit_dte': self.probability(TIME_EXIT),
+            'expected_days_held': float(np.mean(self.days_held)),
+        }
+
+
+def _strangle_value(S, log_return, call_strike, put_strike, T, call_iv, put_iv):
+    # Black-Scholes (zero rate) of both legs on the path grid, working from the log returns
+    # saves a log per leg and only evaluates the branch each leg needs
+    path = S * np.exp(log_return)
+    T = np.maximum(T, 1e-10)
+    call_vol_t = call_iv * np.sqrt(T)
+    d1 = (np.log(S / call_strike) + log_return + 0.5 * call_vol_t * call_vol_t) / call_vol_t
+    value = path * ndtr(d1) - call_strike * ndtr(d1 - call_vol_t)
+    put_vol_t = put_iv * np.sqrt(T)
+    d1 = (np.log(S / put_strike) + log_return + 0.5 * put_vol_t * put_vol_t) / put_vol_t
+    value += put_strike * ndtr(put_vol_t - d1) - path * ndtr(-d1)
+    return value
+
+
+def simulate_strangle(S, call_strike, put_strike, days_to_expiry, call_iv, put_iv=None, entry_credit=None,
+                      take_profit_factor=0.50, stop_loss_factor=3.00, exit_dte=21, paths=100_000, realized_vol=None,
+                      drift=0.0, quantity=1, multiplier=100, max_elements=2_000_000, seed=None):
+
+    '''
+    Simulate the exit P&L of a short strangle
+    :param S: underlying price now
+    :param call_strike: short call strike
+    :param put_strike: short put strike
+    :param days_to_expiry: calendar days to expiration now
+    :param call_iv: implied volatility the call is marked at (held constant along the paths)
+    :param put_iv: implied volatility the put is marked at, defaults to call_iv
+    :param entry_credit: credit received per strangle, defaults to the current model price (a candidate)
+    :param take_profit_factor: exit when the combo is worth this fraction of the credit
+    :param stop_loss_factor: exit when the combo is worth this multiple of the credit
+    :param exit_dte: close at this many days to expiration
+    :param paths: number of simulated paths
+    :param realized_vol: volatility of the simulated underlying, defaults to the mean of the leg IVs
+    :param drift: annualized drift of the underlying
+    :param quantity: strangles held
+    :param multiplier: contract multiplier
+    :param max_elements: cap on paths x days per chunk, bounds the memory of large runs
+    :param seed: random seed
+    :return: MonteCarloResult
+    '''
+
+    put_iv = call_iv if put_iv is None else put_iv
+    sigma = realized_vol if realized_vol is not None else 0.5 * (call_iv + put_iv)
+    strikes = np.array([call_strike, put_strike], dtype=float)
+    ivs = np.array([call_iv, put_iv], dtype=float)
+    rights = np.array([1, -1])
+    value_now = float(np.sum(pricing.black_scholes(rights, S, strikes, days_to_expiry / 365, ivs)))
+    credit = value_now if entry_credit is None else float(entry_credit)
+    take_profit = credit * take_profit_factor
+    stop_loss = credit * stop_loss_factor
+    size = quantity * multiplier
+
+    horizon = int(max(np.floor(days_to_expiry) - exit_dte, 0))
+    pnl = np.empty(paths)
+    reason = np.empty(paths, dtype=np.int8)
+    days_held = np.empty(paths, dtype=np.int32)
+
+    # already at the exit date or through a bracket level: every path exits now
+    if horizon == 0 or value_now <= take_profit or value_now >= stop_loss:
+        code = TAKE_PROFIT if value_now <= take_profit else STOP_LOSS if value_now >= stop_loss else TIME_EXIT
+        pnl[:] = (credit - (take_profit if code == TAKE_PROFIT else value_now)) * size
+        reason[:] = code
+        days_held[:] = 0
+        return MonteCarloResult(pnl, reason, days_held, credit)
+
+    rng = np.random.default_rng(seed)
+    dt = 1 / 365
+    step_drift = (drift - 0.5 * sigma * sigma) * dt
+    step_vol = sigma * np.sqrt(dt)
+    T = (days_to_expiry - np.arange(1, horizon + 1)) / 365
+    chunk = max(1, max_elements // horizon)
+
+    for lo in range(0, paths, chunk):
+        n = min(chunk, paths - lo)
+        # (n, horizon) log returns of the underlying, then the combo mark on every step
+        log_return = np.cumsum(step_drift + step_vol * rng.standard_normal((n, horizon)), axis=1)
+        value = _strangle_value(S, log_return, call_strike, put_strike, T, call_iv, put_iv)
+
+        hit_tp = value <= take_profit
+        hit_sl = value >= stop_loss
+        hit = hit_tp | hit_sl
+        exited = hit.any(axis=1)
+        step = np.where(exited, hit.argmax(axis=1), horizon - 1)
+        rows = np.arange(n)
+        tp_exit = exited & hit_tp[rows, step]
+        sl_exit = exited & ~tp_exit
+
+        exit_value = np.where(tp_exit, take_profit, value[rows, step])
+        pnl[lo:lo + n] = (credit - exit_value) * size
+        reason[lo:lo + n] = np.where(tp_exit, TAKE_PROFIT, np.where(sl_exit, STOP_LOSS, TIME_EXIT))
+        days_held[lo:lo + n] = step + 1
+    return MonteCarloResult(pnl, reason, days_held, credit)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Monte Carlo exit P&L of a short strangle')
+    parser.add_argument('--spot', type=float, required=True)
+    parser.add_argument('--call', type=float, required=True, help='call strike')
+    parser.add_argument('--put', type=float, required=True, help='put strike')
+    parser.add_argument('--dte', type=float, default=45, help='days to expiration')
+    parser.add_argument('--iv', type=float, required=True, help='implied volatility, e.g. 0.18')
+    parser.add_argument('--put-iv', type=float)
+    parser.add_argument('--credit', type=float, help='entry credit of an open position')
+    parser.add_argument('--paths', type=int, default=100_000)
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    result = simulate_strangle(args.spot, args.call, args.put, args.dte, args.iv, args.put_iv, args.credit,
+                               paths=args.paths, seed=args.seed)
+    elapsed = time.perf_counter() - started
+    for key, value in result.summary().items():
+        print(f"{key}: {value:.4f}" if isinstance(value, float) else f"{key}: {value}")
+    print(f"{args.paths:,} paths in {elapsed * 1000:.0f}ms")
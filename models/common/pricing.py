@@ -0,0 +1,154 @@
+# Vectorized Black-Scholes pricing and greeks.
+#
+# Same model and conventions the live bots get from py_vollib_vectorized
+# (model='black_scholes', zero rate by default, vega per 1 vol point and
+# theta per calendar day), written directly in NumPy so that research code,
+# backtests and the risk tools can price millions of options per call
+# without a numba compile step or a pandas round trip.
+#
+# Every function broadcasts over its inputs. Option rights may be given as
+# 'c'/'p' (any case), booleans (True = call) or signed numbers (> 0 = call),
+# the last being how rights are stored in the chain data files.
+
+import numpy as np
+
+try:
+    from common import startup
+except ImportError:  # run as a script from models/common
+    import startup
+
+# scipy takes a while to import and is only needed once something is priced
+special = startup.lazy_import('scipy.special')
+
+_SQRT_2PI = np.sqrt(2 * np.pi)
+
+
+def is_call(flag):
+
+    '''
+    Normalize an option right to a boolean call mask
+    :param flag: 'c'/'p', booleans or signed numbers
+    :return: boolean array, True for calls
+    '''
+
+    flag = np.asarray(flag)
+    if flag.dtype.kind in 'USO':
+        return np.char.lower(flag.astype(str)) == 'c'
+    if flag.dtype.kind == 'b':
+        return flag
+    return flag > 0
+
+
+def _d1_d2(S, K, T, sigma, r):
+    vol_t = sigma * np.sqrt(T)
+    d1 = (np.log(S / K) + (r + 0.5 * sigma * sigma) * T) / vol_t
+    return d1, d1 - vol_t
+
+
+def black_scholes(flag, S, K, T, sigma, r=0.0):
+
+    '''
+    Price European options
+    :param flag: option right(s)
+    :param S: underlying price
+    :param K: strike
+    :param T: annualized time to expiration
+    :param sigma: implied volatility
+    :param r: risk free rate
+    :return: option prices (intrinsic value where T <= 0)
+    '''
+
+    call = is_call(flag)
+    S, K, T, sigma = (np.asarray(x, dtype=float) for x in (S, K, T, sigma))
+    live = (T > 0) & (sigma > 0)
+    T_ = np.where(live, T, 1.0)
+    sigma_ = np.where(live, sigma, 1.0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        d1, d2 = _d1_d2(S, K, T_, sigma_, r)
+    discount = np.exp(-r * T_)
+    call_price = S * special.ndtr(d1) - K * discount * special.ndtr(d2)
+    put_price = K * discount * special.ndtr(-d2) - S * special.ndtr(-d1)
+    price = np.where(call, call_price, put_price)
+    intrinsic = np.where(call, np.maximum(S - K, 0.0), np.maximum(K - S, 0.0))
+    return np.where(live, price, intrinsic)
+
+
+def greeks(flag, S, K, T, sigma, r=0.0):
+
+    '''
+    Price and greeks of European options
+    :param flag: option right(s)
+    :param S: underlying price
+    :param K: strike
+    :param T: annualized time to expiration
+    :param sigma: implied volatility
+    :param r: risk free rate
+    :return: dict of arrays: price, delta, gamma, vega (per vol point) and theta (per day)
+    '''
+
+    call = is_call(flag)
+    S, K, T, sigma = (np.asarray(x, dtype=float) for x in (S, K, T, sigma))
+    live = (T > 0) & (sigma > 0)
+    T_ = np.where(live, T, 1.0)
+    sigma_ = np.where(live, sigma, 1.0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        d1, d2 = _d1_d2(S, K, T_, sigma_, r)
+    sqrt_t = np.sqrt(T_)
+    discount = np.exp(-r * T_)
+    pdf_d1 = np.exp(-0.5 * d1 * d1) / _SQRT_2PI
+    nd1, nd2 = special.ndtr(d1), special.ndtr(d2)
+
+    price = np.where(call, S * nd1 - K * discount * nd2, K * discount * (1 - nd2) - S * (1 - nd1))
+    delta = np.where(call, nd1, nd1 - 1.0)
+    gamma = pdf_d1 / (S * sigma_ * sqrt_t)
+    vega = S * pdf_d1 * sqrt_t * 0.01
+    decay = -S * pdf_d1 * sigma_ / (2 * sqrt_t)
+    theta = np.where(call, decay - r * K * discount * nd2, decay + r * K * discount * (1 - nd2)) / 365
+
+    intrinsic = np.where(call, np.maximum(S - K, 0.0), np.maximum(K - S, 0.0))
+    expired_delta = np.where(call, (S > K).astype(float), -(S < K).astype(float))
+    return {
+        'price': np.where(live, price, intrinsic),
+        'delta': np.where(live, delta, expired_delta),
+        'gamma': np.where(live, gamma, 0.0),
+        'vega': np.where(live, vega, 0.0),
+        'theta': np.where(live, theta, 0.0),
+    }
+
+
+def delta(flag, S, K, T, sigma, r=0.0):
+
+    '''
+    Delta of European options (cheaper than greeks() when only delta is needed)
+    :return: array of deltas, calls in [0, 1] and puts in [-1, 0]
+    '''
+
+    call = is_call(flag)
+    S, K, T, sigma = (np.asarray(x, dtype=float) for x in (S, K, T, sigma))
+    live = (T > 0) & (sigma > 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        d1, _ = _d1_d2(S, K, np.where(live, T, 1.0), np.where(live, sigma, 1.0), r)
+    nd1 = special.ndtr(d1)
+    expired = np.where(call, (S > K).astype(float), -(S < K).astype(float))
+    return np.where(live, np.where(call, nd1, nd1 - 1.0), expired)
+
+
+def implied_volatility(price, flag, S, K, T, r=0.0, iterations=40):
+
+    '''
+    Implied volatility by vectorized bisection, robust for deep OTM quotes
+    :param price: option prices
+    :return: array of implied volatilities, NaN where the price is outside no-arbitrage bounds
+    '''
+
+    price = np.asarray(price, dtype=float)
+    low = np.full(np.broadcast(price, S, K, T).shape, 1e-4)
+    high = np.full_like(low, 5.0)
+    for _ in range(iterations):
+        mid = 0.5 * (low + high)
+        too_high = black_scholes(flag, S, K, T, mid, r) > price
+        high = np.where(too_high, mid, high)
+        low = np.where(too_high, low, mid)
+    iv = 0.5 * (low + high)
+    valid = (price > black_scholes(flag, S, K, T, 1e-4, r)) & (price < black_scholes(flag, S, K, T, 5.0, r))
+    return np.where(valid, iv, np.nan)
@@ -0,0 +1,216 @@
+# Sampling profiler and loop-block detector for the live trading bots.
+#
+# Enabled with --profile on the strategy entry points. A daemon thread
+# samples the stack of the event loop thread every few milliseconds and
+# aggregates the samples in the "folded" format understood by flamegraph.pl,
+# speedscope and inferno ("frame;frame;frame count" per line). Samples taken
+# while one of the wrapped ib_insync callbacks runs are rooted under that
+# callback's name so the flame graph splits by event.
+#
+# A heartbeat scheduled on the asyncio loop lets the same thread spot any
+# callback that holds the loop for longer than the block threshold; the
+# offending stack is logged once per stall.
+
+import collections
+import functools
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+
+
+class Profiler:
+
+    '''
+    Sample the event loop thread and report callbacks that block it
+    :param interval: seconds between samples
+    :param dump_path: file the folded stacks are written to
+    :param dump_every: seconds between automatic dumps, 0 to only dump on signal/stop
+    :param block_threshold_ms: report the loop as blocked after this many milliseconds
+    :param logger: logger for block reports
+    '''
+
+    def __init__(self, interval=0.005, dump_path='pyoptiontrader_profile.folded', dump_every=300,
+                 block_threshold_ms=100, logger=None):
+        self.interval = interval
+        self.dump_path = dump_path
+        self.dump_every = dump_every
+        self.block_threshold = block_threshold_ms / 1000
+        self._logger = logger or logging.getLogger(__name__)
+        self.samples = collections.Counter()
+        self.blocks = []
+        self._thread_id = None
+        self._callback = None
+        self._heartbeat = None
+        self._reported_beat = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self, thread_id=None):
+
+        '''
+        Start sampling
+        :param thread_id: thread to sample, defaults to the calling thread (the one that will run the loop)
+        :return: None
+        '''
+
+        self._thread_id = thread_id if thread_id is not None else threading.get_ident()
+        self._stop.clear()
+        threading.Thread(target=self._run, name="profiler", daemon=True).start()
+        self.install_signal()
+        self._logger.info("Profiling enabled: sampling every %sms, dumping to %s",
+                          round(self.interval * 1000, 2), self.dump_path)
+
+    def stop(self):
+        self._stop.set()
+        self.dump()
+
+    def install_signal(self):
+
+        '''
+        Dump the profile on SIGUSR1 (SIGBREAK on Windows) without stopping the bot
+        :return: None
+        '''
+
+        sig = getattr(signal, 'SIGUSR1', None) or getattr(signal, 'SIGBREAK', None)
+        if sig is None or threading.current_thread() is not threading.main_thread():
+            return
+        signal.signal(sig, lambda signum, frame: self.dump())
+
+    def wrap(self, func, name=None):
+
+        '''
+        Wrap an event callback so samples and stalls are attributed to it
+        :param func: callback to wrap
+        :param name: name used as the root frame, defaults to the function name
+        :return: wrapped callback
+        '''
+
+        name = name or getattr(func, '__name__', repr(func))
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            outer = self._callback
+            self._callback = name
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._callback = outer
+        return wrapper
+
+    def watch_loop(self, loop):
+
+        '''
+        Schedule a heartbeat on the asyncio loop so stalls can be detected
+        :param loop: the event loop the bot runs on
+        :return: None
+        '''
+
+        period = max(self.block_threshold / 4, 0.001)
+
+        def beat():
+            self._heartbeat = time.perf_counter()
+            loop.call_later(period, beat)
+
+        self._heartbeat = time.perf_counter()
+        loop.call_soon_threadsafe(beat)
+
+    def dump(self, path=None):
+
+        '''
+        Write the samples collected so far in folded-stack format
+        :param path: destination, defaults to dump_path
+        :return: None
+        '''
+
+        path = path or self.dump_path
+        with self._lock:
+            lines = [f"{stack} {count}" for stack, count in self.samples.most_common()]
+        tmp = f"{path}.tmp"
+        with open(tmp, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp, path)
+        self._logger.info("Profile written to %s (%s samples)", path, sum(self.samples.values()))
+
+    def _run(self):
+        last_dump = time.perf_counter()
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is None:
+                continue
+            stack = _fold(frame)
+            if self._callback is not None:
+                stack = f"callback:{self._callback};{stack}"
+            with self._lock:
+                self.samples[stack] += 1
+
+            now = time.perf_counter()
+            self._check_block(now, frame)
+            if self.dump_every and now - last_dump >= self.dump_every:
+                last_dump = now
+                try:
+                    self.dump()
+                except OSError as e:
+                    self._logger.error("Could not write profile: %s", e)
+
+    def _check_block(self, now, frame):
+        beat = self._heartbeat
+        if beat is None or beat == self._reported_beat:
+            return
+        stalled = now - beat
+        if stalled >= self.block_threshold:
+            # report each stall once, when it first crosses the threshold
+            self._reported_beat = beat
+            stack = "".join(traceback.format_stack(frame))
+            self.blocks.append((time.time(), self._callback, stalled, stack))
+            self._logger.warning("Event loop blocked for %sms in %s:\n%s", round(stalled * 1000),
+                                 self._callback or "unknown callback", stack)
+
+
+def _fold(frame):
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ";".join(reversed(frames))
+
+
+def add_arguments(parser):
+
+    '''
+    Add the profiling options to a strategy's argument parser
+    :param parser: argparse.ArgumentParser
+    :return: None
+    '''
+
+    parser.add_argument('--profile', action='store_true',
+                        help='sample the event loop and report callbacks that block it')
+    parser.add_argument('--profile-out', default='pyoptiontrader_profile.folded',
+                        help='folded-stack output for flamegraph.pl/speedscope')
+    parser.add_argument('--profile-every', type=float, default=300,
+                        help='seconds between profile dumps (also dumped on SIGUSR1)')
+    parser.add_argument('--profile-interval-ms', type=float, default=5,
+                        help='milliseconds between stack samples')
+    parser.add_argument('--block-ms', type=float, default=100,
+                        help='report callbacks that block the loop for longer than this')
+
+
+def from_args(args, logger=None):
+
+    '''
+    Build and start a profiler from parsed arguments
+    :param args: namespace returned by parser.parse_args()
+    :param logger: logger for profiler reports
+    :return: a running Profiler, or None when --profile was not given
+    '''
+
+    if not args.profile:
+        return None
+    profiler = Profiler(interval=args.profile_interval_ms / 1000, dump_path=args.profile_out,
+                        dump_every=args.profile_every, block_threshold_ms=args.block_ms, logger=logger)
+    profiler.start()
+    return profiler
@@ -0,0 +1,380 @@
+# Risk guard between the strategies and ib.placeOrder.
+#
+# The bots' only circuit breaker was the reqGlobalCancel on the close path.
+# RiskGuard wraps the IB connection: everything is forwarded to ib except
+# placeOrder, which checks the order first, so the bots, the limit worker and
+# the delta hedger are all guarded by handing them the guard instead of ib.
+# Limits:
+#   * max_daily_loss: net liquidation below the first value seen that day by
+#     more than this halts trading for the rest of the day; with
+#     flatten_on_loss every open position is closed at the market and every
+#     working order cancelled. TWS pushes NetLiquidation only about every 3
+#     minutes, so with the greeks book the guard marks the account to market
+#     on every tick: the last NetLiquidation, plus the cash of the fills since
+#     it arrived, plus the change in value of the open positions since then
+#     (the book's model value of the option legs, the other positions at the
+#     underlying's last price). A NetLiquidation older than the account's
+#     max_age is re-read with accountSummary(),
+#   * max_contracts: an order that would take the option contracts held
+#     (summed over legs, working opening orders included) above this is
+#     blocked,
+#   * max_orders: messages allowed per rate_window seconds (new orders and
+#     amendments), shared with nothing else so a runaway loop trips it,
+#   * max_data_age: with no bar or quote for this many seconds new orders are
+#     blocked and the working orders that would open positions are cancelled,
+#     the exits (bracket children, closes) are left working.
+# Orders that only reduce positions pass the loss and stale data checks, so
+# a halted bot can still get out. A blocked order raises OrderBlocked, which
+# the callers' existing error handling logs.
+#
+# Positions are kept per conId from the fills, with the sum of their sizes
+# kept alongside, so a check touches only the legs of the order and a tick is
+# a few attribute reads and comparisons. The stale data check runs on an
+# asyncio timer as well, since a dead feed sends no ticks to check on.
+
+import asyncio
+import collections
+import datetime
+import logging
+import math
+
+from ib_insync import Contract, MarketOrder
+
+try:
+    from common import latency, working
+except ImportError:  # run as a script from models/common
+    import latency
+    import working
+
+# option security types counted against max_contracts
+OPTION_TYPES = ('OPT', 'FOP')
+
+
+class OrderBlocked(Exception):
+    pass
+
+
+class RiskGuard:
+
+    '''
+    Check every order against the risk limits before it reaches ib.placeOrder
+    :param ib: connected ib_insync.IB
+    :param account: account.AccountState to read the net liquidation from, needed for max_daily_loss
+    :param book: greeks.PortfolioGreeks of the open option legs, to mark the account between NetLiquidation updates
+    :param multiplier: contract multiplier of the option legs, for the cash of fills whose contract has none (combos)
+    :param max_daily_loss: dollars of net liquidation lost since the start of the day that halt trading
+    :param flatten_on_loss: close every position and cancel every order when max_daily_loss is hit
+    :param max_contracts: option contracts allowed open (and working to open) across all legs
+    :param max_orders: order messages allowed per rate_window
+    :param rate_window: seconds of the order rate window
+    :param max_data_age: seconds without a bar or quote after which the data is stale
+    :param clock: callable returning the current datetime
+    '''
+
+    def __init__(self, ib, account=None, max_daily_loss=None, flatten_on_loss=True, max_contracts=None,
+                 max_orders=30, rate_window=60.0, max_data_age=120.0, book=None, multiplier=100, clock=None):
+        self._logger = logging.getLogger(__name__)
+        self.ib = ib
+        self.account = account
+        self.book = book
+        self.multiplier = multiplier
+        self.max_daily_loss = max_daily_loss
+        self.flatten_on_loss = flatten_on_loss
+        self.max_contracts = max_contracts
+        self.max_data_age = max_data_age
+        self.clock = clock or datetime.datetime.now
+        self.rate = working.RateLimiter(max_messages=max_orders, window=rate_window, clock=self.clock)
+        self.positions = {}     # conId -> signed units held
+        self.contracts = {}     # conId -> contract to trade it with
+        self.options = set()    # conIds counted against max_contracts
+        self.open_contracts = 0
+        self.working = {}       # orderId -> (trade, option contracts it opens, whether it opens a position)
+        self.working_contracts = 0
+        self.day = None
+        self.day_start_value = math.nan
+        # the NetLiquidation the marks start from: its update time, the positions' value then, fill cash since
+        self.anchor_time = None
+        self.anchor_mark = math.nan
+        self.cash = 0.0
+        self.halted = False
+        self.stale = False
+        self.last_data = None
+        self.breaches = collections.deque(maxlen=1000)
+        self.subscribers = []
+        self._task = None
+
+    def __getattr__(self, name):
+        # everything but placeOrder goes straight to ib
+        return getattr(self.ib, name)
+
+    def subscribe(self, callback):
+
+        '''
+        Call callback(reason, action) on every breach, action being 'flatten', 'cancel' or 'block'
+        '''
+
+        self.subscribers.append(callback)
+
+    # Orders
+
+    @staticmethod
+    def _legs(contract, sign, quantity):
+        # (conId, signed units, contract) traded by quantity of contract, bought (sign 1) or sold (-1)
+        if contract.secType == 'BAG':
+            return [(leg.conId, sign * (1 if leg.action == 'BUY' else -1) * leg.ratio * quantity, None)
+                    for leg in contract.comboLegs]
+        return [(contract.conId, sign * quantity, contract)]
+
+    def _opening(self, contract, order):
+        # option contracts the order adds to the absolute size of the positions, 0 when it only reduces them
+        options = contract.secType == 'BAG' or contract.secType in OPTION_TYPES
+        change = contracts = 0
+        for conId, units, _ in self._legs(contract, 1 if order.action == 'BUY' else -1, order.totalQuantity):
+            held = self.positions.get(conId, 0)
+            change += abs(held + units) - abs(held)
+            if options or conId in self.options:
+                contracts += abs(held + units) - abs(held)
+        return max(contracts, 0), change > 0
+
+    def placeOrder(self, contract, order):
+
+        '''
+        ib.placeOrder behind the risk checks
+        :return: the Trade
+        :raises OrderBlocked: when a limit blocks the order
+        '''
+
+        now = self.clock()
+        amend = order.orderId in self.working
+        if amend:
+            _, contracts, opening = self.working[order.orderId]
+        elif order.parentId:
+            # bracket children close what their parent opens
+            contracts, opening = 0, False
+        else:
+            contracts, opening = self._opening(contract, order)
+        self._new_day(now)
+        self._check_data(now)
+        if opening and self.halted:
+            self._block(f"trading halted for the day after a loss of more than {self.max_daily_loss}")
+        if opening and self.stale:
+            self._block(f"market data is more than {self.max_data_age}s old")
+        if (not amend and contracts and self.max_contracts is not None
+                and self.open_contracts + self.working_contracts + contracts > self.max_contracts):
+            self._block(f"{contracts} more contracts would exceed the {self.max_contracts} contract limit "
+                        f"({self.open_contracts} open, {self.working_contracts} working)")
+        if not self.rate.allow():
+            self._block(f"order rate above {self.rate.max_messages} per {self.rate.window}s")
+        trade = self.ib.placeOrder(contract, order)
+        if not amend and not trade.isDone():
+            self.working[order.orderId] = (trade, contracts, opening)
+            self.working_contracts += contracts
+        return trade
+
+    def _block(self, reason):
+        self._logger.warning("Order blocked: %s", reason)
+        self._breach(reason, 'block')
+        raise OrderBlocked(reason)
+
+    def _breach(self, reason, action):
+        self.breaches.append({'time': self.clock(), 'reason': reason, 'action': action})
+        for callback in self.subscribers:
+            try:
+                callback(reason, action)
+            except Exception as e:
+                self._logger.error("Risk subscriber failed: %s", e)
+
+    def _done(self, trade):
+        entry = self.working.pop(trade.order.orderId, None)
+        if entry is not None:
+            self.working_contracts -= entry[1]
+
+    def on_status(self, trade, *args):
+
+        '''
+        orderStatusEvent handler: forget orders once they are done
+        '''
+
+        if trade.isDone():
+            self._done(trade)
+
+    def on_fill(self, trade, fill):
+
+        '''
+        execDetailsEvent handler: keep the positions and the open contract count
+        '''
+
+        # a combo also reports an execution per leg, the combo level fill covers them
+        if trade.contract.secType == 'BAG' and fill.contract.secType != 'BAG':
+            return
+        order = trade.order
+        sign = 1 if fill.execution.side == 'BOT' else -1
+        parts = self._legs(fill.contract, sign, fill.execution.shares)
+        options = fill.contract.secType == 'BAG' or fill.contract.secType in OPTION_TYPES
+        multiplier = float(fill.contract.multiplier or (self.multiplier if options else 1))
+        self.cash -= sign * fill.execution.price * fill.execution.shares * multiplier
+        for conId, units, contract in parts:
+            held = self.positions.get(conId, 0)
+            after = held + units
+            if options:
+                self.options.add(conId)
+            # the flatten orders trade option legs by conId alone, the leg is still an option
+            if conId in self.options:
+                self.open_contracts += abs(after) - abs(held)
+            if after:
+                self.positions[conId] = after
+            else:
+                self.positions.pop(conId, None)
+            if conId not in self.contracts:
+                self.contracts[conId] = contract or Contract(conId=conId, exchange=fill.contract.exchange or 'SMART')
+        if trade.isDone():
+            self._done(trade)
+        elif order.orderId in self.working:
+            # a partial fill moves contracts from working to open
+            entry = self.working[order.orderId]
+            moved = min(entry[1], sum(abs(units) for conId, units, _ in parts if conId in self.options))
+            self.working[order.orderId] = (entry[0], entry[1] - moved, entry[2])
+            self.working_contracts -= moved
+
+    # Ticks
+
+    def on_tick(self, *args):
+
+        '''
+        Bar / quote handler: note the data is alive and check the daily loss
+        '''
+
+        now = self.clock()
+        self.last_data = now
+        if self.stale:
+            self.stale = False
+            self._logger.info("Market data is back")
+        self._new_day(now)
+        self.check_loss()
+        self._ensure_task()
+
+    def _new_day(self, now):
+        if now.date() == self.day:
+            return
+        self.day = now.date()
+        self.day_start_value = self._net_liquidation()
+        if self.halted:
+            self._logger.info("New trading day, trading resumed")
+        self.halted = False
+
+    def _net_liquidation(self):
+        if self.account is None:
+            return math.nan
+        # re-read when the stream has gone quiet for longer than the account's max_age
+        value = self.account.get('net_liquidation')
+        if self.book is None or math.isnan(value):
+            return value
+        updated = self.account.updated.get('net_liquidation')
+        if updated != self.anchor_time:
+            # a new NetLiquidation already has the fills and marks up to now in it
+            self.anchor_time = updated
+            self.anchor_mark = self._mark()
+            self.cash = 0.0
+            return value
+        mark = self._mark()
+        if math.isnan(mark) or math.isnan(self.anchor_mark):
+            return value
+        return value + self.cash + mark - self.anchor_mark
+
+    def _mark(self):
+        # value of the open positions: the option legs from the book, the rest at their underlying's last price
+        value = self.book.total['value'] if self.book.count else 0.0
+        for conId, units in self.positions.items():
+            if conId in self.options:
+                continue
+            contract = self.contracts[conId]
+            code = self.book.underlyings.get(contract.symbol)
+            price = self.book.spot[code] if code is not None else math.nan
+            value += units * float(contract.multiplier or 1) * price
+        return value
+
+    def check_loss(self):
+
+        '''
+        Halt (and flatten) when the day's loss exceeds max_daily_loss
+        :return: True when trading is halted
+        '''
+
+        if self.halted or self.max_daily_loss is None:
+            return self.halted
+        value = self._net_liquidation()
+        if math.isnan(self.day_start_value):
+            # the account values arrived after the first tick of the day
+            self.day_start_value = value
+            return False
+        loss = self.day_start_value - value
+        if loss > self.max_daily_loss:
+            self.halted = True
+            reason = f"daily loss {round(loss, 2)} exceeds {self.max_daily_loss}"
+            self._logger.critical("Risk limit breached: %s", reason)
+            if self.flatten_on_loss:
+                self.flatten()
+                self._breach(reason, 'flatten')
+            else:
+                self.cancel_opening()
+                self._breach(reason, 'cancel')
+        return self.halted
+
+    def _check_data(self, now):
+        if self.stale or self.last_data is None or self.max_data_age is None:
+            return
+        if (now - self.last_data).total_seconds() > self.max_data_age:
+            self.stale = True
+            reason = f"no market data for {round((now - self.last_data).total_seconds())}s"
+            self._logger.error("Risk limit breached: %s", reason)
+            self.cancel_opening()
+            self._breach(reason, 'cancel')
+
+    def _ensure_task(self):
+        if self._task is not None and not self._task.done():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # no event loop (a replay): the data is checked on every order
+            return
+        self._task = loop.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.max_data_age / 4 if self.max_data_age else 30)
+            self._check_data(self.clock())
+
+    # Breach actions
+
+    def cancel_opening(self):
+
+        '''
+        Cancel the working orders that would open positions, leaving the exits working
+        :return: number of orders cancelled
+        '''
+
+        cancelled = 0
+        for trade, _, opening in list(self.working.values()):
+            if opening and not trade.isDone():
+                self.ib.cancelOrder(trade.order)
+                cancelled += 1
+        return cancelled
+
+    def flatten(self):
+
+        '''
+        Cancel every working order and close every position at the market, bypassing the checks
+        :return: the closing Trades
+        '''
+
+        for trade, _, _ in list(self.working.values()):
+            if not trade.isDone():
+                self.ib.cancelOrder(trade.order)
+        trades = []
+        for conId, units in list(self.positions.items()):
+            order = MarketOrder('SELL' if units > 0 else 'BUY', abs(units), orderRef='flatten')
+            with latency.span('placeOrder'):
+                trades.append(self.ib.placeOrder(self.contracts[conId], order))
+        self._logger.warning("Flattened %s positions", len(trades))
+        return trades
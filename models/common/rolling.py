@@ -0,0 +1,313 @@
+# Roll management for an open short strangle.
+#
+# The README lists the usual ways of defending a strangle instead of closing
+# it: roll the untested side in once it has decayed 50-80% or a strike is
+# breached, roll it all the way into a straddle, go inverted (the untested
+# strike past the tested one, as long as the credit taken in so far covers the
+# inversion width) and roll the whole position out in time, recentered.
+# RollEngine turns these into rules checked on every management tick.
+#
+# Every legal roll is evaluated at once from the cached chain (the bots'
+# reqSecDefOptParams expirations and strikes): calls and puts of every strike
+# and expiration considered are priced a single time on a small grid of
+# underlying moves, each candidate then only gathers the values and deltas of
+# its legs from that grid. A candidate is scored by the time value the roll
+# takes in (its credit less the intrinsic value it sells, so a deep in the
+# money leg does not look like free premium), the delta of the resulting
+# position and its worst loss over the moves:
+#     score = extrinsic credit - delta_weight * |delta| * 1% of spot - risk_weight * risk
+# all in dollars, and the best scoring roll taking in more than the minimum credit
+# is returned for the bot to send as one combo.
+
+import datetime
+
+import numpy as np
+
+try:
+    from common import greeks, pricing
+except ImportError:  # run as a script from models/common
+    import greeks
+    import pricing
+
+ROLL_TYPES = ('untested', 'straddle', 'inverted', 'out')
+# underlying moves the risk of a candidate is measured over
+RISK_MOVES = np.round(np.arange(-0.05, 0.05 + 1e-9, 0.01), 4)
+
+
+def _date(expiry):
+    if isinstance(expiry, str):
+        return datetime.datetime.strptime(expiry[:8], '%Y%m%d').date()
+    return expiry.date() if isinstance(expiry, datetime.datetime) else expiry
+
+
+class StranglePosition:
+
+    '''
+    Open short strangle tracked by the roll engine
+    :param call_strike: short call strike
+    :param put_strike: short put strike
+    :param expiry: expiration date of both legs
+    :param call_entry: premium the call was sold for
+    :param put_entry: premium the put was sold for
+    :param credit: credit taken in so far per share, entry plus every roll
+    :param quantity: strangles held
+    '''
+
+    __slots__ = ('call_strike', 'put_strike', 'expiry', 'call_entry', 'put_entry', 'credit', 'quantity', 'rolls',
+                 'rolled_at')
+
+    def __init__(self, call_strike, put_strike, expiry, call_entry, put_entry, credit=None, quantity=1):
+        self.call_strike = float(call_strike)
+        self.put_strike = float(put_strike)
+        self.expiry = _date(expiry)
+        self.call_entry = float(call_entry)
+        self.put_entry = float(put_entry)
+        self.credit = self.call_entry + self.put_entry if credit is None else float(credit)
+        self.quantity = quantity
+        self.rolls = 0
+        self.rolled_at = None
+
+
+class RollEngine:
+
+    '''
+    Find the best roll of a short strangle across the cached chain
+    :param decay: share of its entry premium the untested side must have lost before it is rolled
+    :param roll_out_dte: days to expiration at which the position is rolled out in time
+    :param max_dte: furthest expiration a roll out may go to
+    :param max_width: strikes further than this fraction of spot from it are not considered
+    :param max_leg_delta: largest |delta| of a rolled untested leg and of the new legs of a roll out
+    :param min_credit: credit per share a roll must take in more than (0 rolls only for a credit)
+    :param max_rolls: rolls allowed per position
+    :param cooldown: seconds after a roll fills before the rules are checked again
+    :param delta_weight: dollars of score lost per dollar of exposure to a 1% move
+    :param risk_weight: dollars of score lost per dollar of worst loss over the moves
+    :param moves: relative underlying moves the risk is measured over
+    :param kinds: roll types considered, from ROLL_TYPES
+    :param multiplier: contract multiplier
+    '''
+
+    def __init__(self, decay=0.5, roll_out_dte=21, max_dte=60, max_width=0.15, max_leg_delta=0.30, min_credit=0.0,
+                 max_rolls=3, cooldown=24 * 60 * 60, delta_weight=1.0, risk_weight=0.1, moves=RISK_MOVES,
+                 kinds=ROLL_TYPES, multiplier=100):
+        self.decay = decay
+        self.roll_out_dte = roll_out_dte
+        self.max_dte = max_dte
+        self.max_width = max_width
+        self.max_leg_delta = max_leg_delta
+        self.min_credit = min_credit
+        self.max_rolls = max_rolls
+        self.cooldown = cooldown
+        self.delta_weight = delta_weight
+        self.risk_weight = risk_weight
+        self.moves = np.asarray(moves, dtype=float)
+        self.kinds = tuple(kinds)
+        self.multiplier = multiplier
+        self.position = None
+
+    def open(self, call_strike, put_strike, expiry, credit, S, iv, now=None, quantity=1):
+
+        '''
+        Start tracking a newly filled strangle, splitting its credit between the legs by their model values
+        :param credit: premium received for the strangle per share
+        :param S: underlying price at the fill
+        :param iv: implied volatility of the expiration
+        '''
+
+        T = self._years(_date(expiry), now)
+        values = pricing.black_scholes([1, -1], S, [call_strike, put_strike], T, iv)
+        share = values / values.sum() if values.sum() > 0 else np.array([0.5, 0.5])
+        self.position = StranglePosition(call_strike, put_strike, expiry, credit * share[0], credit * share[1],
+                                         credit, quantity)
+        return self.position
+
+    def close(self):
+        self.position = None
+
+    def _years(self, expiry, now):
+        now = (now or datetime.datetime.now()).timestamp()
+        return np.maximum((greeks.expiry_timestamp(expiry) - now) / greeks.SECONDS_PER_YEAR, 0.0)
+
+    def triggers(self, S, iv, now=None):
+
+        '''
+        Roll types whose rules fire for the tracked position
+        :return: (tuple of roll types, tested side 'C'/'P')
+        '''
+
+        p = self.position
+        now = now or datetime.datetime.now()
+        if p is None or p.rolls >= self.max_rolls:
+            return (), None
+        # the rolled position is left to settle instead of being rolled again on the next tick
+        if p.rolled_at is not None and (now - p.rolled_at).total_seconds() < self.cooldown:
+            return (), None
+        T = self._years(p.expiry, now)
+        call, put = pricing.black_scholes([1, -1], S, [p.call_strike, p.put_strike], T, iv)
+        tested = 'C' if p.call_strike - S < S - p.put_strike else 'P'
+        breached = S >= p.call_strike or S <= p.put_strike
+        untested_value, untested_entry = (put, p.put_entry) if tested == 'C' else (call, p.call_entry)
+        decayed = untested_entry > 0 and untested_value <= (1.0 - self.decay) * untested_entry
+        fired = []
+        if decayed or breached:
+            fired.append('untested')
+        if breached:
+            fired += ['straddle', 'inverted']
+        if (p.expiry - now.date()).days <= self.roll_out_dte:
+            fired.append('out')
+        return tuple(k for k in fired if k in self.kinds), tested
+
+    def candidates(self, strikes, expirations, S, iv, now=None, kinds=ROLL_TYPES, tested=None):
+
+        '''
+        Every legal roll of the tracked position, priced and scored in one pass
+        :param strikes: strikes listed in the chain
+        :param expirations: expirations listed in the chain ('YYYYMMDD' or dates)
+        :param S: underlying price
+        :param iv: implied volatility the legs are priced at
+        :param kinds: roll types to generate
+        :param tested: tested side, 'C' or 'P', worked out from the strikes when None
+        :return: dict of arrays, one entry per candidate: kind, expiry, call_strike, put_strike, roll_call,
+            roll_put, call_value and put_value (the legs after the roll, per share), credit (per share),
+            extrinsic (the credit less the intrinsic value sold, per share), delta (shares), risk and score
+            (dollars)
+        '''
+
+        p = self.position
+        now = now or datetime.datetime.now()
+        today = now.date()
+        if tested is None:
+            tested = 'C' if p.call_strike - S < S - p.put_strike else 'P'
+        strikes = np.unique(np.asarray(strikes, dtype=float))
+        strikes = strikes[np.abs(strikes / S - 1.0) <= self.max_width]
+        later = sorted({_date(e) for e in expirations if p.expiry < _date(e) and (_date(e) - today).days <= self.max_dte})
+        expiries = [p.expiry] + (later if 'out' in kinds else [])
+
+        # calls and puts of every (expiration, strike) on the moves grid, column 0 is the current spot
+        spots = S * (1.0 + np.concatenate([[0.0], self.moves]))
+        T = np.array([self._years(e, now) for e in expiries])
+        leg = pricing.greeks(True, S, strikes[None, :], T[:, None], iv)
+        call_grid = pricing.black_scholes(True, spots[None, None, :], strikes[None, :, None], T[:, None, None], iv)
+        put_grid = call_grid - spots[None, None, :] + strikes[None, :, None]
+        call_delta, put_delta = leg['delta'], leg['delta'] - 1.0
+
+        # the position as it is, for the legs a roll keeps
+        T0 = self._years(p.expiry, now)
+        old = pricing.greeks([True, False], S, [p.call_strike, p.put_strike], T0, iv)
+        old_call = pricing.black_scholes(True, spots, p.call_strike, T0, iv)
+        old_put = pricing.black_scholes(False, spots, p.put_strike, T0, iv)
+
+        # candidates as (kind, expiry index, call strike index, put strike index, roll call, roll put)
+        n = strikes.size
+        idx = np.arange(n)
+        rows = []
+        untested_call = tested == 'P'
+        tested_strike = p.put_strike if untested_call else p.call_strike
+        untested_strike = p.call_strike if untested_call else p.put_strike
+        direction = 1.0 if untested_call else -1.0
+        # signed distance past the tested strike towards the untested one
+        past = direction * (strikes - tested_strike)
+        # a plain untested roll stays out of the money and below max_leg_delta, going further is a straddle or
+        # an inversion, which only the breach rule allows
+        untested_delta = call_delta[0] if untested_call else -put_delta[0]
+        keep = {
+            'untested': ((past > 0) & (direction * (strikes - untested_strike) < 0) & (direction * (strikes - S) > 0) &
+                         (untested_delta <= self.max_leg_delta)),
+            'straddle': past == 0,
+            'inverted': past < 0,
+        }
+        for code, kind in enumerate(ROLL_TYPES[:3]):
+            if kind not in kinds:
+                continue
+            k = idx[keep[kind]]
+            zeros = np.zeros(k.size, dtype=int)
+            if untested_call:
+                rows.append(np.column_stack([zeros + code, zeros, k, zeros, zeros + 1, zeros]))
+            else:
+                rows.append(np.column_stack([zeros + code, zeros, zeros, k, zeros, zeros + 1]))
+        if 'out' in kinds and len(expiries) > 1:
+            e, c, q = np.meshgrid(np.arange(1, len(expiries)), idx[strikes >= S], idx[strikes <= S], indexing='ij')
+            e, c, q = e.ravel(), c.ravel(), q.ravel()
+            keep = (call_delta[e, c] <= self.max_leg_delta) & (-put_delta[e, q] <= self.max_leg_delta)
+            ones = np.ones(keep.sum(), dtype=int)
+            rows.append(np.column_stack([ones * 3, e[keep], c[keep], q[keep], ones, ones]))
+        rows = np.concatenate(rows) if rows else np.zeros((0, 6), dtype=int)
+        kind, e, c, q = rows[:, 0], rows[:, 1], rows[:, 2], rows[:, 3]
+        roll_call, roll_put = rows[:, 4].astype(bool), rows[:, 5].astype(bool)
+
+        call_value = np.where(roll_call[:, None], call_grid[e, c], old_call[None, :])
+        put_value = np.where(roll_put[:, None], put_grid[e, q], old_put[None, :])
+        credit = (call_value[:, 0] - old_call[0]) * roll_call + (put_value[:, 0] - old_put[0]) * roll_put
+        call_strike = np.where(roll_call, strikes[c], p.call_strike)
+        put_strike = np.where(roll_put, strikes[q], p.put_strike)
+        intrinsic = np.maximum(S - call_strike, 0.0) + np.maximum(put_strike - S, 0.0)
+        extrinsic = credit - intrinsic + max(S - p.call_strike, 0.0) + max(p.put_strike - S, 0.0)
+        size = self.multiplier * p.quantity
+        delta = -size * (np.where(roll_call, call_delta[e, c], old['delta'][0]) +
+                         np.where(roll_put, put_delta[e, q], old['delta'][1]))
+        value = call_value + put_value
+        risk = np.maximum((value[:, 1:] - value[:, :1]).max(axis=1, initial=0.0), 0.0) * size
+
+        # a roll has to take in more than the minimum and move the legs it rolls: buying and selling the same
+        # contract is no roll at all
+        legal = credit > self.min_credit
+        legal &= ~(roll_call & (e == 0) & (call_strike == p.call_strike))
+        legal &= ~(roll_put & (e == 0) & (put_strike == p.put_strike))
+        # an inverted position must have taken in more than the width it can lose at expiration
+        inverted = call_strike < put_strike
+        legal &= ~inverted | (p.credit + credit > put_strike - call_strike)
+        score = extrinsic * size - self.delta_weight * np.abs(delta) * 0.01 * S - self.risk_weight * risk
+        return {
+            'kind': np.array(ROLL_TYPES)[kind][legal],
+            'expiry': np.array(expiries, dtype=object)[e][legal],
+            'call_strike': call_strike[legal],
+            'put_strike': put_strike[legal],
+            'roll_call': roll_call[legal],
+            'roll_put': roll_put[legal],
+            'call_value': call_value[legal, 0],
+            'put_value': put_value[legal, 0],
+            'credit': credit[legal],
+            'extrinsic': extrinsic[legal],
+            'delta': delta[legal],
+            'risk': risk[legal],
+            'score': score[legal],
+        }
+
+    def check(self, strikes, expirations, S, iv, now=None):
+
+        '''
+        Management tick: the best roll if any rule fires and a legal candidate exists
+        :return: dict of the chosen candidate's fields (see candidates()), or None
+        '''
+
+        kinds, tested = self.triggers(S, iv, now)
+        if not kinds:
+            return None
+        found = self.candidates(strikes, expirations, S, iv, now, kinds, tested)
+        if not found['score'].size:
+            return None
+        best = int(np.argmax(found['score']))
+        return {name: values[best].item() if hasattr(values[best], 'item') else values[best]
+                for name, values in found.items()}
+
+    def rolled(self, roll, credit, now=None):
+
+        '''
+        Apply a filled roll to the tracked position
+        :param roll: candidate returned by check()
+        :param credit: credit per share the roll filled for
+        :param now: time of the fill, the cooldown runs from it
+        '''
+
+        p = self.position
+        # slippage against the model goes to the new legs in proportion to their value
+        sold = roll['call_value'] * roll['roll_call'] + roll['put_value'] * roll['roll_put']
+        fill = (credit - roll['credit']) / sold if sold > 0 else 0.0
+        if roll['roll_call']:
+            p.call_strike, p.call_entry = roll['call_strike'], roll['call_value'] * (1.0 + fill)
+        if roll['roll_put']:
+            p.put_strike, p.put_entry = roll['put_strike'], roll['put_value'] * (1.0 + fill)
+        p.expiry = roll['expiry']
+        p.credit += credit
+        p.rolls += 1
+        p.rolled_at = now or datetime.datetime.now()
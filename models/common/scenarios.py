@@ -0,0 +1,128 @@
+# Spot x vol scenario risk of the open book.
+#
+# Every open leg in greeks.book is repriced on a grid of underlying moves
+# (-10% to +10% in 0.5% steps by default) crossed with IV shocks (-10 to +10
+# vol points), as one broadcasted Black-Scholes call over a
+# (legs, spot moves, vol shocks) array. The P&L against the current model
+# value is summed per position (the legs of one strangle) and for the whole
+# book, so a stop can look at the loss of a 2-3 sigma move with a vol spike
+# instead of only at the combo mark. Every underlying is moved by the same
+# percentage, i.e. the scenarios assume perfectly correlated underlyings.
+
+import datetime
+
+import numpy as np
+
+try:
+    from common import greeks, startup
+except ImportError:  # run as a script from models/common
+    import greeks
+    import startup
+
+# scipy takes a while to import and is only needed once the book is repriced
+special = startup.lazy_import('scipy.special')
+
+SPOT_MOVES = np.round(np.arange(-0.10, 0.10 + 1e-9, 0.005), 4)
+VOL_SHOCKS = np.round(np.arange(-0.10, 0.10 + 1e-9, 0.01), 4)
+# an IV shock never takes a leg below this
+MIN_IV = 0.01
+
+
+class ScenarioResult:
+
+    '''
+    P&L of the book on a spot x vol grid
+    :param pnl: (positions, spot moves, vol shocks) P&L in dollars
+    :param positions: position labels, one per row of pnl
+    :param spot_moves: relative underlying moves (0.05 = +5%)
+    :param vol_shocks: absolute IV shocks (0.05 = +5 vol points)
+    '''
+
+    def __init__(self, pnl, positions, spot_moves, vol_shocks):
+        self.pnl = pnl
+        self.positions = positions
+        self.spot_moves = spot_moves
+        self.vol_shocks = vol_shocks
+        self.book = pnl.sum(axis=0)
+
+    def worst(self, max_move=None):
+
+        '''
+        Worst book P&L on the grid
+        :param max_move: only consider underlying moves up to this size (0.05 = 5%), None for the whole grid
+        :return: (P&L, spot move, vol shock)
+        '''
+
+        book = self.book
+        moves = self.spot_moves
+        if max_move is not None:
+            keep = np.abs(moves) <= max_move + 1e-12
+            book, moves = book[keep], moves[keep]
+        if book.size == 0 or not self.positions:
+            return 0.0, 0.0, 0.0
+        i, j = np.unravel_index(np.argmin(book), book.shape)
+        return float(book[i, j]), float(moves[i]), float(self.vol_shocks[j])
+
+    def position_worst(self):
+
+        '''
+        Worst P&L of each position on the grid
+        :return: dict of position label -> P&L
+        '''
+
+        return {label: float(pnl.min()) for label, pnl in zip(self.positions, self.pnl)}
+
+    def frame(self, position=None):
+
+        '''
+        P&L matrix as a DataFrame, spot moves down the index and vol shocks across the columns
+        :param position: position label, None for the book
+        '''
+
+        import pandas as pd
+        pnl = self.book if position is None else self.pnl[self.positions.index(position)]
+        return pd.DataFrame(pnl, index=self.spot_moves, columns=self.vol_shocks)
+
+
+def _value(call, S, K, T, iv):
+    # Black-Scholes (zero rate, as pricing.py) of the grid: price the call and get the put by
+    # parity, half the work of pricing.black_scholes with its per-right branches
+    vol_t = iv * np.sqrt(np.maximum(T, 1e-10))
+    d1 = (np.log(S / K) + 0.5 * vol_t * vol_t) / vol_t
+    return S * special.ndtr(d1) - K * special.ndtr(d1 - vol_t) + np.where(call, 0.0, K - S)
+
+
+def scenario_grid(book=None, now=None, spot_moves=SPOT_MOVES, vol_shocks=VOL_SHOCKS):
+
+    '''
+    Reprice every open leg on the spot x vol grid
+    :param book: greeks.PortfolioGreeks, defaults to the shared greeks.book
+    :param now: datetime to measure the time to expiration from, defaults to the wall clock
+    :param spot_moves: relative underlying moves
+    :param vol_shocks: absolute IV shocks
+    :return: ScenarioResult
+    '''
+
+    book = greeks.book if book is None else book
+    now = (now or datetime.datetime.now()).timestamp()
+    legs = book.snapshot()
+    spot_moves = np.asarray(spot_moves, dtype=float)
+    vol_shocks = np.asarray(vol_shocks, dtype=float)
+
+    T = np.maximum((legs['expiry'] - now) / greeks.SECONDS_PER_YEAR, 0.0)
+    size = legs['quantity'] * legs['multiplier']
+    base = _value(legs['call'], legs['spot'], legs['strike'], T, legs['iv'])
+
+    # (legs, 1, 1) against (1, spot moves, 1) and (1, 1, vol shocks)
+    column = (slice(None), None, None)
+    S = legs['spot'][column] * (1.0 + spot_moves[None, :, None])
+    iv = np.maximum(legs['iv'][column] + vol_shocks[None, None, :], MIN_IV)
+    value = _value(legs['call'][column], S, legs['strike'][column], T[column], iv)
+    leg_pnl = np.nan_to_num((value - base[column]) * size[column]).reshape(T.size, spot_moves.size * vol_shocks.size)
+
+    # sum the legs of each position with one (positions x legs) product
+    held, rows = np.unique(legs['position'], return_inverse=True)
+    owner = np.zeros((held.size, T.size))
+    owner[rows, np.arange(T.size)] = 1.0
+    pnl = (owner @ leg_pnl).reshape(held.size, spot_moves.size, vol_shocks.size)
+    return ScenarioResult(pnl, [legs['positions'][i] for i in held], spot_moves, vol_shocks)
@@ -0,0 +1,56 @@
+# Position sizing rules shared by the live bots and the backtests.
+#
+# The IV ladder used to live inline in place_order(): the share of available
+# funds committed to a strangle grows with the implied volatility of the
+# chain (25% between 10 and 15 IV up to 50% above 40 IV), divided by the
+# margin of one strangle. Here it is a pure function over NumPy arrays, so a
+# backtest sizes thousands of entries in one call and the live bot sizes one
+# entry with the same code and no broker round trip beyond its margin input.
+
+import numpy as np
+
+# (lowest IV of the band, fraction of available funds), ordered by IV
+IV_LADDER = (
+    (0.10, 0.25),
+    (0.15, 0.30),
+    (0.20, 0.35),
+    (0.30, 0.40),
+    (0.40, 0.50),
+)
+
+
+def iv_fraction(iv, ladder=IV_LADDER):
+
+    '''
+    Fraction of available funds the ladder allocates at each IV
+    :param iv: implied volatilities (fractions, e.g. 0.18)
+    :param ladder: (lowest IV, fraction) bands ordered by IV
+    :return: float array, NaN below the lowest band (and for a NaN IV)
+    '''
+
+    bounds = np.array([band[0] for band in ladder])
+    fractions = np.array([band[1] for band in ladder])
+    iv = np.asarray(iv, dtype=float)
+    band = np.searchsorted(bounds, iv, side='right') - 1
+    return np.where((band >= 0) & ~np.isnan(iv), fractions[np.maximum(band, 0)], np.nan)
+
+
+def iv_bucket_size(iv, account_value, margin, ladder=IV_LADDER, default=0):
+
+    '''
+    Contracts to trade under the IV ladder: floor(account value x band fraction / margin per contract)
+    :param iv: implied volatilities
+    :param account_value: available funds at each entry
+    :param margin: initial margin of one contract (strangle) at each entry
+    :param ladder: (lowest IV, fraction) bands ordered by IV
+    :param default: contracts when IV is below the lowest band (the live bot keeps its fixed quantity)
+    :return: int array of contracts, broadcast over the inputs (0 inside a band when the margin is unknown or not
+        positive)
+    '''
+
+    fraction = iv_fraction(iv, ladder)
+    margin = np.asarray(margin, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        contracts = np.floor(np.asarray(account_value, dtype=float) * fraction / margin)
+    contracts = np.maximum(np.nan_to_num(np.where(margin > 0, contracts, 0), nan=0.0, posinf=0.0), 0)
+    return np.where(np.isnan(fraction), default, contracts).astype(np.int64)
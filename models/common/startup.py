@@ -0,0 +1,149 @@
+# Cold start helpers for the live trading bots.
+#
+# pandas, py_vollib_vectorized and apscheduler together take well over a
+# second to import, and py_vollib_vectorized JIT-compiles its numba kernels
+# the first time they are called, which used to happen inside the first
+# get_strike() call while an order was being built. The bots now:
+#   * import those modules lazily (lazy_import),
+#   * import and warm the pricing kernels on a background thread at boot,
+#     overlapping the TWS connection (warm_pricing_kernels),
+#   * keep numba's compiled kernels in a persistent cache directory so later
+#     boots load machine code instead of compiling (enable_jit_cache),
+#   * report time-to-connected and time-to-first-decision (StartupTimer).
+
+import importlib
+import logging
+import os
+import threading
+import time
+
+# Set as early as possible so every timing is relative to process start
+_BOOT = time.perf_counter()
+
+# Where numba keeps compiled kernels between runs. The default (__pycache__
+# next to the library) is not writable inside an auto-py-to-exe bundle.
+DEFAULT_JIT_CACHE = os.path.join(os.path.expanduser("~"), ".pyoptiontrader", "numba_cache")
+
+
+class _LazyModule:
+
+    '''
+    Stand-in for a module that is only imported on first attribute access
+    '''
+
+    def __init__(self, name):
+        self.__dict__["_name"] = name
+        self.__dict__["_module"] = None
+
+    def _load(self):
+        module = self.__dict__["_module"]
+        if module is None:
+            module = importlib.import_module(self.__dict__["_name"])
+            self.__dict__["_module"] = module
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        state = "loaded" if self.__dict__["_module"] is not None else "not loaded"
+        return f"<lazy module '{self.__dict__['_name']}' ({state})>"
+
+
+def lazy_import(name):
+
+    '''
+    Defer importing a heavy module until it is first used
+    :param name: dotted module name
+    :return: proxy that behaves like the module once touched
+    '''
+
+    return _LazyModule(name)
+
+
+def enable_jit_cache(path=DEFAULT_JIT_CACHE):
+
+    '''
+    Point numba's on-disk cache at a persistent, writable directory.
+    Must run before numba is imported to take effect.
+    :param path: cache directory
+    :return: the cache directory in use
+    '''
+
+    os.makedirs(path, exist_ok=True)
+    return os.environ.setdefault("NUMBA_CACHE_DIR", path)
+
+
+class StartupTimer:
+
+    '''
+    Record how long the bot takes to reach each startup milestone
+    '''
+
+    def __init__(self, logger=None):
+        self._logger = logger or logging.getLogger(__name__)
+        self.marks = {}
+
+    def mark(self, name):
+
+        '''
+        Record a milestone the first time it is reached
+        :param name: milestone name (e.g. 'connected', 'first_decision')
+        :return: seconds since process start
+        '''
+
+        if name not in self.marks:
+            self.marks[name] = time.perf_counter() - _BOOT
+            self._logger.info("Time to %s: %ss", name.replace('_', ' '), round(self.marks[name], 3))
+        return self.marks[name]
+
+
+class _Warmup:
+
+    '''
+    Background import and JIT warm-up of the pricing kernels
+    '''
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.seconds = None
+        self.error = None
+
+    def wait(self, timeout=None):
+        return self.done.wait(timeout)
+
+
+def warm_pricing_kernels(logger=None):
+
+    '''
+    Import pandas and py_vollib_vectorized and run the exact pricing calls the bots make
+    (price_dataframe greeks and the Black IV solver) once on dummy inputs, on a daemon thread.
+    :param logger: logger for the warm-up report
+    :return: handle whose wait() blocks until the kernels are ready
+    '''
+
+    logger = logger or logging.getLogger(__name__)
+    warmup = _Warmup()
+
+    def run():
+        start = time.perf_counter()
+        try:
+            pd = importlib.import_module("pandas")
+            vollib = importlib.import_module("py_vollib_vectorized")
+            for flag in ('c', 'p'):
+                option = pd.DataFrame({'Flag': [flag], 'S': [100.0], 'K': [100.0], 'T': [45 / 365], 'R': [0.0],
+                                       'IV': [0.2]})
+                vollib.price_dataframe(option, flag_col='Flag', underlying_price_col='S', strike_col='K',
+                                       annualized_tte_col='T', riskfree_rate_col='R', sigma_col='IV',
+                                       model='black_scholes', inplace=False)
+            vollib.vectorized_implied_volatility_black(3.0, 100.0, 100.0, 0.0, 45 / 365, 'c', return_as='numpy')
+            warmup.seconds = time.perf_counter() - start
+            logger.info("Pricing kernels warmed in %ss", round(warmup.seconds, 3))
+        except Exception as e:
+            warmup.error = e
+            logger.error("Could not warm pricing kernels: %s", e)
+        finally:
+            warmup.done.set()
+
+    threading.Thread(target=run, name="pricing-warmup", daemon=True).start()
+    return warmup
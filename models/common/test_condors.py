@@ -0,0 +1,73 @@
+# select_iron_condor against a brute force over every (short call, long call,
+# short put, long put) of small randomized chains, with and without a
+# minimum credit, a widest spread and fixed wings. Run with pytest.
+
+import numpy as np
+import pytest
+
+try:
+    from common import condors
+except ImportError:  # run from models/common
+    import condors
+
+TARGETS = {'short_call_delta': 0.10, 'long_call_delta': 0.02, 'short_put_delta': -0.10, 'long_put_delta': -0.02}
+
+
+def random_chain(rng):
+    # 8 to 20 listed strikes around the underlying, with gaps and a skewed smile
+    S = 100.0
+    grid = np.arange(70.0, 131.0, 2.5)
+    strikes = np.sort(rng.choice(grid, size=rng.integers(8, 21), replace=False))
+    iv = 0.15 + 0.25 * ((strikes - S) / S) ** 2 - 0.10 * (strikes - S) / S + rng.uniform(0.0, 0.03, strikes.size)
+    return condors.chain_greeks(S, strikes, rng.uniform(10, 60) / 365, iv)
+
+
+def brute_force(legs, call_width=None, put_width=None, max_width=None, min_credit=None):
+    # cost of the cheapest legal condor, None when there is none
+    k = legs['strike']
+    sc, lc, sp, lp = np.meshgrid(*[np.arange(k.size)] * 4, indexing='ij')
+    call_cost = np.abs(legs['call_delta'][sc] - TARGETS['short_call_delta'])
+    put_cost = np.abs(legs['put_delta'][sp] - TARGETS['short_put_delta'])
+    legal = (k[lc] > k[sc]) & (k[lp] < k[sp]) & (k[sp] < k[sc])
+    if call_width is None:
+        call_cost = call_cost + np.abs(legs['call_delta'][lc] - TARGETS['long_call_delta'])
+    else:
+        legal &= np.isclose(k[lc] - k[sc], call_width)
+    if put_width is None:
+        put_cost = put_cost + np.abs(legs['put_delta'][lp] - TARGETS['long_put_delta'])
+    else:
+        legal &= np.isclose(k[sp] - k[lp], put_width)
+    if max_width is not None:
+        legal &= (k[lc] - k[sc] <= max_width) & (k[sp] - k[lp] <= max_width)
+    credit = legs['call_price'][sc] - legs['call_price'][lc] + legs['put_price'][sp] - legs['put_price'][lp]
+    if min_credit is not None:
+        legal &= credit >= min_credit - 1e-12
+    if not legal.any():
+        return None
+    return (call_cost + put_cost)[legal].min()
+
+
+@pytest.mark.parametrize('seed', range(40))
+@pytest.mark.parametrize('widths', [(None, None), (5.0, 5.0), (5.0, 7.5)])
+@pytest.mark.parametrize('max_width', [None, 10.0])
+@pytest.mark.parametrize('min_credit', [None, 0.5, 2.0, 50.0])
+def test_matches_brute_force(seed, widths, max_width, min_credit):
+    legs = random_chain(np.random.default_rng(seed))
+    call_width, put_width = widths
+    best = brute_force(legs, call_width, put_width, max_width, min_credit)
+    condor = condors.select_iron_condor(legs, call_width=call_width, put_width=put_width, max_width=max_width,
+                                        min_credit=min_credit, **TARGETS)
+    if best is None:
+        assert condor is None
+        return
+    assert condor is not None
+    # ties may pick other strikes, the cost has to be the optimum and the condor legal
+    assert condor['cost'] == pytest.approx(best, abs=1e-12)
+    assert condor['long_put'] < condor['short_put'] < condor['short_call'] < condor['long_call']
+    if call_width is not None:
+        assert condor['call_width'] == pytest.approx(call_width)
+        assert condor['put_width'] == pytest.approx(put_width)
+    if max_width is not None:
+        assert max(condor['call_width'], condor['put_width']) <= max_width
+    if min_credit is not None:
+        assert condor['credit'] >= min_credit - 1e-12
@@ -0,0 +1,260 @@
+# Adaptive limit order working for combo entries.
+#
+# place_order priced the combo off a 60 second historical average and left
+# the limit there: when the market moved away the order sat unfilled and
+# manage_strangle logged "Waiting on order fill..." forever. LimitWorker
+# works a limit order instead:
+#   * the order is priced at the live mid of the combo (reqMktData quote) as
+#     soon as there is one, then stepped toward the natural price (the ask
+#     for a buy, the bid for a sell) every interval seconds, reaching it after
+#     steps steps, and follows the natural from then on,
+#   * every price change amends the working order in place (placeOrder again
+#     with the same orderId, which also keeps bracket children attached),
+#     only when the price moved by at least one tick, and never past the worst
+#     price the caller allows (a roll's minimum credit),
+#   * amendments go through a shared RateLimiter so all workers in the
+#     process stay under the broker's message rate,
+#   * each order's time to fill and price improvement against the natural at
+#     submission are recorded.
+# Steps are driven by an asyncio task on the running event loop (ib_insync's
+# loop when live) and can also be driven from the bar callback with step(),
+# so a replay without an event loop works the same way; a step is a few
+# comparisons when nothing needs amending.
+
+import asyncio
+import collections
+import datetime
+import logging
+import math
+import threading
+
+try:
+    from common import latency
+except ImportError:  # run as a script from models/common
+    import latency
+
+
+class RateLimiter:
+
+    '''
+    Sliding window limit on broker messages
+    :param max_messages: messages allowed per window
+    :param window: window length in seconds
+    :param clock: callable returning the current datetime
+    '''
+
+    def __init__(self, max_messages=40, window=1.0, clock=None):
+        self._lock = threading.Lock()
+        self.max_messages = max_messages
+        self.window = window
+        self.clock = clock or datetime.datetime.now
+        self.sent = collections.deque()
+
+    def allow(self):
+
+        '''
+        Take one message from the budget if there is one left in the window
+        :return: True when the message may be sent
+        '''
+
+        now = self.clock()
+        with self._lock:
+            while self.sent and (now - self.sent[0]).total_seconds() >= self.window:
+                self.sent.popleft()
+            if len(self.sent) >= self.max_messages:
+                return False
+            self.sent.append(now)
+            return True
+
+
+def _local(time):
+    # fills carry aware UTC times live and the clocks naive local ones, compare them as naive local
+    if time is not None and time.tzinfo is not None:
+        time = time.astimezone().replace(tzinfo=None)
+    return time
+
+
+# One budget per process, IB counts messages per client connection (50 a second)
+limiter = RateLimiter()
+
+
+class LimitWorker:
+
+    '''
+    Work limit orders from the mid toward the natural price
+    :param ib: connected ib_insync.IB
+    :param interval: seconds between steps
+    :param steps: steps from the mid to the natural price
+    :param tick: price increment of the orders
+    :param rate_limiter: RateLimiter shared by everything that sends orders, defaults to the module's
+    :param clock: callable returning the current datetime
+    '''
+
+    def __init__(self, ib, interval=5.0, steps=4, tick=0.01, rate_limiter=None, clock=None):
+        self._logger = logging.getLogger(__name__)
+        self.ib = ib
+        self.interval = interval
+        self.steps = steps
+        self.tick = tick
+        self.rate_limiter = rate_limiter or limiter
+        self.clock = clock or datetime.datetime.now
+        self.working = {}
+        self.tickers = {}
+        self.records = []
+        self._task = None
+
+    def quote(self, contract):
+
+        '''
+        Live (bid, ask) of a contract, subscribing on first use
+        :return: (bid, ask), NaN until the first quote arrives
+        '''
+
+        key = id(contract)
+        ticker = self.tickers.get(key)
+        if ticker is None:
+            ticker = self.tickers[key] = self.ib.reqMktData(contract, '', False, False)
+        bid, ask = ticker.bid, ticker.ask
+        # IB sends -1 for a missing side
+        if bid is None or ask is None or bid == -1 or ask == -1:
+            return math.nan, math.nan
+        return bid, ask
+
+    def _round(self, price):
+        return round(round(price / self.tick) * self.tick, 10)
+
+    def submit(self, contract, order, limit=None):
+
+        '''
+        Place a limit order at the live mid (the order's own limit until a quote arrives) and work it
+        :param limit: worst price the order may be worked to, a ceiling for a buy and a floor for a sell
+        :return: the Trade
+        '''
+
+        bid, ask = self.quote(contract)
+        state = {'contract': contract, 'order': order, 'trade': None, 'submitted': self.clock(), 'step': 0,
+                 'last_step': None, 'mid': (bid + ask) / 2, 'natural': ask if order.action == 'BUY' else bid,
+                 'amends': 0, 'limit': limit}
+        if not math.isnan(bid):
+            order.lmtPrice = self._bound(state, self._round((bid + ask) / 2))
+        with latency.span('placeOrder'):
+            state['trade'] = self.ib.placeOrder(contract, order)
+        self.working[id(order)] = state
+        state['last_step'] = self.clock() if not math.isnan(bid) else None
+        if not self._finished(state):
+            self._ensure_task()
+        return state['trade']
+
+    def _ensure_task(self):
+        if self._task is not None and not self._task.done():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # no event loop (a replay): the bar callback drives step()
+            return
+        self._task = loop.create_task(self._run())
+
+    async def _run(self):
+        while self.working:
+            await asyncio.sleep(self.interval)
+            try:
+                self.step()
+            except Exception as e:
+                # one bad order must not leave the others unmanaged
+                self._logger.error("Limit worker step failed: %s", e)
+
+    def target(self, state, bid, ask):
+
+        '''
+        Limit price of an order at its current step
+        :return: price between the mid (step 0) and the natural (step steps and after), within the order's limit
+        '''
+
+        mid = (bid + ask) / 2
+        natural = ask if state['order'].action == 'BUY' else bid
+        return self._bound(state, self._round(mid + (natural - mid) * min(state['step'] / self.steps, 1.0)))
+
+    @staticmethod
+    def _bound(state, price):
+        # never past the order's worst price
+        limit = state['limit']
+        if limit is None:
+            return price
+        return min(price, limit) if state['order'].action == 'BUY' else max(price, limit)
+
+    def step(self):
+
+        '''
+        Move every working order that is due one step toward the natural price
+        '''
+
+        now = self.clock()
+        for state in list(self.working.values()):
+            if self._finished(state):
+                continue
+            if state['last_step'] is not None and (now - state['last_step']).total_seconds() < self.interval:
+                continue
+            bid, ask = self.quote(state['contract'])
+            if math.isnan(bid) or math.isnan(ask):
+                continue
+            if state['last_step'] is None:
+                # first quote since submission, that is where the mid starts
+                state['mid'] = (bid + ask) / 2
+                state['natural'] = ask if state['order'].action == 'BUY' else bid
+            else:
+                state['step'] += 1
+            state['last_step'] = now
+            price = self.target(state, bid, ask)
+            order = state['order']
+            if abs(price - order.lmtPrice) < self.tick / 2:
+                continue
+            if not self.rate_limiter.allow():
+                self._logger.warning("Message rate limit reached, order %s not amended", order.orderId)
+                continue
+            previous, order.lmtPrice = order.lmtPrice, price
+            # a bracket parent is sent with transmit=False, the amendment itself has to go out
+            order.transmit = True
+            try:
+                with latency.span('placeOrder'):
+                    self.ib.placeOrder(state['contract'], order)
+            except Exception as e:
+                order.lmtPrice = previous
+                self._logger.warning("Order %s not amended: %s", order.orderId, e)
+                continue
+            state['amends'] += 1
+            self._finished(state)
+
+    def _finished(self, state):
+        trade = state['trade']
+        if trade is None or not trade.isDone():
+            return False
+        del self.working[id(state['order'])]
+        ticker = self.tickers.pop(id(state['contract']), None)
+        if ticker is not None:
+            self.ib.cancelMktData(state['contract'])
+        if trade.orderStatus.status != 'Filled' or not trade.fills:
+            return True
+        fill = trade.fills[-1]
+        filled = _local(fill.time)
+        price = trade.orderStatus.avgFillPrice or fill.execution.price
+        side = 1 if state['order'].action == 'BUY' else -1
+        record = {
+            'order_id': state['order'].orderId,
+            'submitted': state['submitted'],
+            'filled': filled,
+            'time_to_fill': (filled - _local(state['submitted'])).total_seconds(),
+            'mid': state['mid'],
+            'natural': state['natural'],
+            'fill_price': price,
+            # paid less than the natural for a buy / got more for a sell, per share
+            'improvement': side * (state['natural'] - price),
+            'steps': state['step'],
+            'amends': state['amends'],
+        }
+        self.records.append(record)
+        self._logger.info("Order %s filled at %s after %ss, %s steps and %s amendments, improvement %s vs natural",
+                          record['order_id'], price, round(record['time_to_fill'], 1), record['steps'],
+                          record['amends'], round(record['improvement'], 4) if not math.isnan(record['improvement'])
+                          else 'n/a')
+        return True
@@ -10,6 +10,12 @@ import datetime
 from apscheduler.schedulers.background import BackgroundScheduler
 import asyncio
 import nest_asyncio
+import os
+import sys
+
+# Shared helpers for the live bots live in models/common
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from common import condors
 
 # TODO:
 # * Add a way to reconnect to IB if connection is lost
@@ -246,8 +252,8 @@ class IronCondors():
             print("Could not get chain IV.")
 
     def find_iron_condor(self, short_call_delta=0.10, short_put_delta=-0.10, long_call_delta=0.02, long_put_delta=-0.02,
-                         trade_width=True, call_spread_width=3, put_spread_width=3, short_option_qty=1,
-                         long_option_qty=1, order='SELL'):
+                         trade_width=True, call_spread_width=3, put_spread_width=3, max_width=None, min_credit=None,
+                         short_option_qty=1, long_option_qty=1, order='SELL'):
 
         '''
         Get the specified delta call and put to trade at that expiration
@@ -259,6 +265,8 @@ class IronCondors():
         :param trade_width: whether we are trading a width or a delta for the outside options
         :param call_spread_width: width of the call spread
         :param put_spread_width: width of the put spread
+        :param max_width: widest spread allowed on either side, None for no limit
+        :param min_credit: smallest credit of the whole condor (per share), None for no minimum
         :param short_option_qty: quantity of the short option
         :param long_option_qty: quantity of the long option
         :param order: whether we are buying or selling the option
@@ -269,21 +277,22 @@ class IronCondors():
             nearestDTE = self.nearestDTE.strftime('%Y%m%d')
             self.get_chain_iv(nearestDTE=nearestDTE)
 
-            longcallToTrade = 0
-            # get the call strike to sell
-            shortcallToTrade = self.get_strike(delta=short_call_delta, option_type='C', call_strike_rounding='None')
-            if trade_width:
-                longcallToTrade = shortcallToTrade + call_spread_width
-            else:
-                longcallToTrade = self.get_strike(delta=long_call_delta, option_type='C', call_strike_rounding='None')
-
-            longputToTrade = 0
-            # get the put strike to sell
-            shortputToTrade = self.get_strike(delta=short_put_delta, option_type='P', put_strike_rounding='None')
-            if trade_width:
-                longputToTrade = shortputToTrade - put_spread_width
-            else:
-                longputToTrade = self.get_strike(delta=long_put_delta, option_type='P', put_strike_rounding='None')
+            # price every strike of the expiration once and pick all four strikes together
+            chain = next(c for c in self.chains if c.exchange == 'SMART')
+            legs = condors.chain_greeks(self.df.close.iloc[-1], chain.strikes, self.daysToexp,
+                                        float(np.squeeze(self.currentIV)))
+            condor = condors.select_iron_condor(legs, short_call_delta=short_call_delta, short_put_delta=short_put_delta,
+                                                long_call_delta=long_call_delta, long_put_delta=long_put_delta,
+                                                call_width=call_spread_width if trade_width else None,
+                                                put_width=put_spread_width if trade_width else None,
+                                                max_width=max_width, min_credit=min_credit,
+                                                short_qty=short_option_qty, long_qty=long_option_qty)
+            if condor is None:
+                print("No iron condor meets the width and credit constraints")
+                return
+            shortcallToTrade, longcallToTrade = condor['short_call'], condor['long_call']
+            shortputToTrade, longputToTrade = condor['short_put'], condor['long_put']
+            print("Iron Condor model credit: ", round(condor['credit'], 2))
 
             # print the strikes to sell
             print("Call Spread to trade: " + str(shortcallToTrade) + "/" + str(longcallToTrade))
@@ -484,7 +493,7 @@ class IronCondors():
     def trade_ironcondor(self, short_call_delta=0.10, short_put_delta=-0.10, long_call_delta=0.30, long_put_delta=-0.30,
                          call_spread_width=3, put_spread_width=3, order_type='short', order_style='bracket', days=0,
                          take_profit_factor=0.50, stop_loss_factor=2.00, use_vix_position_sizing=False, quantity=1,
-                         short_option_qty=1, long_option_qty=1, trade_width=True):
+                         short_option_qty=1, long_option_qty=1, trade_width=True, max_width=None, min_credit=None):
         '''
         Trade the Iron Condor Options Strategy
         :param short_call_delta: call delta for our short call
@@ -503,6 +512,8 @@ class IronCondors():
         :param short_option_qty: how many short options to trade
         :param long_option_qty: how many long options to trade
         :param trade_width: whether to trade the width of the spread or trade delta of the long options
+        :param max_width: widest spread allowed on either side, None for no limit
+        :param min_credit: smallest credit of the whole condor (per share), None for no minimum
         :return: None
         '''
 
@@ -516,7 +527,8 @@ class IronCondors():
             self.find_iron_condor(short_call_delta=short_call_delta, short_put_delta=short_put_delta,
                                   long_call_delta=long_call_delta, long_put_delta=long_put_delta, trade_width=trade_width,
                                   call_spread_width=call_spread_width, put_spread_width=put_spread_width, order=order,
-                                  short_option_qty=short_option_qty, long_option_qty=long_option_qty)
+                                  max_width=max_width, min_credit=min_credit, short_option_qty=short_option_qty,
+                                  long_option_qty=long_option_qty)
 
             self.place_order(contract=self.ironcondor, order_type=order_type, order_style=order_style,
                              take_profit_factor=take_profit_factor, stop_loss_factor=stop_loss_factor,
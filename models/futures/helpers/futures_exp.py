@@ -1,25 +1,177 @@
-# make a function to calculate the expiration contract code for a future
-# based on the current date and the expiration cycle
+# Futures contract resolution from the exchange's own expiry calendar.
+#
+# futures_exp used to guess the contract code from today's date: the month 45
+# days out (listed or not, MES only lists the quarterly months), a
+# 30-day-per-offset search in the bot and the last digit of today's year,
+# which is the wrong year for any target month in the next calendar year.
+# FuturesResolver asks IB once per root for the details of every listed
+# contract (one reqContractDetails, already qualified) and keeps them as a
+# calendar sorted by last trade date, with each contract's roll date
+# roll_days before it. The front contract (the first one not yet rolled) and
+# the target contract (the first one expiring at least N days out) are binary
+# searches over that calendar; it is requested again once a day, or as soon
+# as the dates asked for run past the last listed contract.
 
+import bisect
 import datetime as dt
+import logging
 
-month_codes= {'F':1, 'G':2, 'H':3, 'J':4, 'K':5, 'M':6, 'N':7, 'Q':8, 'U':9, 'V':10, 'X':11, 'Z':12}
+from ib_insync import Future
+
+from common import latency
+
+month_codes = {'F': 1, 'G': 2, 'H': 3, 'J': 4, 'K': 5, 'M': 6, 'N': 7, 'Q': 8, 'U': 9, 'V': 10, 'X': 11, 'Z': 12}
+codes_by_month = {month: code for code, month in month_codes.items()}
+
+
+def futures_code(root, year, month, digits=1):
+
+    '''
+    Contract code of a futures month, e.g. MESM3 for June 2023
+    :param root: futures root symbol
+    :param year: year of the contract month (not of today)
+    :param month: contract month, 1-12
+    :param digits: digits of the year in the code (IB's CME local symbols use 1)
+    :return: string
+    '''
+
+    return f"{root}{codes_by_month[month]}{str(year)[-digits:]}"
+
+
+def _expiry(details):
+    # last trade date of a ContractDetails as a date
+    text = details.contract.lastTradeDateOrContractMonth or details.realExpirationDate
+    return dt.datetime.strptime(text[:8], '%Y%m%d').date()
+
+
+class FuturesCalendar:
+
+    '''
+    Listed contracts of one futures root, sorted by last trade date
+    :param contracts: qualified Future contracts
+    :param expiries: their last trade dates
+    :param roll_days: calendar days before the last trade date a position moves to the next contract
+    '''
+
+    def __init__(self, contracts, expiries, roll_days=8):
+        order = sorted(range(len(contracts)), key=lambda i: expiries[i])
+        self.contracts = [contracts[i] for i in order]
+        self.expiries = [expiries[i] for i in order]
+        self.rolls = [expiry - dt.timedelta(days=roll_days) for expiry in self.expiries]
+        self.roll_days = roll_days
+
+    def __len__(self):
+        return len(self.contracts)
+
+    def front_index(self, date):
+        # first contract whose roll date is still ahead
+        return bisect.bisect_right(self.rolls, date)
+
+    def target_index(self, date, days=45):
+        # first contract trading at least days after date
+        return bisect.bisect_left(self.expiries, date + dt.timedelta(days=days))
+
+    def front(self, date):
+
+        '''
+        Front contract on a date: the nearest one that has not reached its roll date
+        :return: Future, or None when every listed contract has rolled
+        '''
+
+        i = self.front_index(date)
+        return self.contracts[i] if i < len(self.contracts) else None
+
+    def target(self, date, days=45):
+
+        '''
+        First contract expiring at least days after date
+        :return: Future, or None when none is listed that far out
+        '''
+
+        i = self.target_index(date, days)
+        return self.contracts[i] if i < len(self.contracts) else None
+
+    def next_roll(self, date):
+
+        '''
+        Next roll date after date
+        :return: date, or None past the last listed contract
+        '''
+
+        i = self.front_index(date)
+        return self.rolls[i] if i < len(self.rolls) else None
+
+
+class FuturesResolver:
 
-def futures_exp(contract, offset=0):
     '''
-    This function will take todays date and return the expiration code for the
-    futures contract that is currently trading roughly 45 days out.
-    :param today: todays date
-    :return: string that has the expiration code for the futures contract (ie. 'M3' for June 2023)
+    One contract details request per futures root, cached as a FuturesCalendar
+    :param ib: connected ib_insync.IB
+    :param exchange: exchange of the futures
+    :param currency: currency of the futures
+    :param roll_days: calendar days before the last trade date to roll
+    :param max_age: seconds a calendar is kept before it is requested again
+    :param clock: callable returning the current datetime
     '''
 
-    today = dt.date.today() + dt.timedelta(days=30*offset)
-    year = today.year
-    # get the last digit in the year
-    year = str(year)
-    year = year[-1]
-    target_exp = today + dt.timedelta(days=45)
-    # print the month code for the target expiration
-    for key, value in month_codes.items():
-        if target_exp.month == value:
-            return str(contract)+str(key)+str(year)
+    def __init__(self, ib, exchange='CME', currency='USD', roll_days=8, max_age=24 * 60 * 60, clock=None):
+        self._logger = logging.getLogger(__name__)
+        self.ib = ib
+        self.exchange = exchange
+        self.currency = currency
+        self.roll_days = roll_days
+        self.max_age = max_age
+        self.clock = clock or dt.datetime.now
+        self.calendars = {}     # root -> (FuturesCalendar, time requested)
+
+    def calendar(self, root, refresh=False):
+
+        '''
+        Calendar of every listed contract of a root, requested on first use and after max_age
+        :param root: futures root symbol (MES, ES, ...)
+        :param refresh: request it again even if the cached one is fresh
+        :return: FuturesCalendar
+        '''
+
+        now = self.clock()
+        cached = self.calendars.get(root)
+        if cached is not None and not refresh and (now - cached[1]).total_seconds() < self.max_age:
+            return cached[0]
+        query = Future(symbol=root, exchange=self.exchange, currency=self.currency)
+        with latency.span('reqContractDetails'):
+            details = self.ib.reqContractDetails(query)
+        if not details:
+            raise LookupError(f"no {root} futures listed on {self.exchange}")
+        calendar = FuturesCalendar([d.contract for d in details], [_expiry(d) for d in details], self.roll_days)
+        self.calendars[root] = (calendar, now)
+        self._logger.info("%s futures: %s", root, ', '.join(c.localSymbol for c in calendar.contracts))
+        return calendar
+
+    def _resolve(self, root, pick, date):
+        contract = pick(self.calendar(root))
+        if contract is None:
+            # the cached listing has run out, newer contracts may have been listed since
+            contract = pick(self.calendar(root, refresh=True))
+        if contract is None:
+            raise LookupError(f"no {root} futures listed for {date}")
+        return contract
+
+    def front(self, root, date=None):
+
+        '''
+        Front contract of a root on a date (today by default)
+        :return: qualified Future
+        '''
+
+        date = date or self.clock().date()
+        return self._resolve(root, lambda calendar: calendar.front(date), date)
+
+    def target(self, root, days=45, date=None):
+
+        '''
+        First contract of a root expiring at least days after date (today by default)
+        :return: qualified Future
+        '''
+
+        date = date or self.clock().date()
+        return self._resolve(root, lambda calendar: calendar.target(date, days), date)
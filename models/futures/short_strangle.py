@@ -1,27 +1,35 @@
 # Imports
+import argparse
 import asyncio
+import datetime
 import logging
+import os
 import sys
+
+# Shared helpers for the live bots live in models/common
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common import (account, greeks, hedging, journal, latency, log, margin, profiler, risk, rolling, scenarios,
+                    sizing, startup, working)
+
+# Keep compiled pricing kernels between runs, this has to happen before numba is imported
+startup.enable_jit_cache()
+
 import ib_insync as ibi
 import ib_insync.util
-import pandas as pd
 import numpy as np
-import py_vollib_vectorized
 from ib_insync import *
-from py_vollib_vectorized import price_dataframe
-import datetime
-from apscheduler.schedulers.background import BackgroundScheduler
-import asyncio
 import nest_asyncio
-import helpers.futures_exp as futures_exp
 
-# TODO:
-# * Firgure out how to get the right contract for the right month
-# * Figure out how to get the right expiration date for the right contract
-# * Once I get the chain data for the right expiration and have the right front month contract,
-#   everything else should all into place
+# Heavy modules are imported on first use (pricing is warmed in the background at boot)
+pd = startup.lazy_import('pandas')
+py_vollib_vectorized = startup.lazy_import('py_vollib_vectorized')
+apscheduler_background = startup.lazy_import('apscheduler.schedulers.background')
+
+import helpers.futures_exp as futures_exp
 
 
+# Name of the strategy in the order journal
+STRATEGY = 'short_strangle_mes'
 
 class ShortStrangles:
 
@@ -33,12 +41,20 @@ class ShortStrangles:
     These parameters are configurable in the trade_strangle() function.
     '''
 
-    def __init__(self):
-        print(f"{self.get_timestamp()} Initializing Options Strategy...")
+    def __init__(self, profiler=None, ib=None, clock=None, delta_hedge=False, roll=False, max_daily_loss=None,
+                 max_contracts=None, margin_path='pyoptiontrader_margin_mes.json',
+                 journal_path='pyoptiontrader_orders_mes', latency_path='pyoptiontrader_latency_mes.prom'):
+        self._logger = logging.getLogger(__name__)
+        self._logger.info("Initializing Options Strategy...")
 
         # Instantiate local vars
-        self.ib = ibi.IB()
-        self._logger = logging.getLogger(__name__)
+        # ib and clock are swapped for a simulated broker and virtual clock by research/backtesting/live_replay.py
+        self.ib = ib if ib is not None else ibi.IB()
+        self.clock = clock if clock is not None else datetime.datetime.now
+        self.profiler = profiler
+        # files the bot keeps between runs, a replay points them away from the live ones
+        self.latency_path = latency_path
+        self.startup = startup.StartupTimer(self._logger)
         self.bar_count = 0
         self.underlying = None
         self.data = None
@@ -55,10 +71,50 @@ class ShortStrangles:
         self.lastEstimatedTradePrice = 0.0
         self.takeProfitPrice = 0.0
         self.stopLossPrice = 0.0
+        self.takeProfitFactor = 0.50
+        self.stopLossFactor = 3.00
         self.open_order_log = []
         self.previous_unique_orders = 0
         self.trade_log = []
         self.previous_unique_trades = 0
+        # net greeks of every open leg, shared with any other strategy in the process
+        self.greeks = greeks.book
+        self.leg_contracts = {}
+        # spot x vol P&L grid of the book, refreshed every bar, and the optional tail risk stop on it:
+        # close when the worst loss for moves up to scenario_move exceeds max_scenario_loss dollars
+        self.scenario_risk = None
+        self.scenario_move = 0.05
+        self.max_scenario_loss = None
+        # local margin estimates, checked against whatIfOrder while calibrating and every few orders after
+        self.margin_model = margin.MarginModel(margin_path)
+        # account values pushed by TWS, read without a round trip when sizing orders
+        self.account = account.AccountState(self.ib, clock=self.clock)
+        # listed MES contracts and their roll dates, one contract details request per root
+        self.futures = futures_exp.FuturesResolver(self.ib, exchange='CME', clock=self.clock)
+        # optional delta hedging in the underlying, created once the underlying is qualified
+        self.delta_hedge = delta_hedge
+        self.hedger = None
+        # optional roll management of the open strangle, the roll waiting on its fill and how long it may wait
+        self.roller = rolling.RollEngine() if roll else None
+        self.roll = None
+        self.roll_timeout = 15 * 60
+        # every order goes through the risk limits, the guard stands in for ib wherever orders are placed
+        self.guard = risk.RiskGuard(self.ib, account=self.account, max_daily_loss=max_daily_loss,
+                                    max_contracts=max_contracts, book=self.greeks, multiplier=5, clock=self.clock)
+        self.guard.subscribe(self.on_risk_breach)
+        # once, not in connect_to_ibkr: a reconnect would count every fill again
+        self.ib.orderStatusEvent += self.callback(self.guard.on_status)
+        self.ib.execDetailsEvent += self.callback(self.guard.on_fill)
+        # every order from decision to fill, for the latency and slippage reports
+        self.journal = journal.OrderJournal(journal_path, multiplier=5, clock=self.clock)
+        self.ib.openOrderEvent += self.callback(self.journal.on_status)
+        self.ib.orderStatusEvent += self.callback(self.journal.on_status)
+        self.ib.execDetailsEvent += self.callback(self.journal.on_fill)
+        # entry limits are worked from the live mid toward the natural price until they fill
+        self.worker = working.LimitWorker(self.guard, clock=self.clock, tick=0.05)
+
+        # Import and JIT the pricing kernels while we connect, not while we place the first trade
+        self.pricing_warmup = startup.warm_pricing_kernels(self._logger)
 
         # Run the main loop by connecting to IBKR
         self.connect_to_ibkr()
@@ -73,38 +129,37 @@ class ShortStrangles:
             try:
                 self.ib.connect("127.0.0.1", port=7497, clientId=101, timeout=5)
                 if self.ib.isConnected():
-                    print(f'{self.get_timestamp()} Connected to IBKR')
+                    self._logger.info("Connected to IBKR")
+                    self.startup.mark('connected')
+                    self.account.start()
                     current_reconnect = 0
                     break
             except Exception as err:
-                print(f"{self.get_timestamp()} Connection exception: ", err)
+                self._logger.warning("Connection exception: %s", err)
                 if current_reconnect < max_attempts:
                     current_reconnect += 1
-                    print(f'{self.get_timestamp()} Connect failed')
-                    print(f'{self.get_timestamp()} Retrying in {delaySecs} seconds, attempt {current_reconnect} of max {max_attempts}')
+                    self._logger.warning("Connect failed")
+                    self._logger.info("Retrying in %s seconds, attempt %s of max %s", delaySecs, current_reconnect, max_attempts)
                     self.ib.sleep(delaySecs)
                 else:
-                    sys.exit(f"{self.get_timestamp()} Reconnect Failure after {max_attempts} tries")
+                    self._logger.critical("Reconnect Failure after %s tries", max_attempts)
+                    sys.exit(f"Reconnect Failure after {max_attempts} tries")
         try:
-            # Create Equity "Contract" for ticker to trade
-            # self.underlying = Future('MNQ', "MNQM3", 'CME', 'USD')
-            self.underlying = Contract()
-            self.underlying.secType = 'FUT'
-            self.underlying.exchange = 'CME'
-            self.underlying.currency = 'USD'
-            self.underlying.symbol = 'MES'
+            # The MES contract the ~45 DTE options trade on, from the listed contracts' calendar
+            self.underlying = self.futures.target('MES', days=45)
+            self._logger.info("Trading options on %s, next MES roll on %s", self.underlying.localSymbol,
+                              self.futures.calendar('MES').next_roll(self.clock().date()))
             # self.self.ib.reqMarketDataType(3) # delayed market data, comment out for real-time data
-            for i in range(0,12):
-                try:
-                    self.underlying.localSymbol = futures_exp.futures_exp("MES", i)
-                    self.ib.qualifyContracts(self.underlying)
-                except:
-                    print("Contract {} not found, trying next contract".format(futures_exp.futures_exp("MES", i)))
 
-            # self.ib.qualifyContracts(self.underlying)
+            # Hedge the net delta of the book in the underlying
+            if self.delta_hedge and self.hedger is None:
+                self.hedger = hedging.DeltaHedger(self.guard, self.underlying, book=self.greeks,
+                                                  delta_per_unit=float(self.underlying.multiplier or 1),
+                                                  journal=self.journal, strategy=STRATEGY, clock=self.clock)
+                self.ib.execDetailsEvent += self.callback(self.hedger.on_fill)
 
             # Request Streaming Bars
-            print(f"{self.get_timestamp()} Backfilling data...")
+            self._logger.info("Backfilling data...")
             self.data = self.ib.reqHistoricalData(self.underlying,
                                                   endDateTime='',
                                                   durationStr='1 D',
@@ -115,23 +170,28 @@ class ShortStrangles:
 
             # Debugging Data Import
             self.df = util.df(self.data)
-            print(self.df)
+            self._logger.debug("Backfilled bars: %s", self.df)
 
             # Get current options chains
             self.chains = self.ib.reqSecDefOptParams(self.underlying.symbol, self.underlying.exchange, self.underlying.secType,
                                                      self.underlying.conId)
             # Update the chain every hour - can't update more frequently than this without asyncio issues
-            update_chain_scheduler = BackgroundScheduler(job_defaults={'max_instances': 2})
+            update_chain_scheduler = apscheduler_background.BackgroundScheduler(job_defaults={'max_instances': 2})
             update_chain_scheduler.add_job(func=self.update_options_chains, trigger='cron', hour='*')
             update_chain_scheduler.start()
 
-            print(f"{self.get_timestamp()} Running Live...")
+            # Log a latency summary and refresh the Prometheus text file every minute
+            latency.recorder.start_reporting(interval=60, path=self.latency_path, logger=self._logger)
+
+            self._logger.info("Running Live...")
 
             # Set callback function for events
-            self.ib.disconnectedEvent += self.onDisconnected
-            self.data.updateEvent += self.on_bar_update
-            self.ib.execDetailsEvent += self.exec_status
-            self.ib.openOrderEvent += self.on_open_order_update
+            self.ib.disconnectedEvent += self.callback(self.onDisconnected)
+            self.data.updateEvent += self.callback(self.on_bar_update)
+            self.ib.execDetailsEvent += self.callback(self.exec_status)
+            self.ib.openOrderEvent += self.callback(self.on_open_order_update)
+            if self.profiler is not None:
+                self.profiler.watch_loop(util.getLoop())
 
             # Run the main loop
             util.patchAsyncio()
@@ -146,16 +206,18 @@ class ShortStrangles:
             # long enough that it won't reconnect too often (ie. 50yrs)
             self.ib.sleep(60*60*365*50)
         except Exception as err:
-            print("Problem running strategy code: ", err)
+            self._logger.exception("Problem running strategy code: %s", err)
 
-    def get_timestamp(self):
-        # Get the current datetime
-        now = datetime.datetime.now()
-        # Format the datetime as a string with seconds
-        timestamp = now.strftime("[%Y-%m-%d %I:%M:%S%p]")
-        return timestamp
+    def callback(self, func):
+        # Attribute profiler samples and loop stalls to the event callback when --profile is on
+        if self.profiler is None:
+            return func
+        return self.profiler.wrap(func)
 
     def on_open_order_update(self, trade: Trade):
+        # Hedge orders in the underlying and rolls are not new strangle orders
+        if trade.contract.secType != 'BAG' or trade.order.orderRef == 'roll':
+            return
         # Add the order to the log
         conId = trade.contract.comboLegs[0].conId
         self.open_order_log.append(conId)
@@ -163,14 +225,27 @@ class ShortStrangles:
         current_unique_orders = len(set(self.open_order_log))
         # Check if a new unique order is added
         if current_unique_orders > self.previous_unique_orders:
-            print(f"{self.get_timestamp()} New Order Created")
+            self._logger.info("New Order Created")
             self.previous_unique_orders = current_unique_orders
             self.order_placed = not self.order_placed
-            print(f"{self.get_timestamp()} Trade Placed")
+            self._logger.info("Trade Placed")
+
+    def on_risk_breach(self, reason, action):
+        # the guard closed everything, the strangle and its greeks are gone
+        if action != 'flatten':
+            return
+        for conId in self.leg_contracts:
+            self.greeks.remove_leg(conId)
+        if self.roller is not None:
+            self.roller.close()
+            self.roll = None
+        self.in_trade = False
+        self.order_placed = False
+        self._logger.warning("Strategy flattened by the risk guard: %s", reason)
 
     def onDisconnected(self):
-        print(f"{self.get_timestamp()} Disconnect Event")
-        print(f"{self.get_timestamp()} attempting restart and reconnect...")
+        self._logger.warning("Disconnect Event")
+        self._logger.info("attempting restart and reconnect...")
         self.connect_to_ibkr()
 
     # Update the options chain
@@ -184,16 +259,16 @@ class ShortStrangles:
         try:
             loop = asyncio.new_event_loop()
             asyncio.set_event_loop(loop)
-            print(f"{self.get_timestamp()} Updating Options Chains...")
+            self._logger.info("Updating Options Chains...")
             # Get current options chain
             self.chains = self.ib.reqSecDefOptParams(self.underlying.symbol, self.underlying.exchange, self.underlying.secType,
                                                      self.underlying.conId)
-            print(f"{self.get_timestamp()} Options Chains Updated.")
-            print(self.chains)
+            self._logger.info("Options Chains Updated.")
+            self._logger.debug("Options chains: %s", self.chains)
         except Exception as e:
-            print(str(e))
-            print(f"{self.get_timestamp()} Could not update options chains.")
+            self._logger.error("Could not update options chains: %s", e)
 
+    @latency.timed()
     def update_target_expiration(self, days):
 
         '''
@@ -204,27 +279,27 @@ class ShortStrangles:
         try:
             # chain = next(c for c in self.chains if c.tradingClass == 'SPX' and c.exchange == 'SMART') # for index
             # chain = next(c for c in self.chains if c.exchange == 'SMART')  # for stock
-            print(self.chains)
+            self._logger.debug("Options chains: %s", self.chains)
             chain = next(c for c in self.chains if c.exchange == 'CME')  # for futures
 
             # get the nearest monthly expiration
-            targetDTE = datetime.date.today() + datetime.timedelta(days=days)
+            targetDTE = self.clock().date() + datetime.timedelta(days=days)
 
             # convert chain.expirations to datetime.date
             expire = [datetime.datetime.strptime(exp, '%Y%m%d').date() for exp in chain.expirations]
-            print(expire)
+            self._logger.debug("Expirations: %s", expire)
 
             # find the nearest monthly expiration in chain.expirations to targetDTE
             self.nearestDTE = min(expire, key=lambda x: abs(x - targetDTE))
 
             # find the number of days until the nearest monthly expiration
-            self.daysToexp = (self.nearestDTE - datetime.date.today()).days / 365
-            print(f"{self.get_timestamp()} Days to expiration: ", round(self.daysToexp * 365), " days")
-            print(f"{self.get_timestamp()} Expiration date: ", self.nearestDTE)
+            self.daysToexp = (self.nearestDTE - self.clock().date()).days / 365
+            self._logger.info("Days to expiration: %s days", round(self.daysToexp * 365))
+            self._logger.info("Expiration date: %s", self.nearestDTE)
         except Exception as e:
-            print(str(e))
-            print(f"{self.get_timestamp()} Could not update target expiration.")
+            self._logger.error("Could not update target expiration: %s", e)
 
+    @latency.timed()
     def get_strike(self, delta=0.16, option_type='C', call_strike_rounding='up', put_strike_rounding='down'):
 
         '''
@@ -252,41 +327,39 @@ class ShortStrangles:
                 option['T'] = self.daysToexp  # (Annualized) time-to-expiration
                 option['R'] = 0.00  # Interest free rate
                 option['IV'] = self.currentIV  # Implied Volatility
-                result = price_dataframe(option, flag_col='Flag', underlying_price_col='S', strike_col='K',
-                                         annualized_tte_col='T',
-                                         riskfree_rate_col='R', sigma_col='IV', model='black_scholes',
-                                         inplace=False)
+                result = py_vollib_vectorized.price_dataframe(option, flag_col='Flag', underlying_price_col='S',
+                                                              strike_col='K', annualized_tte_col='T',
+                                                              riskfree_rate_col='R', sigma_col='IV',
+                                                              model='black_scholes', inplace=False)
                 if option_type == 'C':
                     if result['delta'][0] <= delta:  # call delta is positive
-                        print(f"{self.get_timestamp()} Call Greeks:")
-                        print(result)
-                        print(f"{self.get_timestamp()} Raw Call Strike to Trade: ", option['K'][0])
+                        self._logger.debug("Call Greeks: %s", result.to_dict('records'))
+                        self._logger.info("Raw Call Strike to Trade: %s", option['K'][0])
                         if call_strike_rounding == 'up':
                             optionToTrade = int(np.ceil(option['K'][0] / 5)) * 5
                         elif call_strike_rounding == 'down':
                             optionToTrade = int(np.floor(option['K'][0] / 5)) * 5
                         else:
                             optionToTrade = int(round(option['K'][0]))
-                        print(f"{self.get_timestamp()} Call Strike to Trade: ", optionToTrade)
+                        self._logger.info("Call Strike to Trade: %s", optionToTrade)
                         break
                 else:
                     if result['delta'][0] >= delta:  # put delta is negative
-                        print(f"{self.get_timestamp()} Put Greeks:")
-                        print(result)
-                        print(f"{self.get_timestamp()} Raw Put Strike to Trade: ", option['K'][0])
+                        self._logger.debug("Put Greeks: %s", result.to_dict('records'))
+                        self._logger.info("Raw Put Strike to Trade: %s", option['K'][0])
                         if put_strike_rounding == 'up':
                             optionToTrade = int(np.ceil(option['K'][0] / 5)) * 5
                         elif put_strike_rounding == 'down':
                             optionToTrade = int(np.floor(option['K'][0] / 5)) * 5
                         else:
                             optionToTrade = int(round(option['K'][0]))
-                        print(f"{self.get_timestamp()} Put Strike to Trade: ", optionToTrade)
+                        self._logger.info("Put Strike to Trade: %s", optionToTrade)
                         break
             return optionToTrade
         except Exception as e:
-            print(str(e))
-            print(f"{self.get_timestamp()} Could not get strike.")
+            self._logger.error("Could not get strike: %s", e)
 
+    @latency.timed()
     def get_chain_iv(self, nearestDTE):
 
         '''
@@ -298,7 +371,8 @@ class ShortStrangles:
             # Create an ATM call contract to get the current IV of the chain
             atmCall = Option(self.underlying.symbol, nearestDTE, int(np.ceil(self.df.close.iloc[-1] / 5)) * 5, 'C',
                              'SMART')
-            self.ib.qualifyContracts(atmCall)
+            with latency.span('qualifyContracts'):
+                self.ib.qualifyContracts(atmCall)
             atmCallPrices = self.ib.reqHistoricalData(atmCall,
                                                       endDateTime='',
                                                       durationStr='60 s',
@@ -308,7 +382,7 @@ class ShortStrangles:
                                                       keepUpToDate=True, )
             atmCallPricesdf = util.df(atmCallPrices)
             atmCallPrice = round(np.nanmean(atmCallPricesdf['close']), 2)
-            print(f"{self.get_timestamp()} ATM Call Price: ", atmCallPrice)
+            self._logger.info("ATM Call Price: %s", atmCallPrice)
 
             # calculate the current IV of the chain using the ATM call price
             self.currentIV = py_vollib_vectorized.vectorized_implied_volatility_black(atmCallPrice,
@@ -317,10 +391,14 @@ class ShortStrangles:
                                                                                                       -1] / 5) * 5),
                                                                                       0.00, self.daysToexp, 'c',
                                                                                       return_as='numpy')
-            print(f"{self.get_timestamp()} Current IV: ", str(self.currentIV))
+            # the option_quote fields make this line a chain capture research/backtesting/chain_store.py can ingest
+            self._logger.info("Current IV: %s", self.currentIV,
+                              extra={'event': 'option_quote', 'expiry': nearestDTE, 'right': 'C',
+                                     'strike': atmCall.strike, 'bid': atmCallPrice, 'ask': atmCallPrice,
+                                     'iv': float(np.squeeze(self.currentIV)),
+                                     'underlying': float(self.df.close.iloc[-1])})
         except Exception as e:
-            print(str(e))
-            print(f"{self.get_timestamp()} Could not get chain IV.")
+            self._logger.error("Could not get chain IV: %s", e)
 
     def find_strangle(self, call_delta=0.16, put_delta=-0.16, order='SELL'):
 
@@ -333,6 +411,9 @@ class ShortStrangles:
         '''
 
         try:
+            # Block until the pricing kernels are compiled (normally done long before the first trade)
+            self.pricing_warmup.wait()
+
             # Get the current IV of the chain expiration
             nearestDTE = self.nearestDTE.strftime('%Y%m%d')
             self.get_chain_iv(nearestDTE=nearestDTE)
@@ -344,15 +425,19 @@ class ShortStrangles:
             putToTrade = self.get_strike(delta=put_delta, option_type='P')
 
             # print the strikes to sell
-            print(f"{self.get_timestamp()} Call to trade: ", callToTrade)
-            print(f"{self.get_timestamp()} Put to trade: ", putToTrade)
+            self._logger.info("Call to trade: %s", callToTrade)
+            self._logger.info("Put to trade: %s", putToTrade)
 
             # make the option contracts
             self.short_call = Option(self.underlying.symbol, nearestDTE, callToTrade, 'C', 'SMART', '100', 'USD')
             self.short_put = Option(self.underlying.symbol, nearestDTE, putToTrade, 'P', 'SMART', '100', 'USD')
-            self.ib.qualifyContracts(self.short_call)
-            self.ib.qualifyContracts(self.short_put)
-            print(f"{self.get_timestamp()} Call and Put Contracts Qualified")
+            with latency.span('qualifyContracts'):
+                self.ib.qualifyContracts(self.short_call)
+            with latency.span('qualifyContracts'):
+                self.ib.qualifyContracts(self.short_put)
+            self._logger.info("Call and Put Contracts Qualified")
+            self.leg_contracts[self.short_call.conId] = self.short_call
+            self.leg_contracts[self.short_put.conId] = self.short_put
 
             # make the combo order
             self.strangle = Contract()
@@ -376,11 +461,10 @@ class ShortStrangles:
             leg2.exchange = self.short_put.exchange
 
             self.strangle.comboLegs = [leg1, leg2]
-            print(f"{self.get_timestamp()} Strangle Options Combo Order Created")
+            self._logger.info("Strangle Options Combo Order Created")
 
         except Exception as e:
-            print(str(e))
-            print(f"{self.get_timestamp()} Could not find strangle.")
+            self._logger.error("Could not find strangle: %s", e)
 
     def place_order(self, contract, order_type='short', order_style='bracket', take_profit_factor=0.50,
                     stop_loss_factor=3.00, use_vix_position_sizing=True, quantity=1):
@@ -419,62 +503,83 @@ class ShortStrangles:
                     formatDate=1)
                 combo = util.df(combobars)
             avg_price = round(np.nanmean(combo['close']), 2)
-            print(f"{self.get_timestamp()} Order Price: ", avg_price)
+            decided = self.clock()
+            self._logger.info("Order Price: %s", avg_price)
 
             # send the order to IB as a bracket order with a stop loss and take profit
             if order_type == 'short': self.lastEstimatedTradePrice = round(avg_price * 0.995, 2)
             if order_type == 'long': self.lastEstimatedTradePrice = round(avg_price * 1.005, 2)
             self.takeProfitPrice = round(avg_price * take_profit_factor, 2)
             self.stopLossPrice = round(avg_price * stop_loss_factor, 2)
+            self.takeProfitFactor, self.stopLossFactor = take_profit_factor, stop_loss_factor
             what_if_order = LimitOrder('BUY', 1, self.lastEstimatedTradePrice)
 
-            # create a what if order to see what our margin requirements are
-            whatif = self.ib.whatIfOrder(contract, what_if_order)
-            margin = float(whatif.initMarginChange)
-            print(f"{self.get_timestamp()} Initial Margin: ", margin)
+            # estimate our margin requirements locally, the what if order is only sent on the
+            # decision path until the estimate is calibrated against it
+            estimate, local = self.margin_model.estimate('strangle', self.df.close.iloc[-1], self.short_call.strike,
+                                                         self.short_put.strike, avg_price, multiplier=5)
+            initial_margin = float(estimate)
+            verify = self.margin_model.due('strangle')
+            if verify and not self.margin_model.calibrated('strangle'):
+                initial_margin = self.verify_margin(contract, what_if_order, local)
+                verify = False
+            self._logger.info("Initial Margin: %s", initial_margin)
 
             # get the position size based on our account value and margin requirements
-            acc_sum = self.ib.accountSummary()
-            account_value = 0
-            for av in acc_sum:
-                if av.tag == 'AvailableFunds':
-                    account_value = float(av.value)
-                    print(f"{self.get_timestamp()} Account Value: ", account_value)
+            account_value = self.account.get('available_funds')
+            self._logger.info("Account Value: %s", account_value)
 
             # get the position size to default contract quantity if not using VIX position sizing
             position_size = quantity
 
             # get the position size based on VIX position sizing
             if use_vix_position_sizing:
-                if 0.10 <= self.currentIV < 0.15:
-                    position_size = int(np.floor(account_value * 0.25 / margin))
-                    print(f"{self.get_timestamp()} IV is between 10 and 15...\n{self.get_timestamp()} Position size is 25% of account value\n{self.get_timestamp()} Trading {position_size} contracts")
-                if 0.15 <= self.currentIV < 0.20:
-                    position_size = int(np.floor(account_value * 0.30 / margin))
-                    print(f"{self.get_timestamp()} IV is between 15 and 20...\n{self.get_timestamp()} Position size is 30% of account value\n{self.get_timestamp()} Trading {position_size} contracts")
-                if 0.20 <= self.currentIV < 0.30:
-                    position_size = int(np.floor(account_value * 0.35 / margin))
-                    print(f"{self.get_timestamp()} IV is between 20 and 30...\n{self.get_timestamp()} Position size is 35% of account value\n{self.get_timestamp()} Trading {position_size} contracts")
-                if 0.30 <= self.currentIV < 0.40:
-                    position_size = int(np.floor(account_value * 0.40 / margin))
-                    print(f"{self.get_timestamp()} IV is between 30 and 40...\n{self.get_timestamp()} Position size is 40% of account value\n{self.get_timestamp()} Trading {position_size} contracts")
-                if self.currentIV >= 0.40:
-                    position_size = int(np.floor(account_value * 0.50 / margin))
-                    print(f"{self.get_timestamp()} IV is greater than 40...\n{self.get_timestamp()} Position size is 50% of account value\n{self.get_timestamp()} Trading {position_size} contracts")
+                iv = float(np.squeeze(self.currentIV))
+                position_size = int(sizing.iv_bucket_size(iv, account_value, initial_margin, default=quantity))
+                fraction = sizing.iv_fraction(iv)
+                if not np.isnan(fraction):
+                    self._logger.info("IV is %s... Position size is %s%% of account value, trading %s contracts",
+                                      round(iv * 100, 1), int(fraction * 100), position_size)
 
             if order_style == 'bracket':
                 IV_adjusted_bracket = self.ib.bracketOrder('BUY', position_size, self.lastEstimatedTradePrice,
                                                            self.takeProfitPrice,
                                                            self.stopLossPrice)
-                for o in IV_adjusted_bracket:
-                    self.ib.placeOrder(contract, o)
+                trade = self.worker.submit(contract, IV_adjusted_bracket.parent)
+                self.journal.submit(trade, STRATEGY, 'bracket', 'entry', avg_price, decided)
+                for o in (IV_adjusted_bracket.takeProfit, IV_adjusted_bracket.stopLoss):
+                    with latency.span('placeOrder'):
+                        trade = self.guard.placeOrder(contract, o)
+                    self.journal.submit(trade, STRATEGY, 'bracket', 'exit', decided=decided)
             elif order_style == 'limit':
-                self.ib.placeOrder(contract, LimitOrder('BUY', position_size, self.lastEstimatedTradePrice))
+                trade = self.worker.submit(contract, LimitOrder('BUY', position_size, self.lastEstimatedTradePrice))
+                self.journal.submit(trade, STRATEGY, 'limit', 'entry', avg_price, decided)
             elif order_style == 'market':
-                self.ib.placeOrder(contract, MarketOrder('BUY', position_size))
+                with latency.span('placeOrder'):
+                    trade = self.guard.placeOrder(contract, MarketOrder('BUY', position_size))
+                self.journal.submit(trade, STRATEGY, 'market', 'entry', avg_price, decided)
+
+            # periodic check of the calibrated estimate, after the order is out
+            if verify:
+                self.verify_margin(contract, what_if_order, local)
         except Exception as e:
-            print(str(e))
-            print(f"{self.get_timestamp()} Could not place order.")
+            self._logger.error("Could not place order: %s", e)
+
+    def verify_margin(self, contract, order, local):
+
+        '''
+        Ask the broker for the margin of an order and calibrate the local model with the answer
+        :param contract: contract of the order
+        :param order: what if order (1 contract)
+        :param local: raw local margin estimate of the same order
+        :return: the broker's initial margin change
+        '''
+
+        with latency.span('whatIfOrder'):
+            whatif = self.ib.whatIfOrder(contract, order)
+        broker_margin = float(whatif.initMarginChange)
+        self.margin_model.observe('strangle', local, broker_margin)
+        return broker_margin
 
     def trade_strangle(self, call_delta=0.16, put_delta=-0.16, order_type='short', order_style='bracket', days=45,
                        take_profit_factor=0.50, stop_loss_factor=3.00, use_vix_position_sizing=True, quantity=1):
@@ -505,8 +610,7 @@ class ShortStrangles:
                              take_profit_factor=take_profit_factor, stop_loss_factor=stop_loss_factor,
                              use_vix_position_sizing=use_vix_position_sizing, quantity=quantity)
         except Exception as e:
-            print(str(e))
-            print(f"{self.get_timestamp()} Could not trade the strangle.")
+            self._logger.error("Could not trade the strangle: %s", e)
 
     def manage_strangle(self):
         if self.in_trade:  # We are in a trade with no open orders
@@ -516,7 +620,7 @@ class ShortStrangles:
             take care of the take profit and stop loss
             '''
             # get the days to expiration
-            daysToexp = (self.nearestDTE - datetime.date.today()).days
+            daysToexp = (self.nearestDTE - self.clock().date()).days
 
             # get the market price of the combo order
             combobars = self.ib.reqHistoricalData(
@@ -529,44 +633,86 @@ class ShortStrangles:
                 formatDate=1)
             combo = util.df(combobars)
             curr_price = round(np.nanmean(combo['close']), 2)
-            print(f"{self.get_timestamp()} Strangle Price: ", curr_price)
+            decided = self.clock()
+            self._logger.info("Strangle Price: %s", curr_price)
+
+            # worst loss of the book on the scenario grid
+            tail_stop = False
+            if self.scenario_risk is not None:
+                tail_loss, move, shock = self.scenario_risk.worst(self.scenario_move)
+                self._logger.info("Worst Scenario P&L: $%s (underlying %s%%, IV %s pts)", round(tail_loss, 2),
+                                  round(move * 100, 1), round(shock * 100, 1))
+                tail_stop = self.max_scenario_loss is not None and tail_loss < -self.max_scenario_loss
+                if tail_stop:
+                    self._logger.warning("Scenario loss $%s exceeds the $%s limit", round(-tail_loss, 2),
+                                         self.max_scenario_loss)
+
+            # roll instead of closing when a roll rule fires and a legal roll exists
+            if self.roller is not None and not tail_stop:
+                if self.roll is not None:
+                    if self.roll_pending(closing=daysToexp <= 21):
+                        self._logger.info("Waiting on roll fill...")
+                        return
+                elif self.roll_strangle():
+                    return
 
             # if the difference between self.nearestDTE and today is less than 21 days
-            if daysToexp <= 21:
-                print(f"{self.get_timestamp()} Closing Open Strangle Position...")
+            if daysToexp <= 21 or tail_stop:
+                self._logger.info("Closing Open Strangle Position...")
                 # close the position
                 # send the order to IB as a market order
                 order = MarketOrder('SELL', 1)
-                self.ib.placeOrder(self.strangle, order)
-                print(f"{self.get_timestamp()} Position closed at 21DTE for a profit of $" + str(
-                                                round(curr_price - self.lastEstimatedTradePrice, 2)))
+                with latency.span('placeOrder'):
+                    trade = self.guard.placeOrder(self.strangle, order)
+                self.journal.submit(trade, STRATEGY, 'market', 'exit', curr_price, decided)
+                self._logger.info("Position closed at %s for a profit of $%s",
+                                  'the scenario loss limit' if tail_stop else '21DTE',
+                                  round(curr_price - self.lastEstimatedTradePrice, 2))
 
                 # Clean up and cancel all orders
                 self.ib.reqGlobalCancel()
+                if self.roller is not None:
+                    self.roller.close()
+                    self.roll = None
 
                 # reset the local variables
                 self.in_trade = not self.in_trade
                 return
             else:
-                print(f"{self.get_timestamp()} Position is still open...")
-                print(f"{self.get_timestamp()} Days to expiration: ", round(daysToexp), " days")
-                print(f"{self.get_timestamp()} Current Total Open Pnl: $" + str(
-                                                round(curr_price - self.lastEstimatedTradePrice, 2)))
+                self._logger.info("Position is still open...")
+                self._logger.info("Days to expiration: %s days", round(daysToexp))
+                self._logger.info("Current Total Open Pnl: $%s", round(curr_price - self.lastEstimatedTradePrice, 2))
+                self._logger.info("Portfolio Greeks: %s", {k: round(v, 2) for k, v in self.greeks.total.items()})
                 return
         elif not self.in_trade and self.order_placed:  # Waiting on order fill
-            print(f"{self.get_timestamp()} Waiting on order fill...")
+            self._logger.info("Waiting on order fill...")
             return
         else:  # Catch all... There's something wrong
-            print(f"{self.get_timestamp()} Something went wrong...")
+            self._logger.warning("Something went wrong...")
             return
 
     # On Bar Update, when we get new data
+    @latency.timed()
     def on_bar_update(self, bars: BarDataList, has_new_bar: bool):
+        # Reprice the open legs on every bar, and while a hedge is still held so it can be unwound
+        if self.greeks.count or (self.hedger is not None and self.hedger.position):
+            try:
+                self.greeks.update(self.underlying.symbol, bars[-1].close, self.clock())
+                self.scenario_risk = scenarios.scenario_grid(self.greeks, self.clock())
+            except Exception as e:
+                self._logger.error("Could not update portfolio greeks: %s", e)
+        else:
+            self.scenario_risk = None
+        # the guard marks the account off the repriced book
+        self.guard.on_tick()
+        # step the working entry orders here too, in case no event loop is running them
+        if self.worker.working:
+            self.worker.step()
         self.bar_count += 1
         if self.bar_count == 5:
             self.bar_count = 0
             try:
-                print(f"{self.get_timestamp()} New Bar Received...")
+                self._logger.info("New Bar Received...")
                 # Convert the BarDataList to a Pandas DataFrame
                 self.df = util.df(self.data)
                 # Check if we are in a trade and no open orders
@@ -578,11 +724,18 @@ class ShortStrangles:
                 else:
                     # Manage the strangle
                     self.manage_strangle()
+                self.startup.mark('first_decision')
             except Exception as e:
-                print(str(e))
-                print(f"{self.get_timestamp()} Could not update bars.")
+                self._logger.error("Could not update bars: %s", e)
 
     def exec_status(self, trade: Trade, fill: Fill):
+        self.book_fill(trade, fill)
+        # IB reports an execution per combo leg and one for the combo, only the combo's carries the combo price
+        if trade.contract.secType != 'BAG' or fill.contract.secType != 'BAG':
+            return
+        if trade.order.orderRef == 'roll':
+            self.roll_filled(trade, fill)
+            return
         # Add the order to the log
         conId = trade.contract.comboLegs[0].conId
         self.trade_log.append(conId)
@@ -590,13 +743,220 @@ class ShortStrangles:
         current_unique_trades = len(set(self.trade_log))
         # Check if a new unique order is added
         if current_unique_trades > self.previous_unique_trades:
-            print(f"{self.get_timestamp()} New Trade Created")
+            self._logger.info("New Trade Created")
             self.previous_unique_trades = current_unique_trades
             self.order_placed = not self.order_placed
             self.in_trade = not self.in_trade
-            print(f"{self.get_timestamp()} Trade Executed: " + str(trade))
-            print(f"{self.get_timestamp()} Fill: " + str(fill))
+            if self.in_trade:
+                # P&L is measured from the worked fill, not the estimate the order started from
+                self.lastEstimatedTradePrice = fill.execution.price
+            if self.roller is not None and self.in_trade:
+                self.roller.open(self.short_call.strike, self.short_put.strike, self.nearestDTE, -fill.execution.price,
+                                 self.df.close.iloc[-1], float(np.squeeze(self.currentIV)), self.clock())
+            self._logger.info("Trade Executed: %s", trade)
+            self._logger.info("Fill: %s", fill)
+
+
+    def book_fill(self, trade: Trade, fill: Fill):
+
+        '''
+        Apply a combo fill to the portfolio greeks book
+        :param trade: trade of the combo order
+        :param fill: fill of the combo (leg executions are skipped, the combo fill covers them)
+        '''
+
+        try:
+            if fill.contract.secType != 'BAG':
+                return
+            side = 1 if fill.execution.side == 'BOT' else -1
+            position = '+'.join(str(leg.conId) for leg in trade.contract.comboLegs)
+            for leg in trade.contract.comboLegs:
+                contract = self.leg_contracts.get(leg.conId)
+                if contract is None:
+                    self._logger.warning("No contract for leg %s, greeks not updated", leg.conId)
+                    continue
+                quantity = side * (1 if leg.action == 'BUY' else -1) * leg.ratio * fill.execution.shares
+                self.greeks.add_leg(leg.conId, self.underlying.symbol, contract.right, contract.strike,
+                                    contract.lastTradeDateOrContractMonth, quantity, float(np.squeeze(self.currentIV)),
+                                    multiplier=float(contract.multiplier or 100), position=position)
+        except Exception as e:
+            self._logger.error("Could not update portfolio greeks: %s", e)
+
+    def roll_strangle(self):
+
+        '''
+        Check the roll rules and send the best roll of the open strangle as one combo:
+        buy back the legs being rolled and sell their replacements
+        :return: True if a roll order was sent
+        '''
+
+        try:
+            chain = next(c for c in self.chains if c.exchange == 'CME')
+            roll = self.roller.check(chain.strikes, chain.expirations, self.df.close.iloc[-1],
+                                     float(np.squeeze(self.currentIV)), self.clock())
+            if roll is None:
+                return False
+            self._logger.info("Rolling (%s) to %s/%s %s for a model credit of %s (delta %s, risk $%s)",
+                              roll['kind'], roll['call_strike'], roll['put_strike'], roll['expiry'],
+                              round(roll['credit'], 2), round(roll['delta'], 2), round(roll['risk'], 2))
+
+            # the new legs
+            expiry = roll['expiry'].strftime('%Y%m%d')
+            new_legs = []
+            if roll['roll_call']:
+                new_legs.append(Option(self.underlying.symbol, expiry, roll['call_strike'], 'C', 'SMART', '100', 'USD'))
+            if roll['roll_put']:
+                new_legs.append(Option(self.underlying.symbol, expiry, roll['put_strike'], 'P', 'SMART', '100', 'USD'))
+            with latency.span('qualifyContracts'):
+                self.ib.qualifyContracts(*new_legs)
+            for contract in new_legs:
+                self.leg_contracts[contract.conId] = contract
+            old_legs = ([self.short_call] if roll['roll_call'] else []) + ([self.short_put] if roll['roll_put'] else [])
+
+            # make the roll combo
+            combo = Contract()
+            combo.symbol = self.underlying.symbol
+            combo.secType = 'BAG'
+            combo.currency = self.short_call.currency
+            combo.exchange = self.short_call.exchange
+            combo.comboLegs = []
+            for contract, action in [(c, 'BUY') for c in old_legs] + [(c, 'SELL') for c in new_legs]:
+                leg = ComboLeg()
+                leg.conId = contract.conId
+                leg.ratio = 1
+                leg.action = action
+                leg.exchange = contract.exchange
+                combo.comboLegs.append(leg)
+
+            # work it at the market mid, as long as that still takes in the minimum credit
+            combobars = self.ib.reqHistoricalData(
+                contract=combo,
+                endDateTime='',
+                durationStr='60 s',
+                barSizeSetting='1 secs',
+                whatToShow='MIDPOINT',
+                useRTH=True,
+                formatDate=1)
+            combo_df = util.df(combobars)
+            price = round(np.nanmean(combo_df['close']), 2) if combo_df is not None else round(-roll['credit'], 2)
+            decided = self.clock()
+            if -price <= self.roller.min_credit:
+                self._logger.info("Roll skipped, the market credit %s is not above the minimum", -price)
+                return False
+
+            # the exits stay on the current legs until the roll has filled (roll_filled moves them)
+            self.roll = dict(roll, legs=new_legs, submitted=decided, trade=None)
+            try:
+                # worked toward the natural, but never to less than the minimum credit
+                trade = self.worker.submit(combo, LimitOrder('BUY', self.roller.position.quantity, price,
+                                                             orderRef='roll'), limit=-self.roller.min_credit)
+            except Exception:
+                self.roll = None
+                raise
+            if self.roll is not None:
+                self.roll['trade'] = trade
+            self.journal.submit(trade, STRATEGY, 'limit', 'roll', price, decided)
+            return True
+        except Exception as e:
+            self._logger.error("Could not roll the strangle: %s", e)
+            return False
 
+    def place_exits(self, value, quantity, group):
 
-# create the bot
-ShortStrangles()
+        '''
+        Take profit and stop loss of the open strangle as a one-cancels-all pair, priced off its value the way
+        place_order prices the bracket off the entry
+        :param value: value of the strangle per share
+        :param quantity: strangles held
+        :param group: OCA group of the pair
+        :return: None
+        '''
+
+        self.takeProfitPrice = round(-value * self.takeProfitFactor, 2)
+        self.stopLossPrice = round(-value * self.stopLossFactor, 2)
+        decided = self.clock()
+        for order in (LimitOrder('SELL', quantity, self.takeProfitPrice),
+                      StopOrder('SELL', quantity, self.stopLossPrice)):
+            order.ocaGroup, order.ocaType = group, 1
+            try:
+                with latency.span('placeOrder'):
+                    trade = self.guard.placeOrder(self.strangle, order)
+                self.journal.submit(trade, STRATEGY, 'bracket', 'exit', decided=decided)
+            except Exception as e:
+                self._logger.error("Could not place the exit: %s", e)
+
+    def roll_pending(self, closing=False):
+
+        '''
+        Check on the roll waiting on its fill, giving up on it once it is cancelled or past roll_timeout, or when the
+        position is due to close and the roll is not the roll out that replaces that close
+        :param closing: the position has reached its time exit
+        :return: True while the roll is still worth waiting on
+        '''
+
+        trade = self.roll['trade']
+        if trade is None or trade.orderStatus.status == 'Filled':
+            # the fill is on its way to roll_filled
+            return True
+        expired = (self.clock() - self.roll['submitted']).total_seconds() > self.roll_timeout
+        if not trade.isDone() and not expired and not (closing and self.roll['kind'] != 'out'):
+            return True
+        if not trade.isDone():
+            self.ib.cancelOrder(trade.order)
+        self._logger.warning("Roll (%s) given up (%s), the exits stay on the current legs", self.roll['kind'],
+                             'not filled' if trade.isDone() else 'timed out' if expired else 'closing')
+        self.roll = None
+        return False
+
+    def roll_filled(self, trade: Trade, fill: Fill):
+
+        '''
+        A roll filled: move the strangle onto its new legs
+        '''
+
+        roll, self.roll = self.roll, None
+        if roll is None:
+            return
+        self.roller.rolled(roll, -fill.execution.price, self.clock())
+        # the strangle's P&L carries the roll's credit or debit
+        self.lastEstimatedTradePrice = round(self.lastEstimatedTradePrice + fill.execution.price, 2)
+        for contract in roll['legs']:
+            if contract.right == 'C':
+                self.short_call = contract
+            else:
+                self.short_put = contract
+        self.nearestDTE = roll['expiry']
+        # the exits of the replaced legs go with them
+        for open_trade in self.ib.openTrades():
+            order = open_trade.order
+            if open_trade.contract.secType == 'BAG' and order.orderRef != 'roll' and (order.parentId or order.ocaGroup):
+                self.ib.cancelOrder(order)
+        legs = [ComboLeg(conId=contract.conId, ratio=leg.ratio, action=leg.action, exchange=leg.exchange)
+                for leg, contract in zip(self.strangle.comboLegs, (self.short_call, self.short_put))]
+        self.strangle = Contract(symbol=self.strangle.symbol, secType='BAG', currency=self.strangle.currency,
+                                 exchange=self.strangle.exchange, comboLegs=legs)
+        # the rolled strangle is the same trade to the order and fill logs
+        self.open_order_log.append(self.strangle.comboLegs[0].conId)
+        self.previous_unique_orders = len(set(self.open_order_log))
+        self.trade_log.append(self.strangle.comboLegs[0].conId)
+        self.previous_unique_trades = len(set(self.trade_log))
+        # and it is managed like a new entry: a take profit and a stop loss on its value
+        self.place_exits(roll['call_value'] + roll['put_value'], trade.order.totalQuantity,
+                         f"exits_{trade.order.orderId}")
+        self._logger.info("Roll filled at %s, strangle now %s/%s %s", fill.execution.price, self.short_call.strike,
+                          self.short_put.strike, self.nearestDTE)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=ShortStrangles.__doc__)
+    profiler.add_arguments(parser)
+    parser.add_argument('--delta-hedge', action='store_true', help='hedge the net delta of the book in the underlying')
+    parser.add_argument('--max-daily-loss', type=float, help='halt and flatten after losing this many dollars in a day')
+    parser.add_argument('--max-contracts', type=int, help='most option contracts open across all legs')
+    parser.add_argument('--roll', action='store_true', help='roll the strangle by the roll rules instead of only closing it')
+    args = parser.parse_args()
+
+    # create the bot
+    log.setup_logging(level='INFO')
+    ShortStrangles(profiler=profiler.from_args(args, logger=logging.getLogger(__name__)), delta_hedge=args.delta_hedge,
+                   roll=args.roll, max_daily_loss=args.max_daily_loss, max_contracts=args.max_contracts)
@@ -0,0 +1,228 @@
+"""
+CHAIN_DATA.PY
+Columnar on-disk format for historical option chain snapshots.
+
+A chain data set is a directory holding one raw little-endian binary file per
+column plus a meta.json describing the dtypes and row count. Files are appended
+chunk by chunk while writing and memory-mapped read-only while reading, so a
+backtest over years of chains touches only the pages it actually slices.
+
+Rows are sorted by (date, expiry, right, strike). Dates and expiries are stored
+as int32 days since 1970-01-01, rights as int8 (+1 call, -1 put).
+"""
+
+import json
+import os
+
+import numpy as np
+
+FORMAT_VERSION = 1
+
+# column name -> dtype, in the order the columns are documented above
+COLUMNS = {
+    'date': 'int32',
+    'expiry': 'int32',
+    'right': 'int8',
+    'strike': 'float64',
+    'bid': 'float64',
+    'ask': 'float64',
+    'iv': 'float64',
+    'delta': 'float64',
+    'underlying': 'float64',
+}
+
+CALL = 1
+PUT = -1
+
+_EPOCH = np.datetime64('1970-01-01', 'D')
+
+# strike resolution of the composite row key (1/100 of a point)
+_STRIKE_SCALE = 100
+_STRIKE_SPAN = 10_000_000
+
+
+def to_days(dates):
+
+    '''
+    Convert dates to int32 days since 1970-01-01
+    :param dates: datetime64 values, datetime.date objects or 'YYYY-MM-DD'/'YYYYMMDD' strings
+    :return: int32 array
+    '''
+
+    values = np.asarray(dates)
+    if values.dtype.kind in 'iu':
+        return values.astype(np.int32)
+    if values.dtype.kind in 'US' and values.size and len(str(values.flat[0])) == 8:
+        values = np.array([f"{v[:4]}-{v[4:6]}-{v[6:]}" for v in values.astype(str).ravel()]).reshape(values.shape)
+    return (values.astype('datetime64[D]') - _EPOCH).astype(np.int32)
+
+
+def from_days(days):
+
+    '''
+    Convert int days since 1970-01-01 back to datetime64[D]
+    :param days: int array
+    :return: datetime64[D] array
+    '''
+
+    return _EPOCH + np.asarray(days).astype('timedelta64[D]')
+
+
+def row_key(expiry, right, strike):
+
+    '''
+    Composite sort key of rows within one date, ordered like the file (expiry, right, strike)
+    :return: int64 array
+    '''
+
+    expiry = np.asarray(expiry, dtype=np.int64)
+    is_call = (np.asarray(right) > 0).astype(np.int64)
+    strike = np.rint(np.asarray(strike, dtype=float) * _STRIKE_SCALE).astype(np.int64)
+    return (expiry * 2 + is_call) * _STRIKE_SPAN + strike
+
+
+def sort_order(date, expiry, right, strike):
+    # lexsort sorts by the last key first
+    return np.lexsort((np.asarray(strike), np.asarray(right) > 0, np.asarray(expiry), np.asarray(date)))
+
+
+class ChainWriter:
+
+    '''
+    Append sorted chunks of chain rows to a chain data directory
+    :param path: output directory (created if needed)
+    :param append: keep existing rows and append after them
+    '''
+
+    def __init__(self, path, append=False):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.rows = 0
+        self.last_date = None
+        if append and os.path.exists(os.path.join(path, 'meta.json')):
+            meta = read_meta(path)
+            self.rows = meta['rows']
+            if self.rows:
+                self.last_date = int(np.memmap(os.path.join(path, 'date.bin'), dtype=COLUMNS['date'], mode='r',
+                                               shape=(self.rows,))[-1])
+        else:
+            for name in COLUMNS:
+                open(os.path.join(path, f'{name}.bin'), 'wb').close()
+
+    def append(self, **columns):
+
+        '''
+        Append a chunk of rows. The chunk is sorted internally and must not start before the last date written.
+        Missing optional columns (iv, delta) are filled with NaN.
+        :param columns: one array per column in COLUMNS
+        :return: number of rows written
+        '''
+
+        n = len(columns['date'])
+        if n == 0:
+            return 0
+        data = {}
+        for name, dtype in COLUMNS.items():
+            if name in ('date', 'expiry'):
+                data[name] = to_days(columns[name])
+            elif name in columns:
+                data[name] = np.asarray(columns[name], dtype=dtype)
+            elif name in ('iv', 'delta'):
+                data[name] = np.full(n, np.nan)
+            else:
+                raise ValueError(f"missing column '{name}'")
+        order = sort_order(data['date'], data['expiry'], data['right'], data['strike'])
+        if self.last_date is not None and data['date'][order[0]] < self.last_date:
+            raise ValueError("chunks must be appended in date order")
+        for name, values in data.items():
+            with open(os.path.join(self.path, f'{name}.bin'), 'ab') as f:
+                np.ascontiguousarray(values[order]).astype(values.dtype.newbyteorder('<'), copy=False).tofile(f)
+        self.rows += n
+        self.last_date = int(data['date'][order[-1]])
+        self._write_meta()
+        return n
+
+    def _write_meta(self):
+        meta = {'version': FORMAT_VERSION, 'rows': self.rows, 'columns': COLUMNS}
+        tmp = os.path.join(self.path, 'meta.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(meta, f, indent=2)
+        os.replace(tmp, os.path.join(self.path, 'meta.json'))
+
+    def close(self):
+        self._write_meta()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def write_chains(path, **columns):
+
+    '''
+    Write a complete chain data set in one call
+    :param path: output directory
+    :param columns: one array per column in COLUMNS
+    :return: number of rows written
+    '''
+
+    with ChainWriter(path) as writer:
+        return writer.append(**columns)
+
+
+def read_meta(path):
+    with open(os.path.join(path, 'meta.json')) as f:
+        return json.load(f)
+
+
+def load_chains(path):
+
+    '''
+    Memory-map every column of a chain data set
+    :param path: chain data directory
+    :return: dict of column name -> read-only array
+    '''
+
+    meta = read_meta(path)
+    rows = meta['rows']
+    columns = {}
+    for name, dtype in meta['columns'].items():
+        if rows == 0:
+            columns[name] = np.empty(0, dtype=dtype)
+        else:
+            columns[name] = np.memmap(os.path.join(path, f'{name}.bin'), dtype=np.dtype(dtype).newbyteorder('<'),
+                                      mode='r', shape=(rows,))
+    return columns
+
+
+def day_index(date):
+
+    '''
+    Locate the contiguous block of rows for every date
+    :param date: sorted date column
+    :return: (days, starts, ends) arrays, rows of days[i] are date[starts[i]:ends[i]]
+    '''
+
+    date = np.asarray(date)
+    if date.size == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return date[:0], empty, empty
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(date)) + 1))
+    ends = np.append(starts[1:], date.size)
+    return np.asarray(date[starts]), starts, ends
+
+
+def mid(bid, ask):
+
+    '''
+    Quote midpoint, falling back to whichever side is present
+    :return: float array
+    '''
+
+    bid = np.asarray(bid, dtype=float)
+    ask = np.asarray(ask, dtype=float)
+    both = (bid > 0) & (ask > 0)
+    return np.where(both, 0.5 * (bid + ask), np.where(ask > 0, ask, bid))
@@ -0,0 +1,364 @@
+"""
+CHAIN_STORE.PY
+Memory-mapped, indexed store of historical option chain snapshots.
+
+Sits on top of a chain_data directory (rows sorted by date, expiry, right,
+strike) and adds a persisted two level index:
+  * days        -> first row of every date,
+  * (date, expiry) blocks -> first row of every expiration on every date.
+Looking up "all puts expiring nearest 45 DTE on date D" is a binary search
+for D, a binary search over D's expirations and a split of that block at
+the put/call boundary. The result is a dict of read-only views into the
+memory-mapped columns; nothing is copied and no DataFrame is built.
+
+The ingestion tools write stores from vendor CSV files (CBOE DataShop style
+long format out of the box, any other layout with a column map) and from the
+JSON-lines logs the live bots write, which carry an 'option_quote' record
+every time a chain IV is sampled.
+"""
+
+import argparse
+import glob
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+import chain_data
+
+INDEX_VERSION = 1
+
+# timezone the trading date of a live capture is taken in
+EXCHANGE_TZ = 'America/New_York'
+
+# Vendor CSV layouts: store column -> vendor column
+CSV_PRESETS = {
+    # CBOE DataShop option EOD summary / calcs
+    'cboe': {'date': 'quote_date', 'expiry': 'expiration', 'right': 'option_type', 'strike': 'strike',
+             'bid': 'bid_1545', 'ask': 'ask_1545', 'iv': 'implied_volatility_1545', 'delta': 'delta_1545',
+             'underlying': 'active_underlying_price_1545'},
+    # already in store layout
+    'store': {name: name for name in chain_data.COLUMNS},
+}
+
+
+class ChainStore:
+
+    '''
+    Indexed, zero-copy access to a chain data directory
+    :param path: chain data directory, the index is built on first use and rebuilt when stale
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.columns = chain_data.load_chains(path)
+        self.rows = chain_data.read_meta(path)['rows']
+        index = load_index(path)
+        if index is None or index['rows'] != self.rows:
+            index = build_index(path)
+        self.days = index['days']
+        self.day_starts = index['day_starts']
+        self.block_day = index['block_day']
+        self.block_expiry = index['block_expiry']
+        self.block_starts = index['block_starts']
+        self.block_calls = index['block_calls']
+
+    def __len__(self):
+        return self.rows
+
+    @property
+    def dates(self):
+        return chain_data.from_days(self.days)
+
+    def _day(self, date):
+        day = int(chain_data.to_days([date])[0])
+        i = np.searchsorted(self.days, day)
+        if i == self.days.size or self.days[i] != day:
+            raise KeyError(f"no chain stored for {chain_data.from_days(day)}")
+        return day, i
+
+    def _blocks(self, i):
+        # index range of the (date, expiry) blocks of the i-th day
+        return np.searchsorted(self.block_starts, self.day_starts[i]), \
+            np.searchsorted(self.block_starts, self._day_end(i))
+
+    def _day_end(self, i):
+        return self.day_starts[i + 1] if i + 1 < self.day_starts.size else self.rows
+
+    def _block_end(self, b):
+        return self.block_starts[b + 1] if b + 1 < self.block_starts.size else self.rows
+
+    def _view(self, lo, hi):
+        return {name: column[lo:hi] for name, column in self.columns.items()}
+
+    def day(self, date):
+
+        '''
+        Every row of one date
+        :param date: anything chain_data.to_days accepts
+        :return: dict of column views
+        '''
+
+        _, i = self._day(date)
+        return self._view(self.day_starts[i], self._day_end(i))
+
+    def expiries(self, date):
+
+        '''
+        Expirations listed on a date
+        :return: datetime64[D] array
+        '''
+
+        _, i = self._day(date)
+        b0, b1 = self._blocks(i)
+        return chain_data.from_days(self.block_expiry[b0:b1])
+
+    def nearest_expiry(self, date, days):
+
+        '''
+        Listed expiration nearest to `days` calendar days after `date`
+        :return: datetime64[D]
+        '''
+
+        day, i = self._day(date)
+        b0, b1 = self._blocks(i)
+        listed = self.block_expiry[b0:b1]
+        return chain_data.from_days(listed[np.argmin(np.abs(listed - (day + days)))])
+
+    def slice(self, date, expiry, right=None, strike_lo=None, strike_hi=None):
+
+        '''
+        Rows of one expiration on one date, optionally one right and a strike range
+        :param date: quote date
+        :param expiry: expiration date
+        :param right: 'C'/'P' (or +1/-1), None for both
+        :param strike_lo: lowest strike to include
+        :param strike_hi: highest strike to include
+        :return: dict of column views sorted by strike (puts before calls when right is None)
+        '''
+
+        _, i = self._day(date)
+        b0, b1 = self._blocks(i)
+        exp = int(chain_data.to_days([expiry])[0])
+        b = b0 + np.searchsorted(self.block_expiry[b0:b1], exp)
+        if b == b1 or self.block_expiry[b] != exp:
+            raise KeyError(f"{chain_data.from_days(exp)} not listed on {chain_data.from_days(self.days[i])}")
+        lo, hi = int(self.block_starts[b]), int(self._block_end(b))
+        if right is not None:
+            call = _is_call(right)
+            split = int(self.block_calls[b])
+            lo, hi = (split, hi) if call else (lo, split)
+        if strike_lo is not None or strike_hi is not None:
+            strikes = self.columns['strike'][lo:hi]
+            new_lo = lo + (np.searchsorted(strikes, strike_lo) if strike_lo is not None else 0)
+            hi = lo + (np.searchsorted(strikes, strike_hi, side='right') if strike_hi is not None else hi - lo)
+            lo = new_lo
+        return self._view(lo, hi)
+
+    def nearest_dte(self, date, days, right=None):
+
+        '''
+        Rows of the expiration nearest `days` out, e.g. all puts nearest 45 DTE on a date
+        :return: dict of column views
+        '''
+
+        return self.slice(date, self.nearest_expiry(date, days), right=right)
+
+    def quote(self, date, expiry, right, strike):
+
+        '''
+        Single contract lookup
+        :return: dict of scalars, or None when the contract is not listed
+        '''
+
+        rows = self.slice(date, expiry, right, strike, strike)
+        if len(rows['strike']) == 0:
+            return None
+        return {name: column[0].item() for name, column in rows.items()}
+
+
+def _is_call(right):
+    if isinstance(right, str):
+        return right.upper().startswith('C')
+    return right > 0
+
+
+def build_index(path):
+
+    '''
+    Build and persist the day and (date, expiry) block index of a chain data directory
+    :param path: chain data directory
+    :return: dict of index arrays
+    '''
+
+    columns = chain_data.load_chains(path)
+    rows = chain_data.read_meta(path)['rows']
+    date, expiry, right = columns['date'], columns['expiry'], columns['right']
+    days, day_starts, _ = chain_data.day_index(date)
+    if rows:
+        change = np.flatnonzero((np.diff(date) != 0) | (np.diff(expiry) != 0)) + 1
+        block_starts = np.concatenate(([0], change)).astype(np.int64)
+        block_ends = np.append(block_starts[1:], rows)
+        # puts sort before calls inside a block, the first call row splits it
+        calls = np.asarray(right) > 0
+        first_call = np.flatnonzero(calls[:-1] != calls[1:]) + 1
+        pos = np.searchsorted(first_call, block_starts, side='right')
+        candidate = np.append(first_call, rows)[pos]
+        block_calls = np.where(calls[block_starts], block_starts, np.minimum(candidate, block_ends))
+    else:
+        block_starts = block_calls = np.empty(0, dtype=np.int64)
+    index = {
+        'rows': rows,
+        'days': np.asarray(days, dtype=np.int32),
+        'day_starts': np.asarray(day_starts, dtype=np.int64),
+        'block_day': np.asarray(date[block_starts], dtype=np.int32),
+        'block_expiry': np.asarray(expiry[block_starts], dtype=np.int32),
+        'block_starts': block_starts,
+        'block_calls': np.asarray(block_calls, dtype=np.int64),
+    }
+    np.savez(os.path.join(path, 'index.npz'), version=INDEX_VERSION, **index)
+    return index
+
+
+def load_index(path):
+    file = os.path.join(path, 'index.npz')
+    if not os.path.exists(file):
+        return None
+    with np.load(file) as data:
+        if int(data['version']) != INDEX_VERSION:
+            return None
+        index = {name: data[name] for name in data.files if name != 'version'}
+    index['rows'] = int(index['rows'])
+    return index
+
+
+def _normalize(frame, columns):
+    # vendor frame -> store columns
+    data = {}
+    for name, source in columns.items():
+        data[name] = frame[source].to_numpy() if source in frame else None
+    right = data['right']
+    if right.dtype.kind in 'OUS':
+        data['right'] = np.where(pd.Series(right).astype(str).str.upper().str.startswith('C'), chain_data.CALL,
+                                 chain_data.PUT)
+    for name in ('date', 'expiry'):
+        data[name] = pd.to_datetime(data[name]).to_numpy().astype('datetime64[D]')
+    return {k: v for k, v in data.items() if v is not None}
+
+
+def ingest_csv(paths, store, preset='cboe', columns=None, append=False):
+
+    '''
+    Write a store from vendor CSV files
+    :param paths: CSV files (glob patterns allowed), each sorted or at least not overlapping in dates
+    :param store: output chain data directory
+    :param preset: key of CSV_PRESETS
+    :param columns: explicit store column -> vendor column map, overrides the preset
+    :param append: append after the rows already in the store
+    :return: number of rows in the store
+    '''
+
+    mapping = dict(CSV_PRESETS[preset])
+    mapping.update(columns or {})
+    files = sorted(f for p in ([paths] if isinstance(paths, str) else paths) for f in glob.glob(p))
+    frames = []
+    for file in files:
+        frame = pd.read_csv(file, usecols=lambda c: c in mapping.values())
+        data = _normalize(frame, mapping)
+        frames.append((data['date'].min(), data))
+    with chain_data.ChainWriter(store, append=append) as writer:
+        for _, data in sorted(frames, key=lambda f: f[0]):
+            writer.append(**data)
+        rows = writer.rows
+    build_index(store)
+    return rows
+
+
+def read_captures(paths, tz=EXCHANGE_TZ):
+
+    '''
+    Collect the option_quote records from live bot JSON-lines logs
+    :param paths: log files (glob patterns allowed)
+    :param tz: timezone of the exchange, the capture times are dated in it
+    :return: DataFrame in store layout
+    '''
+
+    records = []
+    files = sorted(f for p in ([paths] if isinstance(paths, str) else paths) for f in glob.glob(p))
+    for file in files:
+        with open(file) as f:
+            for line in f:
+                if '"option_quote"' not in line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get('event') == 'option_quote':
+                    records.append(record)
+    frame = pd.DataFrame(records)
+    if frame.empty:
+        return frame
+    # epochs are UTC, where an evening capture in New York already falls on the next day
+    local = pd.to_datetime(frame['epoch'], unit='s', utc=True).dt.tz_convert(tz).dt.tz_localize(None)
+    frame['date'] = local.dt.normalize()
+    # keep the last capture of each contract per day
+    frame = frame.sort_values('epoch').drop_duplicates(['date', 'expiry', 'right', 'strike'], keep='last')
+    return frame
+
+
+def ingest_captures(paths, store, append=False):
+
+    '''
+    Write a store from live session captures (the bots' JSON-lines logs)
+    :param paths: log files (glob patterns allowed)
+    :param store: output chain data directory
+    :param append: append after the rows already in the store
+    :return: number of rows in the store
+    '''
+
+    frame = read_captures(paths)
+    with chain_data.ChainWriter(store, append=append) as writer:
+        if not frame.empty:
+            writer.append(**_normalize(frame, {name: name for name in chain_data.COLUMNS}))
+        rows = writer.rows
+    build_index(store)
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build and query memory-mapped option chain stores')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    csv_cmd = commands.add_parser('ingest-csv', help='ingest vendor CSV files')
+    csv_cmd.add_argument('store')
+    csv_cmd.add_argument('files', nargs='+')
+    csv_cmd.add_argument('--preset', choices=sorted(CSV_PRESETS), default='cboe')
+    csv_cmd.add_argument('--column', action='append', default=[], metavar='STORE=VENDOR',
+                         help='override a column mapping, e.g. --column bid=Bid')
+    csv_cmd.add_argument('--append', action='store_true')
+
+    log_cmd = commands.add_parser('ingest-log', help='ingest live session JSON-lines logs')
+    log_cmd.add_argument('store')
+    log_cmd.add_argument('files', nargs='+')
+    log_cmd.add_argument('--append', action='store_true')
+
+    query_cmd = commands.add_parser('query', help='print the chain nearest a DTE on a date')
+    query_cmd.add_argument('store')
+    query_cmd.add_argument('date')
+    query_cmd.add_argument('--days', type=int, default=45)
+    query_cmd.add_argument('--right', choices=['C', 'P'])
+    args = parser.parse_args()
+
+    if args.command == 'ingest-csv':
+        overrides = dict(c.split('=', 1) for c in args.column)
+        print(f"{ingest_csv(args.files, args.store, args.preset, overrides, args.append):,} rows in {args.store}")
+    elif args.command == 'ingest-log':
+        print(f"{ingest_captures(args.files, args.store, args.append):,} rows in {args.store}")
+    else:
+        rows = ChainStore(args.store).nearest_dte(args.date, args.days, args.right)
+        frame = pd.DataFrame({name: np.asarray(column) for name, column in rows.items()})
+        for name in ('date', 'expiry'):
+            frame[name] = chain_data.from_days(frame[name].to_numpy())
+        print(frame.to_string(index=False))
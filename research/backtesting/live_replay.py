@@ -0,0 +1,164 @@
+"""
+LIVE_REPLAY.PY
+Backtest the live bot itself: replay intraday bars through ShortStrangles.
+
+strangle_backtest.py and the QuantConnect port re-implement the strategy
+rules, so they can drift away from what actually trades. This harness loads
+the live bot file unchanged, hands it a simulated broker (sim_broker.SimIB)
+and a virtual clock, and lets connect_to_ibkr() run as it does live:
+qualifyContracts, the keepUpToDate bar stream, reqSecDefOptParams, then
+ib.run(), which here replays every remaining bar through on_bar_update and
+returns. trade_strangle, find_strangle, place_order (whatIfOrder,
+accountSummary, the bracket), manage_strangle, exec_status and
+on_open_order_update are all the live code paths; only the broker is fake.
+"""
+
+import argparse
+import importlib.util
+import os
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'models'))
+from common import log
+
+import chain_store
+import sim_broker
+
+DEFAULT_BOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'models', 'equities', 'Release',
+                           'short_strangles_4.11.23.py')
+
+
+class ReplayResult:
+
+    '''
+    Output of a replay
+    :param bot: the strategy object after the replay
+    :param ib: the SimIB it traded against
+    :param elapsed: wall clock seconds
+    :param output_dir: directory of the bot's margin calibration, order journal and latency file
+    '''
+
+    def __init__(self, bot, ib, elapsed, output_dir=None):
+        self.bot = bot
+        self.ib = ib
+        self.output_dir = output_dir
+        self.fills = ib.fills_frame()
+        self.equity = ib.equity_curve()
+        self.elapsed = elapsed
+
+    def stats(self):
+        equity = self.equity
+        return {
+            'fills': len(self.fills),
+            'orders': len(self.ib.trades),
+            'total_pnl': round(float(equity.iloc[-1] - equity.iloc[0]), 2) if len(equity) else 0.0,
+            'max_drawdown': round(float((equity - equity.cummax()).min()), 2) if len(equity) else 0.0,
+            'open_positions': len(self.ib.positions),
+            'seconds': round(self.elapsed, 2),
+        }
+
+
+def load_bot(path=DEFAULT_BOT, name='ShortStrangles'):
+
+    '''
+    Import a bot file by path (the release file names are not importable module names)
+    :param path: python file of the bot
+    :param name: strategy class in it
+    :return: the class
+    '''
+
+    spec = importlib.util.spec_from_file_location(f"live_bot_{abs(hash(path))}", path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return getattr(module, name)
+
+
+def replay(bars, chains, bot_path=DEFAULT_BOT, account_value=100000.0, exchange='SMART', multiplier=100,
+           underlying_multiplier=1, commission=0.65, spread=0.0, warmup_bars=390, delta_hedge=False, roll=False,
+           max_daily_loss=None, max_contracts=None, output_dir=None):
+
+    '''
+    Run the live bot over historical bars against a simulated broker
+    :param bars: DataFrame of 1 minute underlying bars, DatetimeIndex and open/high/low/close(/volume) columns
+    :param chains: chain data directory (or ChainStore) of the underlying's options
+    :param bot_path: bot file to load
+    :param account_value: starting cash
+    :param exchange: exchange the bot looks for in reqSecDefOptParams
+    :param multiplier: option contract multiplier
+    :param underlying_multiplier: multiplier of the underlying, used when the bot hedges in it
+    :param commission: commission per contract per leg
+    :param spread: quoted bid/ask width of each option leg, limit orders have to cross it to fill
+    :param warmup_bars: bars in the initial backfill, not replayed through on_bar_update
+    :param delta_hedge: run the bot with delta hedging in the underlying
+    :param roll: run the bot with roll management
+    :param max_daily_loss: the bot's daily loss limit in dollars
+    :param max_contracts: the bot's limit on open option contracts
+    :param output_dir: directory for the files the bot writes (margin calibration, order journal, latency), a new
+        temporary directory by default so a replay never touches the live ones
+    :return: ReplayResult
+    '''
+
+    store = chains if hasattr(chains, 'day_starts') else chain_store.ChainStore(chains)
+    clock = sim_broker.SimClock()
+    ib = sim_broker.SimIB(store, bars, clock, account_value=account_value, exchange=exchange, multiplier=multiplier,
+                          underlying_multiplier=underlying_multiplier, commission=commission, spread=spread,
+                          warmup_bars=warmup_bars)
+    strategy = load_bot(bot_path)
+    # the bot's scheduled jobs (hourly chain refresh) follow the virtual clock
+    sys.modules[strategy.__module__].apscheduler_background = ib.scheduler_module()
+    if output_dir is None:
+        output_dir = tempfile.mkdtemp(prefix='live_replay_')
+    os.makedirs(output_dir, exist_ok=True)
+    started = time.perf_counter()
+    # the constructor connects and runs the main loop, which returns once the bars are exhausted
+    bot = strategy(ib=ib, clock=clock, delta_hedge=delta_hedge, roll=roll, max_daily_loss=max_daily_loss,
+                   max_contracts=max_contracts, margin_path=os.path.join(output_dir, 'margin.json'),
+                   journal_path=os.path.join(output_dir, 'orders'), latency_path=os.path.join(output_dir, 'latency.prom'))
+    return ReplayResult(bot, ib, time.perf_counter() - started, output_dir)
+
+
+def _read_bars(path):
+    frame = pd.read_csv(path)
+    frame.columns = [c.lower() for c in frame.columns]
+    time_col = next(c for c in frame.columns if c in ('date', 'datetime', 'time', 'timestamp'))
+    frame.index = pd.to_datetime(frame.pop(time_col))
+    return frame
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay intraday bars through the live bot against a simulated broker')
+    parser.add_argument('bars', help='CSV of 1 minute underlying bars with a date/datetime column')
+    parser.add_argument('chains', help='chain data directory')
+    parser.add_argument('--bot', default=DEFAULT_BOT, help='bot file to replay')
+    parser.add_argument('--account-value', type=float, default=100000.0)
+    parser.add_argument('--start', help='first bar date, YYYY-MM-DD')
+    parser.add_argument('--end', help='last bar date, YYYY-MM-DD')
+    parser.add_argument('--log-level', default='WARNING', help='level of the bot logs written to --log')
+    parser.add_argument('--log', help='JSON-lines log file of the bot')
+    parser.add_argument('--fills', help='write the fills to this CSV')
+    parser.add_argument('--spread', type=float, default=0.0, help='quoted bid/ask width of each option leg')
+    parser.add_argument('--delta-hedge', action='store_true', help='run the bot with delta hedging in the underlying')
+    parser.add_argument('--roll', action='store_true', help='run the bot with roll management')
+    parser.add_argument('--max-daily-loss', type=float, help='daily loss limit of the bot in dollars')
+    parser.add_argument('--max-contracts', type=int, help='limit on the open option contracts of the bot')
+    parser.add_argument('--output-dir', help='directory for the margin calibration, order journal and latency file '
+                                             'of the bot, a temporary directory by default')
+    args = parser.parse_args()
+
+    log.setup_logging(level=args.log_level, path=args.log)
+    minute_bars = _read_bars(args.bars).loc[args.start:args.end]
+    result = replay(minute_bars, args.chains, bot_path=args.bot, account_value=args.account_value,
+                    spread=args.spread, delta_hedge=args.delta_hedge, roll=args.roll,
+                    max_daily_loss=args.max_daily_loss, max_contracts=args.max_contracts, output_dir=args.output_dir)
+    log.shutdown_logging()
+
+    print(f"{len(minute_bars):,} bars replayed in {result.elapsed:.1f}s, bot files in {result.output_dir}")
+    for key, value in result.stats().items():
+        print(f"{key}: {value}")
+    if args.fills:
+        result.fills.to_csv(args.fills, index=False)
@@ -0,0 +1,155 @@
+"""
+PARAM_SWEEP.PY
+Parallel parameter sweeps of the short strangle backtest.
+
+Every worker process memory-maps the same chain data directory once (see
+chain_data.load_chains), so the historical chains are shared through the OS
+page cache instead of being pickled to each worker. Only the parameter dicts
+go out and only the headline statistics come back. Results are streamed to a
+CSV results table as each run finishes, so a long sweep can be watched (and
+loaded with pandas) while it is still running.
+"""
+
+import argparse
+import csv
+import itertools
+import os
+import random
+import time
+
+import multiprocessing as mp
+
+import pandas as pd
+
+import chain_data
+import strangle_backtest
+
+# Parameters of trade_strangle() explored by default
+DEFAULT_SPACE = {
+    'call_delta': [0.10, 0.12, 0.16, 0.20, 0.25],
+    'put_delta': [-0.10, -0.12, -0.16, -0.20, -0.25],
+    'days': [30, 38, 45, 52, 60],
+    'take_profit_factor': [0.25, 0.50, 0.75],
+    'stop_loss_factor': [2.00, 3.00, 4.00],
+    'use_vix_position_sizing': [False, True],
+}
+
+_chains = None
+
+
+def grid(space):
+
+    '''
+    Every combination of the values in the space
+    :param space: dict of parameter name -> list of values
+    :return: list of parameter dicts
+    '''
+
+    names = list(space)
+    return [dict(zip(names, values)) for values in itertools.product(*(space[n] for n in names))]
+
+
+def sample(space, n, seed=None):
+
+    '''
+    Random sample of the space
+    :param space: dict of parameter name -> list of values, or (low, high) tuple for a uniform range
+    :param n: number of parameter sets
+    :param seed: random seed for reproducible sweeps
+    :return: list of parameter dicts
+    '''
+
+    rng = random.Random(seed)
+    draws = []
+    for _ in range(n):
+        params = {}
+        for name, values in space.items():
+            if isinstance(values, tuple):
+                low, high = values
+                params[name] = rng.randint(low, high) if isinstance(low, int) else rng.uniform(low, high)
+            else:
+                params[name] = rng.choice(values)
+        draws.append(params)
+    return draws
+
+
+def _init_worker(path):
+    # map the chain files once per worker, the pages are shared between processes by the OS
+    global _chains
+    _chains = chain_data.load_chains(path)
+
+
+def _run(task):
+    run_id, params, fixed = task
+    started = time.perf_counter()
+    try:
+        result = strangle_backtest.run_backtest(_chains, **fixed, **params)
+        row = {'run': run_id, **params, **result.stats(), 'error': ''}
+    except Exception as e:
+        row = {'run': run_id, **params, 'error': repr(e)}
+    row['seconds'] = round(time.perf_counter() - started, 4)
+    return row
+
+
+def run_sweep(path, params, results_path=None, workers=None, fixed=None, chunksize=1, progress=None, on_result=None):
+
+    '''
+    Backtest every parameter set across a process pool
+    :param path: chain data directory
+    :param params: list of parameter dicts (see grid() and sample())
+    :param results_path: CSV file the results are streamed to, None to only return them
+    :param workers: number of processes, defaults to the CPU count
+    :param fixed: keyword arguments passed unchanged to every run (start, end, quantity, ...)
+    :param chunksize: parameter sets handed to a worker at a time
+    :param progress: optional callable(done, total) called after each result
+    :param on_result: optional callable(row) called with each result as it arrives
+    :return: DataFrame of results, one row per parameter set
+    '''
+
+    workers = workers or os.cpu_count()
+    fixed = fixed or {}
+    tasks = [(i, p, fixed) for i, p in enumerate(params)]
+    stat_names = list(strangle_backtest.BacktestResult(pd.DataFrame(), pd.Series(dtype=float), {}).stats())
+    fields = ['run'] + sorted({k for p in params for k in p}) + stat_names + ['error', 'seconds']
+
+    rows = []
+    out = open(results_path, 'w', newline='') if results_path else None
+    try:
+        writer = csv.DictWriter(out, fieldnames=fields, extrasaction='ignore') if out else None
+        if writer:
+            writer.writeheader()
+        with mp.Pool(workers, initializer=_init_worker, initargs=(path,)) as pool:
+            for row in pool.imap_unordered(_run, tasks, chunksize=chunksize):
+                rows.append(row)
+                if on_result:
+                    on_result(row)
+                if writer:
+                    writer.writerow(row)
+                    out.flush()
+                if progress:
+                    progress(len(rows), len(tasks))
+    finally:
+        if out:
+            out.close()
+    return pd.DataFrame(rows, columns=fields).sort_values('run').reset_index(drop=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Parallel parameter sweep of the short strangle backtest')
+    parser.add_argument('chains', help='chain data directory')
+    parser.add_argument('--results', default='sweep_results.csv', help='CSV results table')
+    parser.add_argument('--samples', type=int, help='random sample this many parameter sets instead of the full grid')
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--start', help='first trading date, YYYY-MM-DD')
+    parser.add_argument('--end', help='last trading date, YYYY-MM-DD')
+    args = parser.parse_args()
+
+    parameter_sets = sample(DEFAULT_SPACE, args.samples, args.seed) if args.samples else grid(DEFAULT_SPACE)
+    started = time.perf_counter()
+    results = run_sweep(args.chains, parameter_sets, results_path=args.results, workers=args.workers,
+                        fixed={'start': args.start, 'end': args.end},
+                        progress=lambda done, total: print(f"\r{done}/{total} runs", end='', flush=True))
+    elapsed = time.perf_counter() - started
+    print(f"\n{len(results)} runs in {elapsed:.1f}s ({len(results) / elapsed:.1f} runs/s), results in {args.results}")
+    print(results.sort_values('total_pnl', ascending=False).head(10).to_string(index=False))
@@ -0,0 +1,205 @@
+"""
+RESULT_CACHE.PY
+Content-addressed cache of backtest results.
+
+A result is stored under a hash of everything that produced it:
+  * the parameters of the run,
+  * the data version, a fingerprint of the chain rows the result was computed
+    from (DataVersion), so appending or correcting data only invalidates the
+    results that read the changed rows,
+  * the code version, a hash of the source files of the strategy
+    (code_version), so editing the backtest invalidates its results without
+    anyone having to remember to clear the cache.
+Nothing is ever looked up by name, so a stale entry can not be returned: it is
+simply never asked for again and ages out. With max_bytes set, the least
+recently used entries are evicted once the cache grows past its budget.
+
+Used by strangle_backtest.run_backtest (whole runs and the exit path of every
+trade) and walk_forward (every window x parameter set cell).
+"""
+
+import hashlib
+import inspect
+import json
+import os
+
+import numpy as np
+
+import chain_data
+
+# columns fingerprinted by DataVersion, every column of the chain
+FINGERPRINT_COLUMNS = tuple(chain_data.COLUMNS)
+
+
+class ResultCache:
+
+    '''
+    Directory of JSON results keyed by content hash, optionally bounded in size
+    :param path: cache directory
+    :param max_bytes: evict the least recently used entries beyond this size, None for unbounded
+    '''
+
+    def __init__(self, path, max_bytes=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._bytes = None
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, key):
+        return os.path.join(self.path, key[:2], f"{key}.json")
+
+    def get(self, key):
+        file = self._file(key)
+        try:
+            with open(file) as f:
+                value = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if self.max_bytes is not None:
+            # the modification time doubles as the last use for eviction
+            try:
+                os.utime(file)
+            except OSError:
+                pass
+        return value
+
+    def put(self, key, value):
+        file = self._file(key)
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        # unique temporary name, sweep workers write to the same cache
+        tmp = f"{file}.{os.getpid()}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(value, f)
+        written = os.path.getsize(tmp)
+        os.replace(tmp, file)
+        if self.max_bytes is not None:
+            self._bytes = (self.size() if self._bytes is None else self._bytes + written)
+            if self._bytes > self.max_bytes:
+                self.evict()
+
+    def _entries(self):
+        entries = []
+        for sub in os.scandir(self.path):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                if entry.name.endswith('.json'):
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def size(self):
+
+        '''
+        Bytes stored in the cache
+        :return: int
+        '''
+
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self, target=None):
+
+        '''
+        Remove the least recently used entries until the cache fits
+        :param target: bytes to shrink to, defaults to 90% of max_bytes so eviction does not run on every put
+        :return: number of entries removed
+        '''
+
+        target = int(0.9 * self.max_bytes) if target is None else target
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, file in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(file)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        self._bytes = total
+        return removed
+
+
+def open_cache(cache, max_bytes=None):
+
+    '''
+    A ResultCache from a cache or a directory
+    :param cache: ResultCache, cache directory or None
+    :return: ResultCache or None
+    '''
+
+    if cache is None or isinstance(cache, ResultCache):
+        return cache
+    return ResultCache(cache, max_bytes)
+
+
+def content_key(**parts):
+
+    '''
+    Stable hash of JSON-serializable parts
+    :return: hex digest
+    '''
+
+    blob = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(blob.encode()).hexdigest()
+
+
+def code_version(*sources):
+
+    '''
+    Hash of the source files a result depends on
+    :param sources: python files, modules or functions (hashed by the whole file they are defined in)
+    :return: hex digest, changes whenever any of the files does
+    '''
+
+    digest = hashlib.sha256()
+    for source in sources:
+        with open(source if isinstance(source, str) else inspect.getsourcefile(source), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+def fingerprint(columns, lo, hi):
+
+    '''
+    Fingerprint of the chain rows lo:hi, a hash of the raw bytes of every column slice
+    :param columns: dict of chain columns
+    :return: str, equal for equal rows (in the same order)
+    '''
+
+    digest = hashlib.blake2b(digest_size=16)
+    for c in FINGERPRINT_COLUMNS:
+        if c in columns:
+            digest.update(c.encode())
+            digest.update(memoryview(np.ascontiguousarray(columns[c][lo:hi])).cast('B'))
+    return f"{hi - lo}:{digest.hexdigest()}"
+
+
+class DataVersion:
+
+    '''
+    Fingerprint the chain rows that fall inside a date range, so a cached
+    result stays valid exactly as long as the data it was computed from
+    :param chains: chain data directory, dict of chain columns or ChainStore
+    '''
+
+    def __init__(self, chains):
+        if isinstance(chains, str):
+            chains = chain_data.load_chains(chains)
+        if hasattr(chains, 'day_starts'):
+            self.days, self.starts = chains.days, chains.day_starts
+            chains = chains.columns
+        else:
+            self.days, self.starts, _ = chain_data.day_index(chains['date'])
+        self.columns = chains
+
+    def __call__(self, start, end):
+        lo = self.starts[np.searchsorted(self.days, chain_data.to_days([start])[0])] if self.days.size else 0
+        i = np.searchsorted(self.days, chain_data.to_days([end])[0], side='right')
+        hi = self.starts[i] if i < self.days.size else len(self.columns['date'])
+        return fingerprint(self.columns, lo, hi)
@@ -0,0 +1,557 @@
+"""
+SIM_BROKER.PY
+A simulated IB connection and virtual clock for running the live bots offline.
+
+SimIB implements the subset of ib_insync.IB the bots call (connect,
+qualifyContracts, reqHistoricalData, reqSecDefOptParams, whatIfOrder,
+accountSummary, accountValues, bracketOrder, placeOrder, reqGlobalCancel,
+reqMktData, cancelMktData, sleep, run and the disconnected/execDetails/
+openOrder/orderStatus/accountValue events) on top of:
+  * a DataFrame of underlying bars, replayed one bar at a time by run(),
+  * a chain store (chain_store.ChainStore) for listed expirations, strikes
+    and implied vols. Options are marked with Black-Scholes at the current
+    bar's underlying price and the IV of the last chain snapshot before the
+    current date, so no same-day snapshot leaks into the decision.
+
+Combos follow IB's sign convention: the price of a BAG is the sum of its
+legs' prices, signed by each leg's action (SELL legs count negative), so a
+BUY bracket on a strangle of SELL legs opens it for a credit exactly as it
+does live. Quotes from reqMktData are the mark plus or minus half of spread
+per leg, refreshed every bar. Placing an order whose orderId is still
+working amends it in place, as IB does. Limit orders fill at their limit once the quote crosses it
+(the ask for a buy, the bid for a sell; the mark with no spread), stop
+orders trigger on the mark and fill at it, market orders fill at the mark.
+Bracket children only work once their parent has filled and cancel each
+other (OCA) when one fills. Nothing sleeps: the clock jumps from bar to bar
+as fast as the bot's callbacks return.
+"""
+
+import datetime
+import os
+import sys
+import types
+
+import numpy as np
+import pandas as pd
+from ib_insync import (AccountValue, BarData, BarDataList, BracketOrder, CommissionReport, Execution, Fill,
+                       LimitOrder, OptionChain, OrderState, OrderStatus, StopOrder, Ticker, Trade)
+from eventkit import Event
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'models'))
+from common import pricing
+
+import chain_data
+
+# Options stop trading and are marked for settlement at the close on expiration day
+EXPIRY_TIME = datetime.time(16, 0)
+SECONDS_PER_YEAR = 365 * 24 * 60 * 60
+
+
+def _contract_key(contract):
+    if contract.secType == 'BAG':
+        return tuple((leg.conId, leg.action, leg.ratio) for leg in contract.comboLegs)
+    return contract.conId
+
+
+class SimClock:
+
+    '''
+    Virtual wall clock, called like datetime.datetime.now
+    :param now: starting time
+    '''
+
+    def __init__(self, now=None):
+        self.now = now or datetime.datetime(1970, 1, 1)
+
+    def __call__(self):
+        return self.now
+
+
+class SimScheduler:
+
+    '''
+    Stand-in for apscheduler's BackgroundScheduler whose cron jobs run on the virtual clock.
+    Only the 'hour' and 'minute' fields of cron triggers are used ('*' or an int), which covers
+    the bots' hourly chain refresh
+    :param ib: SimIB whose replay fires the jobs
+    '''
+
+    def __init__(self, ib, job_defaults=None):
+        self.jobs = []
+        ib.schedulers.append(self)
+
+    def add_job(self, func, trigger='cron', hour='*', minute=0, **kwargs):
+        self.jobs.append((func, str(hour), str(minute)))
+
+    def start(self):
+        pass
+
+    def shutdown(self, wait=True):
+        self.jobs = []
+
+    def fire(self, now):
+        for func, hour, minute in self.jobs:
+            if hour in ('*', str(now.hour)) and minute in ('*', str(now.minute)):
+                func()
+
+
+class SimIB:
+
+    '''
+    Simulated ib_insync.IB backed by historical bars and a chain store
+    :param store: chain_store.ChainStore with the option chains of the underlying
+    :param bars: DataFrame of underlying bars with a DatetimeIndex and open/high/low/close(/volume) columns
+    :param clock: SimClock shared with the bot
+    :param account_value: starting cash
+    :param exchange: exchange reported for the option chain ('SMART' for the equity bot, 'CME' for futures)
+    :param multiplier: contract multiplier of the options
+    :param underlying_multiplier: multiplier of the underlying when it is traded (1 for a stock, 5 for MES)
+    :param commission: commission per option contract per leg
+    :param underlying_commission: commission per unit of the underlying
+    :param spread: quoted bid/ask width of each option leg
+    :param warmup_bars: bars already in the backfill when the replay starts
+    :param window: bars kept in the streaming bar list (one regular session), the bot converts the whole list
+        to a DataFrame every 5 bars so a longer window only slows the replay
+    :param account_interval: bars between NetLiquidation pushes, TWS streams it about every 3 minutes
+    '''
+
+    def __init__(self, store, bars, clock, account_value=100000.0, exchange='SMART', multiplier=100,
+                 underlying_multiplier=1, commission=0.65, underlying_commission=0.005, spread=0.0, warmup_bars=390,
+                 window=390, account_interval=3):
+        self.store = store
+        self.clock = clock
+        self.exchange = exchange
+        self.multiplier = multiplier
+        self.underlying_multiplier = underlying_multiplier
+        self.commission = commission
+        self.underlying_commission = underlying_commission
+        self.spread = spread
+        self.window = window
+        self.account_interval = account_interval
+        self.cash = float(account_value)
+
+        bars = bars.rename(columns=str.lower)
+        self._times = bars.index.to_pydatetime()
+        self._ohlcv = np.column_stack([bars[c].to_numpy(dtype=float) if c in bars else np.zeros(len(bars))
+                                       for c in ('open', 'high', 'low', 'close', 'volume')])
+        self._next = min(warmup_bars, len(bars))
+        self.bars = BarDataList(self._bar(i) for i in range(self._next))
+        if self._next:
+            self.clock.now = self._times[self._next - 1] + datetime.timedelta(minutes=1)
+
+        self.disconnectedEvent = Event('disconnectedEvent')
+        self.execDetailsEvent = Event('execDetailsEvent')
+        self.openOrderEvent = Event('openOrderEvent')
+        self.orderStatusEvent = Event('orderStatusEvent')
+        self.accountValueEvent = Event('accountValueEvent')
+        self.accountSummaryEvent = Event('accountSummaryEvent')
+
+        self._connected = False
+        self._order_id = 0
+        self._exec_id = 0
+        self._underlying_conid = 1
+        self._contracts = {}    # conId -> (expiry as datetime.date, +1 call / -1 put, strike)
+        self._conids = {}       # (expiry, right, strike) -> conId
+        self._iv_cache = {}
+        self.positions = {}     # conId -> signed contracts
+        self.working = {}       # orderId -> trade that can still fill
+        self.tickers = {}       # contract key -> Ticker requested with reqMktData
+        self.trades = []
+        self._filled = set()    # orderIds of filled orders, bracket children work once their parent is in here
+        self.fills = []
+        self.equity = []        # (date, account value at the last bar of the day)
+        self.schedulers = []
+
+    # Connection
+
+    def connect(self, *args, **kwargs):
+        self._connected = True
+        return self
+
+    def disconnect(self):
+        self._connected = False
+
+    def isConnected(self):
+        return self._connected
+
+    def sleep(self, secs=0.02):
+        # nothing happens between bars, waiting is free
+        return True
+
+    def run(self, *args):
+
+        '''
+        Replay the remaining bars, emitting updateEvent on the streaming bar list after each
+        :return: None once the bars are exhausted
+        '''
+
+        day = self.clock.now.date()
+        for i in range(self._next, len(self._times)):
+            self.clock.now = self._times[i] + datetime.timedelta(minutes=1)
+            self._fire_jobs(self.clock.now)
+            if self.clock.now.date() != day:
+                self.equity.append((day, self.net_liquidation()))
+                day = self.clock.now.date()
+                self._settle_expired(day)
+            self.bars.append(self._bar(i))
+            if len(self.bars) > 2 * self.window:
+                del self.bars[:len(self.bars) - self.window]
+            self._next = i + 1
+            self._quote_tickers()
+            self._work_orders()
+            # TWS streams the portfolio value as the market moves, not only on fills, every few minutes
+            if i % self.account_interval == 0:
+                self.accountValueEvent.emit(AccountValue('SIM', 'NetLiquidation',
+                                                         str(round(self.net_liquidation(), 2)), 'USD', ''))
+            self.bars.updateEvent.emit(self.bars, True)
+        self.equity.append((day, self.net_liquidation()))
+
+    def scheduler_module(self):
+
+        '''
+        Replacement for the apscheduler.schedulers.background module, so jobs a bot schedules run on
+        the virtual clock instead of wall time
+        :return: namespace with a BackgroundScheduler factory
+        '''
+
+        return types.SimpleNamespace(BackgroundScheduler=lambda **kwargs: SimScheduler(self, **kwargs))
+
+    def _fire_jobs(self, now):
+        # jobs run at the bar closes matching their trigger, nothing fires inside gaps in the bars
+        for scheduler in self.schedulers:
+            scheduler.fire(now)
+
+    # Contracts and market data
+
+    def qualifyContracts(self, *contracts):
+        qualified = []
+        for contract in contracts:
+            if contract.secType in ('OPT', 'FOP'):
+                expiry = datetime.datetime.strptime(contract.lastTradeDateOrContractMonth[:8], '%Y%m%d').date()
+                right = 1 if contract.right.upper().startswith('C') else -1
+                if np.isnan(self._iv(expiry, right, float(contract.strike))):
+                    continue
+                key = (expiry, right, float(contract.strike))
+                if key not in self._conids:
+                    self._conids[key] = len(self._contracts) + 2
+                    self._contracts[self._conids[key]] = key
+                contract.conId = self._conids[key]
+            elif contract.secType != 'BAG':
+                contract.conId = self._underlying_conid
+            qualified.append(contract)
+        return qualified
+
+    def reqHistoricalData(self, contract, endDateTime='', durationStr='', barSizeSetting='', whatToShow='',
+                          useRTH=False, formatDate=1, keepUpToDate=False, chartOptions=None):
+        if contract.conId == self._underlying_conid and contract.secType != 'BAG':
+            return self.bars
+        price = self.price(contract)
+        if np.isnan(price):
+            return BarDataList()
+        return BarDataList([BarData(self.clock.now, price, price, price, price, 0, price, 0)])
+
+    def reqSecDefOptParams(self, underlyingSymbol, futFopExchange, underlyingSecType, underlyingConId):
+        snapshot = chain_data.from_days(self.store.days[self._snapshot(self.clock.now.date())])
+        expiries = self.store.expiries(snapshot)
+        expiries = expiries[expiries >= np.datetime64(self.clock.now.date(), 'D')]
+        strikes = np.unique(self.store.day(snapshot)['strike'])
+        return [OptionChain(self.exchange, underlyingConId, underlyingSymbol, str(self.multiplier),
+                            [d.strftime('%Y%m%d') for d in pd.to_datetime(expiries)], strikes.tolist())]
+
+    def price(self, contract):
+
+        '''
+        Current mark of a qualified option or a BAG of qualified options (IB sign convention)
+        :return: price, NaN when a leg is unknown
+        '''
+
+        if contract.secType == 'BAG':
+            total = 0.0
+            for leg in contract.comboLegs:
+                sign = 1 if leg.action == 'BUY' else -1
+                total += sign * leg.ratio * self._option_price(leg.conId)
+            return round(total, 2)
+        if contract.conId == self._underlying_conid:
+            return self.underlying_price()
+        return round(self._option_price(contract.conId), 2)
+
+    def underlying_price(self):
+        return self._ohlcv[self._next - 1, 3] if self._next else np.nan
+
+    def _option_price(self, conId):
+        if conId not in self._contracts:
+            return np.nan
+        expiry, right, strike = self._contracts[conId]
+        iv = self._iv(expiry, right, strike)
+        T = (datetime.datetime.combine(expiry, EXPIRY_TIME) - self.clock.now).total_seconds() / SECONDS_PER_YEAR
+        return float(pricing.black_scholes(right, self.underlying_price(), strike, max(T, 0.0), iv))
+
+    def _snapshot(self, date):
+        # last chain snapshot strictly before the date, the first one before the data starts
+        i = np.searchsorted(self.store.days, chain_data.to_days([date])[0]) - 1
+        return max(int(i), 0)
+
+    def _iv(self, expiry, right, strike):
+        i = self._snapshot(self.clock.now.date())
+        key = (i, expiry, right, strike)
+        if key not in self._iv_cache:
+            try:
+                rows = self.store.slice(chain_data.from_days(self.store.days[i]), np.datetime64(expiry, 'D'), right)
+                strikes, ivs = np.asarray(rows['strike']), np.asarray(rows['iv'])
+                inside = strikes.size and strikes[0] <= strike <= strikes[-1]
+                self._iv_cache[key] = float(np.interp(strike, strikes, ivs)) if inside else np.nan
+            except KeyError:
+                self._iv_cache[key] = np.nan
+        return self._iv_cache[key]
+
+    # Account
+
+    def net_liquidation(self):
+        hedge = self.positions.get(self._underlying_conid, 0) * self.underlying_price() * self.underlying_multiplier
+        marks = sum(qty * self._option_price(conId) for conId, qty in self.positions.items()
+                    if conId != self._underlying_conid)
+        return self.cash + marks * self.multiplier + hedge
+
+    def margin(self, positions=None):
+
+        '''
+        Reg-T style initial margin of option positions: for each expiration the larger of the
+        naked call and naked put requirements (20% of the underlying less the OTM amount, at
+        least 10% of the underlying for calls and of the strike for puts) plus the premium of
+        the other side; long options and positions in the underlying (hedges) need no margin
+        :param positions: dict conId -> signed contracts, defaults to the open positions
+        :return: dollars
+        '''
+
+        positions = self.positions if positions is None else positions
+        S = self.underlying_price()
+        by_expiry = {}
+        for conId, qty in positions.items():
+            if qty >= 0 or conId == self._underlying_conid:
+                continue
+            expiry, right, strike = self._contracts[conId]
+            premium = self._option_price(conId)
+            otm = max(S - strike, 0.0) if right < 0 else max(strike - S, 0.0)
+            naked = premium + max(0.20 * S - otm, 0.10 * (strike if right < 0 else S))
+            side = by_expiry.setdefault(expiry, {1: [0.0, 0.0], -1: [0.0, 0.0]})[right]
+            side[0] += -qty * naked
+            side[1] += -qty * premium
+        total = 0.0
+        for sides in by_expiry.values():
+            calls, puts = sides[1], sides[-1]
+            total += max(calls[0] + puts[1], puts[0] + calls[1])
+        return total * self.multiplier
+
+    def whatIfOrder(self, contract, order):
+        after = self._after(contract, order)
+        change = self.margin(after) - self.margin()
+        return OrderState(status='PreSubmitted', initMarginChange=str(round(change, 2)),
+                          maintMarginChange=str(round(change, 2)))
+
+    def accountSummary(self, account=''):
+        net = self.net_liquidation()
+        margin = self.margin()
+        values = {'NetLiquidation': net, 'TotalCashValue': self.cash, 'InitMarginReq': margin,
+                  'MaintMarginReq': margin, 'AvailableFunds': net - margin, 'ExcessLiquidity': net - margin,
+                  'BuyingPower': (net - margin) * 4}
+        return [AccountValue('SIM', tag, str(round(value, 2)), 'USD', '') for tag, value in values.items()]
+
+    def accountValues(self, account=''):
+        return self.accountSummary(account)
+
+    def _push_account_values(self):
+        # TWS streams the account values to the client when they change
+        for value in self.accountSummary():
+            self.accountValueEvent.emit(value)
+
+    # Market data
+
+    def reqMktData(self, contract, genericTickList='', snapshot=False, regulatorySnapshot=False,
+                   mktDataOptions=None):
+        key = _contract_key(contract)
+        if key not in self.tickers:
+            self.tickers[key] = Ticker(contract=contract)
+            self._quote(self.tickers[key])
+        return self.tickers[key]
+
+    def cancelMktData(self, contract):
+        self.tickers.pop(_contract_key(contract), None)
+
+    def _quote(self, ticker):
+        contract = ticker.contract
+        mark = self.price(contract)
+        half = self._half_spread(contract)
+        ticker.time = self.clock.now
+        ticker.bid, ticker.ask = round(mark - half, 2), round(mark + half, 2)
+        ticker.last = mark
+
+    def _half_spread(self, contract):
+        if contract.secType == 'BAG':
+            return self.spread / 2 * sum(leg.ratio for leg in contract.comboLegs)
+        return 0.0 if contract.conId == self._underlying_conid else self.spread / 2
+
+    def _quote_tickers(self):
+        for ticker in self.tickers.values():
+            self._quote(ticker)
+
+    # Orders
+
+    def bracketOrder(self, action, quantity, limitPrice, takeProfitPrice, stopLossPrice, **kwargs):
+        reverse = 'BUY' if action == 'SELL' else 'SELL'
+        parent = LimitOrder(action, quantity, limitPrice, orderId=self._next_order_id(), transmit=False, **kwargs)
+        take_profit = LimitOrder(reverse, quantity, takeProfitPrice, orderId=self._next_order_id(), transmit=False,
+                                 parentId=parent.orderId, **kwargs)
+        stop_loss = StopOrder(reverse, quantity, stopLossPrice, orderId=self._next_order_id(), transmit=True,
+                              parentId=parent.orderId, **kwargs)
+        return BracketOrder(parent, take_profit, stop_loss)
+
+    def placeOrder(self, contract, order):
+        if order.orderId in self.working:
+            # an order that is still working is amended in place
+            trade = self.working[order.orderId]
+            trade.order = order
+            self.openOrderEvent.emit(trade)
+            self._work_orders()
+            return trade
+        if not order.orderId:
+            order.orderId = self._next_order_id()
+        status = 'PreSubmitted' if order.parentId else 'Submitted'
+        trade = Trade(contract, order, OrderStatus(orderId=order.orderId, status=status,
+                                                   remaining=order.totalQuantity, parentId=order.parentId))
+        self.trades.append(trade)
+        self.working[order.orderId] = trade
+        self.openOrderEvent.emit(trade)
+        self._work_orders()
+        return trade
+
+    def cancelOrder(self, order):
+        if order.orderId in self.working:
+            self._cancel(self.working[order.orderId])
+
+    def reqGlobalCancel(self):
+        for trade in list(self.working.values()):
+            self._cancel(trade)
+
+    def openTrades(self):
+        return list(self.working.values())
+
+    def _next_order_id(self):
+        self._order_id += 1
+        return self._order_id
+
+    def _cancel(self, trade):
+        trade.orderStatus.status = 'Cancelled'
+        del self.working[trade.order.orderId]
+        self.orderStatusEvent.emit(trade)
+
+    def _after(self, contract, order):
+        # positions after the order fills
+        positions = dict(self.positions)
+        sign = 1 if order.action == 'BUY' else -1
+        legs = contract.comboLegs if contract.secType == 'BAG' else []
+        for leg in legs:
+            leg_sign = 1 if leg.action == 'BUY' else -1
+            positions[leg.conId] = positions.get(leg.conId, 0) + sign * leg_sign * leg.ratio * order.totalQuantity
+        if contract.secType != 'BAG':
+            positions[contract.conId] = positions.get(contract.conId, 0) + sign * order.totalQuantity
+        return {conId: qty for conId, qty in positions.items() if qty}
+
+    def _work_orders(self):
+        # one mark per distinct contract, however many orders are working on it
+        marks = {}
+        for orderId in list(self.working):
+            trade = self.working.get(orderId)
+            if trade is None:
+                continue
+            order = trade.order
+            if order.parentId and order.parentId not in self._filled:
+                continue
+            key = _contract_key(trade.contract)
+            if key not in marks:
+                marks[key] = self.price(trade.contract)
+            mark = marks[key]
+            if np.isnan(mark):
+                continue
+            buy = order.action == 'BUY'
+            fill_price = None
+            if order.orderType == 'MKT':
+                fill_price = mark
+            elif order.orderType == 'LMT' and (mark + self._half_spread(trade.contract) <= order.lmtPrice if buy
+                                               else mark - self._half_spread(trade.contract) >= order.lmtPrice):
+                fill_price = order.lmtPrice
+            elif order.orderType == 'STP' and (mark >= order.auxPrice if buy else mark <= order.auxPrice):
+                fill_price = mark
+            if fill_price is None:
+                continue
+            self._fill(trade, fill_price)
+            if order.parentId:
+                # bracket children are one-cancels-all
+                for sibling in [t for t in self.working.values() if t.order.parentId == order.parentId]:
+                    self._cancel(sibling)
+            if order.ocaGroup:
+                for sibling in [t for t in self.working.values() if t.order.ocaGroup == order.ocaGroup]:
+                    self._cancel(sibling)
+
+    def _fill(self, trade, price):
+        order, contract = trade.order, trade.contract
+        quantity = order.totalQuantity
+        self.positions = self._after(contract, order)
+        legs = len(contract.comboLegs) if contract.secType == 'BAG' else 1
+        sign = 1 if order.action == 'BUY' else -1
+        if contract.conId == self._underlying_conid and contract.secType != 'BAG':
+            multiplier, commission = self.underlying_multiplier, self.underlying_commission * quantity
+        else:
+            multiplier, commission = self.multiplier, self.commission * quantity * legs
+        self.cash -= sign * price * quantity * multiplier + commission
+
+        self._exec_id += 1
+        now = self.clock.now
+        execution = Execution(execId=f'sim.{self._exec_id}', time=now, acctNumber='SIM', exchange=contract.exchange,
+                              side='BOT' if sign > 0 else 'SLD', shares=quantity, price=price, orderId=order.orderId,
+                              cumQty=quantity, avgPrice=price)
+        fill = Fill(contract, execution, CommissionReport(execId=execution.execId, commission=commission,
+                                                          currency='USD'), now)
+        trade.fills.append(fill)
+        trade.orderStatus.status = 'Filled'
+        trade.orderStatus.filled = quantity
+        trade.orderStatus.remaining = 0
+        trade.orderStatus.avgFillPrice = price
+        trade.orderStatus.lastFillPrice = price
+        del self.working[order.orderId]
+        self._filled.add(order.orderId)
+        self.fills.append({'time': now, 'order_id': order.orderId, 'parent_id': order.parentId,
+                           'order_type': order.orderType, 'action': order.action, 'quantity': quantity,
+                           'price': price, 'commission': commission, 'underlying': self.underlying_price(),
+                           'cash': self.cash})
+        self.execDetailsEvent.emit(trade, fill)
+        self.orderStatusEvent.emit(trade)
+        self._push_account_values()
+
+    def _settle_expired(self, today):
+        # expired options settle at intrinsic value against the last price seen
+        S = self.underlying_price()
+        for conId, qty in list(self.positions.items()):
+            if conId == self._underlying_conid:
+                continue
+            expiry, right, strike = self._contracts[conId]
+            if expiry < today:
+                intrinsic = max(S - strike, 0.0) if right > 0 else max(strike - S, 0.0)
+                self.cash += qty * intrinsic * self.multiplier
+                del self.positions[conId]
+                self.fills.append({'time': self.clock.now, 'order_id': 0, 'parent_id': 0, 'order_type': 'EXPIRY',
+                                   'action': 'SELL' if qty > 0 else 'BUY', 'quantity': abs(qty),
+                                   'price': intrinsic, 'commission': 0.0, 'underlying': S, 'cash': self.cash})
+
+    def _bar(self, i):
+        o, h, l, c, v = self._ohlcv[i]
+        return BarData(self._times[i], o, h, l, c, v, c, 0)
+
+    # Results
+
+    def fills_frame(self):
+        return pd.DataFrame(self.fills, columns=['time', 'order_id', 'parent_id', 'order_type', 'action', 'quantity',
+                                                 'price', 'commission', 'underlying', 'cash'])
+
+    def equity_curve(self):
+        return pd.Series([v for _, v in self.equity], index=pd.to_datetime([d for d, _ in self.equity]),
+                         name='equity', dtype=float)
@@ -0,0 +1,445 @@
+"""
+STRANGLE_BACKTEST.PY
+Native vectorized backtest of the live short strangle rules over local chain data.
+
+Replicates ShortStrangles.trade_strangle() / manage_strangle() from
+models/equities/Release/short_strangles_4.11.23.py:
+  * pick the listed expiration nearest to `days` calendar days out,
+  * take the ATM call IV of that expiration (strike rounded up to $5),
+  * walk strikes in $1 steps away from the rounded spot until the Black-Scholes
+    delta at that IV crosses call_delta / put_delta, then round the call up and
+    the put down to a $5 strike,
+  * sell the combo at 99.5% of its mid, bracket it with a take profit at
+    take_profit_factor x mid and a stop at stop_loss_factor x mid,
+  * close anything left at exit_dte (21) days to expiration.
+
+The backtest steps one trading day at a time, but every day's work (expiry and
+strike selection, quote lookup and marking of all open positions) is a handful
+of NumPy calls on that day's slice of the memory-mapped chain data.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'models'))
+from common import pricing
+from common.margin import strangle_margin
+from common.sizing import IV_LADDER, iv_bucket_size
+
+import chain_data
+import result_cache
+
+# strikes walked by get_strike() in the live bot
+_STRIKE_STEPS = np.arange(1000)
+
+# cached results are only reused while the code that produced them is unchanged
+CODE_VERSION = result_cache.code_version(__file__, chain_data, pricing, strangle_margin, iv_bucket_size)
+
+
+class BacktestResult:
+
+    '''
+    Trades and daily equity of a backtest run
+    :param trades: DataFrame with one row per closed trade
+    :param equity: Series of account equity (realized + open P&L) indexed by date
+    :param params: parameters the backtest was run with
+    '''
+
+    def __init__(self, trades, equity, params, elapsed=0.0):
+        self.trades = trades
+        self.equity = equity
+        self.params = params
+        self.elapsed = elapsed
+
+    def stats(self):
+
+        '''
+        Headline statistics of the run
+        :return: dict
+        '''
+
+        pnl = self.trades['pnl'] if len(self.trades) else pd.Series(dtype=float)
+        equity = self.equity.to_numpy()
+        drawdown = (np.maximum.accumulate(equity) - equity).max() if equity.size else 0.0
+        daily = np.diff(equity)
+        sharpe = daily.mean() / daily.std() * np.sqrt(252) if daily.size > 1 and daily.std() > 0 else 0.0
+        return {
+            'trades': int(len(pnl)),
+            'total_pnl': float(pnl.sum()),
+            'win_rate': float((pnl > 0).mean()) if len(pnl) else 0.0,
+            'avg_pnl': float(pnl.mean()) if len(pnl) else 0.0,
+            'max_drawdown': float(drawdown),
+            'sharpe': float(sharpe),
+            'avg_days_held': float(self.trades['days_held'].mean()) if len(pnl) else 0.0,
+        }
+
+
+def select_expiry(expiries, day, days):
+
+    '''
+    Listed expiration nearest to `days` out, like update_target_expiration()
+    :param expiries: sorted unique expirations listed on `day` (int days)
+    :return: the chosen expiration
+    '''
+
+    return expiries[np.argmin(np.abs(expiries - (day + days)))]
+
+
+def select_strikes(S, iv, T, call_delta, put_delta, call_strike_rounding='up', put_strike_rounding='down'):
+
+    '''
+    Vectorized get_strike() for both legs
+    :param S: underlying price
+    :param iv: chain IV used for every strike (the live bot prices all strikes at the ATM IV)
+    :param T: annualized time to expiration
+    :return: (call strike, put strike), 0 when no strike crosses the target delta
+    '''
+
+    base = round(S)
+    call_k = base + _STRIKE_STEPS
+    put_k = base - _STRIKE_STEPS
+    call_hit = pricing.delta('c', S, call_k, T, iv) <= call_delta
+    put_hit = pricing.delta('p', S, put_k, T, iv) >= put_delta
+    call = _round_strike(call_k[call_hit.argmax()], call_strike_rounding) if call_hit.any() else 0
+    put = _round_strike(put_k[put_hit.argmax()], put_strike_rounding) if put_hit.any() else 0
+    return call, put
+
+
+def size_trades(trades, account_value, ladder=IV_LADDER, default=1, multiplier=100):
+
+    '''
+    Re-size the trades of a run with the IV ladder in one vectorized call, on a fixed account value
+    :param trades: BacktestResult.trades of a run
+    :param account_value: available funds at every entry (scalar or one per trade)
+    :param ladder: (lowest IV, fraction) bands, see common/sizing.py
+    :param default: contracts below the lowest band
+    :return: copy of trades with quantity, pnl and margin for the new sizes
+    '''
+
+    sized = trades.copy()
+    margin = strangle_margin(trades['underlying'].to_numpy(), trades['call_strike'].to_numpy(),
+                             trades['put_strike'].to_numpy(), trades['credit'].to_numpy(), multiplier)
+    contracts = iv_bucket_size(trades['entry_iv'].to_numpy(), account_value, margin, ladder, default)
+    per_contract = trades['pnl'].to_numpy() / np.where(trades['quantity'] > 0, trades['quantity'], 1)
+    sized['quantity'] = contracts
+    sized['pnl'] = per_contract * contracts
+    sized['margin'] = margin * contracts
+    return sized
+
+
+def _round_strike(strike, rounding):
+    if rounding == 'up':
+        return int(np.ceil(strike / 5)) * 5
+    if rounding == 'down':
+        return int(np.floor(strike / 5)) * 5
+    return int(round(strike))
+
+
+def _listed(strikes, target, direction):
+    # the listed strike equal to target, or the nearest one further out of the money
+    i = np.searchsorted(strikes, target)
+    if i < strikes.size and strikes[i] == target:
+        return strikes[i]
+    if direction > 0:
+        return strikes[i] if i < strikes.size else None
+    return strikes[i - 1] if i > 0 else None
+
+
+def _quote(keys, mids, wanted):
+    # look up the mids of `wanted` keys in one day's sorted key slice, NaN where not listed
+    pos = np.minimum(np.searchsorted(keys, wanted), keys.size - 1)
+    return np.where(keys[pos] == wanted, mids[pos], np.nan)
+
+
+def run_backtest(chains, call_delta=0.16, put_delta=-0.16, days=45, take_profit_factor=0.50, stop_loss_factor=3.00,
+                 exit_dte=21, quantity=1, max_positions=1, multiplier=100, entry_factor=0.995, commission=0.0,
+                 start=None, end=None, sizing=None, use_vix_position_sizing=False, account_value=100000.0,
+                 cache=None):
+
+    '''
+    Backtest the short strangle rules
+    :param chains: dict of chain columns (see chain_data.load_chains), a ChainStore or a chain data directory
+    :param call_delta: delta of the call to sell
+    :param put_delta: delta of the put to sell
+    :param days: target days to expiration at entry
+    :param take_profit_factor: buy back when the combo is worth this fraction of the entry mid
+    :param stop_loss_factor: stop out when the combo is worth this multiple of the entry mid
+    :param exit_dte: close positions at this many days to expiration
+    :param quantity: contracts per entry
+    :param max_positions: number of strangles allowed open at once (the live bot uses 1)
+    :param multiplier: contract multiplier
+    :param entry_factor: limit price as a fraction of the combo mid (0.995 in the live bot)
+    :param commission: round trip commission per contract
+    :param start: first date to trade (anything chain_data.to_days accepts), None for all
+    :param end: last date to trade, None for all
+    :param sizing: optional callable(day, iv, credit, S, equity) -> contracts, overrides quantity
+    :param use_vix_position_sizing: size entries with the live IV ladder (common/sizing.py) on account_value
+        plus realized P&L, against the Reg-T strangle_margin() (common/margin.py) per contract
+    :param account_value: starting available funds for use_vix_position_sizing
+    :param cache: optional result_cache.ResultCache (or its directory) of whole runs and of the exit path of every
+        trade, keyed by parameters, chain data fingerprint and CODE_VERSION; a run with a sizing callable is not
+        cached as a whole, its trades still are
+    :return: BacktestResult
+    '''
+
+    started = time.perf_counter()
+    if isinstance(chains, str):
+        chains = chain_data.load_chains(chains)
+    params = {'call_delta': call_delta, 'put_delta': put_delta, 'days': days,
+              'take_profit_factor': take_profit_factor, 'stop_loss_factor': stop_loss_factor, 'exit_dte': exit_dte,
+              'quantity': quantity, 'max_positions': max_positions, 'use_vix_position_sizing': use_vix_position_sizing}
+
+    if hasattr(chains, 'day_starts'):
+        # a ChainStore already knows where every day starts
+        all_days, starts = chains.days, chains.day_starts
+        ends = np.append(starts[1:], len(chains))
+        chains = chains.columns
+    else:
+        all_days, starts, ends = chain_data.day_index(chains['date'])
+    first = 0 if start is None else np.searchsorted(all_days, chain_data.to_days([start])[0])
+    last = all_days.size if end is None else np.searchsorted(all_days, chain_data.to_days([end])[0], side='right')
+
+    cache = result_cache.open_cache(cache)
+    run_key = None
+    if cache is not None and sizing is None:
+        rows = result_cache.fingerprint(chains, int(starts[first]), int(ends[last - 1])) if last > first else ''
+        run_key = result_cache.content_key(
+            kind='run', code=CODE_VERSION, data=rows, first=int(first), last=int(last), params=params,
+            multiplier=multiplier, entry_factor=entry_factor, commission=commission, account_value=account_value)
+        cached = cache.get(run_key)
+        if cached is not None:
+            return _result(cached['trades'], cached['equity_days'], cached['equity'], params, started)
+
+    # open positions, one slot per allowed strangle
+    slots = max_positions
+    open_ = np.zeros(slots, dtype=bool)
+    entry_day = np.zeros(slots, dtype=np.int64)
+    expiry = np.zeros(slots, dtype=np.int64)
+    call_k = np.zeros(slots)
+    put_k = np.zeros(slots)
+    credit = np.zeros(slots)
+    mid_in = np.zeros(slots)
+    qty = np.zeros(slots)
+    last_mark = np.zeros(slots)
+    entry_iv = np.zeros(slots)
+    entry_S = np.zeros(slots)
+    # with a cache: the trade key of each slot, the marks of a live slot so far, and the cached
+    # (marks, exit price, reason) of a slot whose exit path was already known at entry
+    entry_index = np.zeros(slots, dtype=np.int64)
+    replayed = np.zeros(slots, dtype=bool)
+    trade_keys = [None] * slots
+    history = [None] * slots
+    paths = [None] * slots
+
+    trades = {name: [] for name in ('entry_date', 'exit_date', 'expiry', 'call_strike', 'put_strike', 'quantity',
+                                    'credit', 'exit_price', 'pnl', 'days_held', 'reason', 'entry_iv', 'underlying')}
+    equity_days = []
+    equity = []
+    realized = 0.0
+
+    for d in range(first, last):
+        lo, hi = int(starts[d]), int(ends[d])
+        day = int(all_days[d])
+        closed, closed_price, closed_reason = [], [], []
+
+        # positions on a cached exit path take the day's mark and their exit from the path
+        for s in np.flatnonzero(open_ & replayed):
+            marks, path_price, path_reason = paths[s]
+            k = d - entry_index[s] - 1
+            last_mark[s] = marks[k]
+            if k == len(marks) - 1:
+                closed.append([s])
+                closed_price.append([path_price])
+                closed_reason.append([path_reason])
+
+        live = open_ & ~replayed
+        if live.any() or not open_.all() or closed:
+            # the day's chain is only needed to mark live positions or to enter
+            exp_col = np.asarray(chains['expiry'][lo:hi])
+            right_col = np.asarray(chains['right'][lo:hi])
+            strike_col = np.asarray(chains['strike'][lo:hi])
+            keys = chain_data.row_key(exp_col, right_col, strike_col)
+            mids = chain_data.mid(chains['bid'][lo:hi], chains['ask'][lo:hi])
+            S = float(chains['underlying'][lo])
+
+        # mark and manage every live position at once
+        if live.any():
+            idx = np.flatnonzero(live)
+            call_mid = _quote(keys, mids, chain_data.row_key(expiry[idx], 1, call_k[idx]))
+            put_mid = _quote(keys, mids, chain_data.row_key(expiry[idx], -1, put_k[idx]))
+            mark = call_mid + put_mid
+            expired = day >= expiry[idx]
+            intrinsic = np.maximum(S - call_k[idx], 0) + np.maximum(put_k[idx] - S, 0)
+            mark = np.where(expired, intrinsic, np.where(np.isnan(mark), last_mark[idx], mark))
+            last_mark[idx] = mark
+            if cache is not None:
+                for s, m in zip(idx, mark):
+                    history[s].append(float(m))
+
+            take_profit = mark <= np.round(mid_in[idx] * take_profit_factor, 2)
+            stop_loss = ~take_profit & (mark >= np.round(mid_in[idx] * stop_loss_factor, 2))
+            time_exit = ~take_profit & ~stop_loss & (expiry[idx] - day <= exit_dte)
+            closing = take_profit | stop_loss | time_exit | expired
+            if closing.any():
+                # the take profit is a resting limit so it fills at its price, stops and time exits at the mark
+                exit_price = np.where(take_profit, np.round(mid_in[idx] * take_profit_factor, 2), mark)
+                reason = np.where(take_profit, 'take_profit', np.where(stop_loss, 'stop_loss',
+                                  np.where(expired, 'expired', 'exit_dte')))
+                closed.append(idx[closing])
+                closed_price.append(exit_price[closing])
+                closed_reason.append(reason[closing])
+
+        if closed:
+            c = np.concatenate(closed).astype(np.int64)
+            exit_price = np.concatenate(closed_price)
+            reason = np.concatenate(closed_reason)
+            pnl = (credit[c] - exit_price) * qty[c] * multiplier - commission * qty[c]
+            realized += pnl.sum()
+            trades['entry_date'].extend(entry_day[c])
+            trades['exit_date'].extend([day] * c.size)
+            trades['expiry'].extend(expiry[c])
+            trades['call_strike'].extend(call_k[c])
+            trades['put_strike'].extend(put_k[c])
+            trades['quantity'].extend(qty[c])
+            trades['credit'].extend(credit[c])
+            trades['exit_price'].extend(exit_price)
+            trades['pnl'].extend(pnl)
+            trades['days_held'].extend(day - entry_day[c])
+            trades['reason'].extend(reason)
+            trades['entry_iv'].extend(entry_iv[c])
+            trades['underlying'].extend(entry_S[c])
+            open_[c] = False
+            if cache is not None:
+                for s, price, why in zip(c, exit_price, reason):
+                    if not replayed[s]:
+                        cache.put(trade_keys[s], {'marks': history[s], 'exit_price': float(price), 'reason': str(why)})
+
+        # enter a new strangle when a slot is free
+        if not open_.all():
+            opened = _enter(day, S, exp_col, right_col, strike_col, keys, mids, chains['iv'][lo:hi], call_delta,
+                            put_delta, days, exit_dte)
+            if opened is not None:
+                exp, ck, pk, combo_mid, iv = opened
+                if sizing is not None:
+                    size = int(sizing(day, iv, combo_mid, S, realized))
+                elif use_vix_position_sizing:
+                    margin = strangle_margin(S, ck, pk, combo_mid, multiplier)
+                    size = int(iv_bucket_size(iv, account_value + realized, margin, default=quantity))
+                else:
+                    size = quantity
+                if size > 0:
+                    s = int(np.flatnonzero(~open_)[0])
+                    open_[s] = True
+                    entry_day[s], expiry[s], call_k[s], put_k[s] = day, exp, ck, pk
+                    mid_in[s] = combo_mid
+                    credit[s] = round(combo_mid * entry_factor, 2)
+                    qty[s] = size
+                    last_mark[s] = combo_mid
+                    entry_iv[s], entry_S[s] = iv, S
+                    entry_index[s] = d
+                    if cache is not None:
+                        # the exit path depends on the entry, the exit rules and the chains up to expiration
+                        e = max(int(np.searchsorted(all_days, exp, side='right')) - 1, d)
+                        trade_keys[s] = result_cache.content_key(
+                            kind='trade', code=CODE_VERSION, data=result_cache.fingerprint(chains, hi, int(ends[e])),
+                            entry=day, expiry=int(exp), call=float(ck), put=float(pk), mid=float(combo_mid),
+                            take_profit_factor=take_profit_factor, stop_loss_factor=stop_loss_factor,
+                            exit_dte=exit_dte)
+                        path = cache.get(trade_keys[s])
+                        replayed[s] = path is not None
+                        paths[s] = (path['marks'], path['exit_price'], path['reason']) if path else None
+                        history[s] = []
+
+        unrealized = ((credit - last_mark) * qty * multiplier)[open_].sum()
+        equity_days.append(day)
+        equity.append(realized + unrealized)
+
+    if run_key is not None:
+        cache.put(run_key, {'trades': {k: np.asarray(v).tolist() for k, v in trades.items()},
+                            'equity_days': equity_days, 'equity': [float(x) for x in equity]})
+    return _result(trades, equity_days, equity, params, started)
+
+
+def _result(trades, equity_days, equity, params, started):
+    frame = pd.DataFrame(trades)
+    if len(frame):
+        frame = frame.sort_values(['entry_date', 'exit_date'], kind='stable').reset_index(drop=True)
+        for col in ('entry_date', 'exit_date', 'expiry'):
+            frame[col] = chain_data.from_days(frame[col].to_numpy())
+    equity_series = pd.Series(equity, index=chain_data.from_days(np.asarray(equity_days, dtype=np.int64)),
+                              name='equity')
+    return BacktestResult(frame, equity_series, params, time.perf_counter() - started)
+
+
+def _enter(day, S, exp_col, right_col, strike_col, keys, mids, iv_col, call_delta, put_delta, days, exit_dte):
+    # expiry selection over the day's listed expirations
+    listed = exp_col[np.concatenate(([0], np.flatnonzero(np.diff(exp_col)) + 1))]
+    listed = listed[listed > day]
+    if listed.size == 0:
+        return None
+    exp = int(select_expiry(listed, day, days))
+    lo, hi = np.searchsorted(exp_col, exp), np.searchsorted(exp_col, exp, side='right')
+    calls = slice(lo + np.searchsorted(right_col[lo:hi] > 0, True), hi)
+    call_strikes = strike_col[calls]
+    put_strikes = strike_col[lo:calls.start]
+    if call_strikes.size == 0 or put_strikes.size == 0:
+        return None
+    T = (exp - day) / 365
+
+    # ATM IV from the call at the spot rounded up to $5, like get_chain_iv()
+    atm = _listed(call_strikes, int(np.ceil(S / 5)) * 5, 1)
+    if atm is None:
+        return None
+    atm_row = calls.start + np.searchsorted(call_strikes, atm)
+    iv = float(np.asarray(iv_col)[atm_row])
+    if not iv > 0:
+        iv = float(pricing.implied_volatility(mids[atm_row], 'c', S, atm, T))
+    if not iv > 0:
+        return None
+
+    ck, pk = select_strikes(S, iv, T, call_delta, put_delta)
+    ck, pk = _listed(call_strikes, ck, 1), _listed(put_strikes, pk, -1)
+    if not ck or not pk:
+        return None
+    call_mid = _quote(keys, mids, chain_data.row_key(exp, 1, ck))
+    put_mid = _quote(keys, mids, chain_data.row_key(exp, -1, pk))
+    combo_mid = round(float(call_mid) + float(put_mid), 2)
+    if not combo_mid > 0:
+        return None
+    return exp, ck, pk, combo_mid, iv
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Backtest the 45DTE/16-delta short strangle over local chain data')
+    parser.add_argument('chains', help='chain data directory')
+    parser.add_argument('--call-delta', type=float, default=0.16)
+    parser.add_argument('--put-delta', type=float, default=-0.16)
+    parser.add_argument('--days', type=int, default=45)
+    parser.add_argument('--take-profit-factor', type=float, default=0.50)
+    parser.add_argument('--stop-loss-factor', type=float, default=3.00)
+    parser.add_argument('--exit-dte', type=int, default=21)
+    parser.add_argument('--quantity', type=int, default=1)
+    parser.add_argument('--vix-sizing', action='store_true', help='size entries with the live IV ladder')
+    parser.add_argument('--account-value', type=float, default=100000.0)
+    parser.add_argument('--cache', help='result cache directory, reruns reuse unchanged runs and trades')
+    parser.add_argument('--cache-mb', type=float, help='size bound of the cache in MB')
+    parser.add_argument('--trades-out', help='write the trade list to this CSV')
+    args = parser.parse_args()
+
+    cache = None
+    if args.cache:
+        cache = result_cache.ResultCache(args.cache, int(args.cache_mb * 2 ** 20) if args.cache_mb else None)
+    result = run_backtest(args.chains, call_delta=args.call_delta, put_delta=args.put_delta, days=args.days,
+                          take_profit_factor=args.take_profit_factor, stop_loss_factor=args.stop_loss_factor,
+                          exit_dte=args.exit_dte, quantity=args.quantity, use_vix_position_sizing=args.vix_sizing,
+                          account_value=args.account_value, cache=cache)
+    for name, value in result.stats().items():
+        print(f"{name:>14}: {value:,.4f}" if isinstance(value, float) else f"{name:>14}: {value}")
+    print(f"{'elapsed':>14}: {result.elapsed:.3f}s")
+    if args.trades_out:
+        result.trades.to_csv(args.trades_out, index=False)
@@ -0,0 +1,197 @@
+"""
+SYNTHETIC_CHAINS.PY
+Generate synthetic daily option chains from underlying bars and a vol index.
+
+When no historical option data is available, chains are rebuilt from the
+underlying's OHLC bars plus a VIX-style series (in vol points, e.g. 18.5):
+  * expirations follow the listing calendar: monthlies on the third Friday out
+    to max_days, weeklies on every other Friday inside weekly_horizon days,
+  * strikes follow the listing grid of the product: $1 near the money and $5
+    further out for equities, 5 and 25 point increments for equity index
+    futures options (ES/MES),
+  * prices are Black-Scholes with a zero rate, the same model the live bots
+    price with, using the vol index as ATM IV plus an optional linear skew.
+
+Days are priced as whole blocks of rows with NumPy and written in chunks to a
+chain_data directory that strangle_backtest.py (and anything else) can
+memory-map. Intraday bars are reduced to one snapshot per day, taken at the
+last bar at or before snapshot_time.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'models'))
+from common import pricing
+
+import chain_data
+
+# Strike grids and expiration calendars of the products we trade
+LISTING_RULES = {
+    # SPY style: $1 strikes within 10% of spot, $5 strikes out to 40%
+    'equity': {'fine_step': 1.0, 'fine_width': 0.10, 'coarse_step': 5.0, 'max_width': 0.40,
+               'max_days': 70, 'weekly_horizon': 70},
+    # ES/MES options: 5 point strikes within 10% of the future, 25 points out to 30%
+    'futures': {'fine_step': 5.0, 'fine_width': 0.10, 'coarse_step': 25.0, 'max_width': 0.30,
+                'max_days': 70, 'weekly_horizon': 35},
+}
+
+
+def third_friday(year, month):
+    first = np.datetime64(f'{year:04d}-{month:02d}-01', 'D')
+    return np.busday_offset(first, 2, roll='forward', weekmask='Fri')
+
+
+def expirations(start, end, max_days, weekly_horizon, weeklies=True):
+
+    '''
+    Listed expirations for every date between start and end
+    :param start: first date (datetime64[D])
+    :param end: last date (datetime64[D])
+    :param max_days: longest expiration listed on any date
+    :param weekly_horizon: weeklies are only listed this many days out
+    :param weeklies: list weekly (non third Friday) expirations at all
+    :return: (sorted expirations as datetime64[D], boolean mask of monthly expirations)
+    '''
+
+    last = end + np.timedelta64(max_days + 7, 'D')
+    fridays = np.arange(np.busday_offset(start, 0, roll='forward', weekmask='Fri'), last, 7).astype('datetime64[D]')
+    months = pd.period_range(str(start), str(last), freq='M')
+    monthly = np.array([third_friday(p.year, p.month) for p in months], dtype='datetime64[D]')
+    expiries = np.union1d(fridays, monthly) if weeklies else monthly
+    return expiries, np.isin(expiries, monthly)
+
+
+def strike_grid(S, rules):
+
+    '''
+    Listed strikes around the underlying price
+    :param S: underlying price
+    :param rules: one of LISTING_RULES
+    :return: sorted strikes
+    '''
+
+    fine = rules['fine_step']
+    coarse = rules['coarse_step']
+    near = np.arange(np.ceil(S * (1 - rules['fine_width']) / fine) * fine, S * (1 + rules['fine_width']), fine)
+    far = np.arange(np.ceil(S * (1 - rules['max_width']) / coarse) * coarse, S * (1 + rules['max_width']), coarse)
+    return np.union1d(near, far)
+
+
+def daily_snapshots(bars, vol, snapshot_time=None):
+
+    '''
+    Reduce bars and the vol series to one (date, price, vol) per trading day
+    :param bars: DataFrame with a DatetimeIndex and a 'close' column
+    :param vol: Series of the vol index in vol points, indexed by date or datetime
+    :param snapshot_time: 'HH:MM' to snapshot intraday bars at, None for the last bar of the day
+    :return: DataFrame indexed by date with 'close' and 'vol' columns (vol as a fraction)
+    '''
+
+    close = bars['close'] if 'close' in bars else bars['Close']
+    if snapshot_time is not None:
+        close = close[close.index.time <= pd.Timestamp(snapshot_time).time()]
+    daily = close.groupby(close.index.normalize()).last().to_frame('close')
+    vol = vol.groupby(pd.DatetimeIndex(vol.index).normalize()).last()
+    daily['vol'] = vol.reindex(daily.index).ffill().bfill() / 100
+    return daily.dropna()
+
+
+def generate_chains(bars, vol, path, rules='equity', snapshot_time=None, weeklies=True, skew=0.0, spread=0.02,
+                    min_tick=0.01, chunk_days=250, append=False):
+
+    '''
+    Build synthetic chains for every trading day in bars and write them to a chain data directory
+    :param bars: DataFrame with a DatetimeIndex and a 'close' column (daily or intraday)
+    :param vol: Series of a VIX-style vol index in vol points
+    :param path: output chain data directory
+    :param rules: key of LISTING_RULES or a dict of the same shape
+    :param snapshot_time: 'HH:MM' to snapshot intraday bars at, None for the last bar of the day
+    :param weeklies: list weekly expirations
+    :param skew: IV change per unit of log-moneyness ln(K/S), negative gives the usual put skew
+    :param spread: bid/ask spread as a fraction of the option price
+    :param min_tick: smallest price increment and minimum half-spread
+    :param chunk_days: trading days priced and written per chunk
+    :param append: append to an existing data set instead of replacing it
+    :return: number of rows written
+    '''
+
+    rules = LISTING_RULES[rules] if isinstance(rules, str) else rules
+    daily = daily_snapshots(bars, vol, snapshot_time)
+    days = daily.index.to_numpy().astype('datetime64[D]')
+    if days.size == 0:
+        return 0
+    expiries, _ = expirations(days[0], days[-1], rules['max_days'], rules['weekly_horizon'], weeklies)
+    expiry_days = chain_data.to_days(expiries)
+
+    with chain_data.ChainWriter(path, append=append) as writer:
+        for lo in range(0, days.size, chunk_days):
+            chunk = _price_days(chain_data.to_days(days[lo:lo + chunk_days]),
+                                daily['close'].to_numpy()[lo:lo + chunk_days],
+                                daily['vol'].to_numpy()[lo:lo + chunk_days], expiry_days, rules, skew, spread,
+                                min_tick)
+            writer.append(**chunk)
+        return writer.rows
+
+
+def _price_days(days, closes, vols, expiry_days, rules, skew, spread, min_tick):
+    date, expiry, right, strike, S, atm = [], [], [], [], [], []
+    for day, close, iv in zip(days, closes, vols):
+        listed = expiry_days[(expiry_days > day) & (expiry_days <= day + rules['max_days'])]
+        listed = listed[(listed <= day + rules['weekly_horizon']) | _is_monthly(listed)]
+        strikes = strike_grid(close, rules)
+        n = listed.size * 2 * strikes.size
+        # rows of one date ordered by (expiry, right: put first, strike), the file order
+        date.append(np.full(n, day, dtype=np.int32))
+        expiry.append(np.repeat(listed, 2 * strikes.size))
+        right.append(np.tile(np.repeat(np.array([chain_data.PUT, chain_data.CALL], dtype=np.int8), strikes.size),
+                             listed.size))
+        strike.append(np.tile(strikes, 2 * listed.size))
+        S.append(np.full(n, close))
+        atm.append(np.full(n, iv))
+
+    date, expiry, right, strike, S, atm = (np.concatenate(x) for x in (date, expiry, right, strike, S, atm))
+    iv = np.maximum(atm + skew * np.log(strike / S), 0.01)
+    greeks = pricing.greeks(right, S, strike, (expiry - date) / 365, iv)
+    price = greeks['price']
+    half = np.maximum(price * spread / 2, min_tick)
+    bid = np.where(price - half >= min_tick, np.round((price - half) / min_tick) * min_tick, 0.0)
+    ask = np.round((price + half) / min_tick) * min_tick
+    return {'date': date, 'expiry': expiry, 'right': right, 'strike': strike, 'bid': bid, 'ask': ask, 'iv': iv,
+            'delta': greeks['delta'], 'underlying': S}
+
+
+def _is_monthly(expiry_days):
+    # third Fridays fall on the 15th to the 21st
+    dom = (chain_data.from_days(expiry_days) - chain_data.from_days(expiry_days).astype('datetime64[M]')).astype(int)
+    return (dom >= 14) & (dom <= 20)
+
+
+def _read_series(path):
+    frame = pd.read_csv(path)
+    frame.columns = [c.lower() for c in frame.columns]
+    time_col = next(c for c in frame.columns if c in ('date', 'datetime', 'time', 'timestamp'))
+    frame.index = pd.to_datetime(frame.pop(time_col))
+    return frame
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate synthetic option chains from underlying bars and a vol index')
+    parser.add_argument('bars', help='CSV of underlying bars with date/datetime and close columns')
+    parser.add_argument('vol', help='CSV of the vol index with date and close columns, in vol points')
+    parser.add_argument('out', help='output chain data directory')
+    parser.add_argument('--rules', choices=sorted(LISTING_RULES), default='equity')
+    parser.add_argument('--snapshot-time', help='HH:MM snapshot for intraday bars')
+    parser.add_argument('--no-weeklies', action='store_true')
+    parser.add_argument('--skew', type=float, default=0.0)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    rows = generate_chains(_read_series(args.bars), _read_series(args.vol)['close'], args.out, rules=args.rules,
+                           snapshot_time=args.snapshot_time, weeklies=not args.no_weeklies, skew=args.skew)
+    print(f"{rows:,} rows written to {args.out} in {time.perf_counter() - started:.1f}s")
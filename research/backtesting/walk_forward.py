@@ -0,0 +1,155 @@
+"""
+WALK_FORWARD.PY
+Walk-forward optimization of the short strangle backtest.
+
+The data range is cut into rolling windows: parameters are optimized on each
+in-sample window and the winner is evaluated on the out-of-sample window that
+follows it. Every (window, parameter set) backtest is cached on disk under a
+hash of its content (window dates, parameters, fixed arguments, the chain
+data version and the backtest code version, see result_cache.py), so
+  * extending the date range only backtests the new windows (the data version
+    is fingerprinted per window, so appending data leaves old windows valid),
+  * adding a parameter value only backtests the new cells,
+  * an interrupted run picks up where it stopped, since each cell is written
+    to the cache as soon as it finishes,
+  * editing strangle_backtest.py invalidates every cell without clearing the
+    cache by hand.
+The backtests share the same cache for the exit path of every trade, so the
+overlap of consecutive in-sample windows is only simulated once per parameter
+set.
+"""
+
+import argparse
+
+import numpy as np
+import pandas as pd
+
+import chain_data
+import param_sweep
+import result_cache
+import strangle_backtest
+
+
+def windows(first, last, in_sample_months=24, out_sample_months=6, step_months=None):
+
+    '''
+    Rolling in-sample / out-of-sample windows
+    :param first: first date with data
+    :param last: last date with data
+    :param in_sample_months: length of each optimization window
+    :param out_sample_months: length of each evaluation window
+    :param step_months: months between window starts, defaults to out_sample_months
+    :return: list of (is_start, is_end, oos_start, oos_end) Timestamps, ends inclusive
+    '''
+
+    step = pd.DateOffset(months=step_months or out_sample_months)
+    first, last = pd.Timestamp(first), pd.Timestamp(last)
+    result = []
+    start = first
+    while True:
+        oos_start = start + pd.DateOffset(months=in_sample_months)
+        oos_end = oos_start + pd.DateOffset(months=out_sample_months) - pd.Timedelta(days=1)
+        if oos_start > last:
+            break
+        result.append((start, oos_start - pd.Timedelta(days=1), oos_start, min(oos_end, last)))
+        start = start + step
+    return result
+
+
+def _cell_key(fingerprint, start, end, params, fixed):
+    return result_cache.content_key(data=fingerprint, code=strangle_backtest.CODE_VERSION, start=str(start.date()),
+                                    end=str(end.date()), params=params, fixed=fixed)
+
+
+def evaluate(path, params, start, end, cache, version, fixed=None, workers=None):
+
+    '''
+    Backtest every parameter set over one date range, reusing cached cells
+    :return: DataFrame of stats, one row per parameter set in the given order
+    '''
+
+    fixed = dict(fixed or {})
+    fingerprint = version(start, end)
+    keys = [_cell_key(fingerprint, start, end, p, fixed) for p in params]
+    rows = [cache.get(k) for k in keys]
+    missing = [i for i, row in enumerate(rows) if row is None]
+    if missing:
+        todo = [params[i] for i in missing]
+
+        def store(row):
+            i = missing[row['run']]
+            row = {k: v for k, v in row.items() if k != 'run'}
+            rows[i] = row
+            if not row.get('error'):
+                cache.put(keys[i], row)
+
+        param_sweep.run_sweep(path, todo, workers=workers, on_result=store,
+                              fixed={**fixed, 'start': str(start.date()), 'end': str(end.date()), 'cache': cache})
+    return pd.DataFrame(rows)
+
+
+def walk_forward(path, params, cache_dir, in_sample_months=24, out_sample_months=6, step_months=None,
+                 objective='sharpe', fixed=None, workers=None, progress=None, cache_bytes=None):
+
+    '''
+    Optimize on each in-sample window and evaluate the winner out of sample
+    :param path: chain data directory
+    :param params: list of parameter dicts to choose from (see param_sweep.grid/sample)
+    :param cache_dir: directory of cached (window, parameter set) results and backtests
+    :param objective: in-sample statistic to maximize
+    :param fixed: keyword arguments passed unchanged to every backtest
+    :param workers: processes per sweep
+    :param progress: optional callable(window number, total windows)
+    :param cache_bytes: size bound of the cache, least recently used results are evicted beyond it
+    :return: DataFrame with one row per window
+    '''
+
+    cache = result_cache.ResultCache(cache_dir, cache_bytes)
+    version = result_cache.DataVersion(path)
+    days = chain_data.from_days(version.days)
+    plan = windows(days[0], days[-1], in_sample_months, out_sample_months, step_months)
+
+    report = []
+    for n, (is_start, is_end, oos_start, oos_end) in enumerate(plan):
+        in_sample = evaluate(path, params, is_start, is_end, cache, version, fixed, workers)
+        if objective not in in_sample:
+            continue
+        scores = pd.to_numeric(in_sample[objective], errors='coerce').to_numpy()
+        if np.all(np.isnan(scores)):
+            continue
+        best = int(np.nanargmax(scores))
+        out_sample = evaluate(path, [params[best]], oos_start, oos_end, cache, version, fixed, workers).iloc[0]
+        row = {'window': n, 'is_start': is_start.date(), 'is_end': is_end.date(), 'oos_start': oos_start.date(),
+               'oos_end': oos_end.date(), **params[best], f'is_{objective}': scores[best]}
+        for stat in ('trades', 'total_pnl', 'win_rate', 'max_drawdown', 'sharpe'):
+            row[f'oos_{stat}'] = out_sample.get(stat)
+        report.append(row)
+        if progress:
+            progress(n + 1, len(plan))
+    return pd.DataFrame(report)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Walk-forward optimization of the short strangle backtest')
+    parser.add_argument('chains', help='chain data directory')
+    parser.add_argument('--cache', default='walk_forward_cache', help='directory of cached window results')
+    parser.add_argument('--cache-mb', type=float, help='size bound of the cache in MB')
+    parser.add_argument('--in-sample', type=int, default=24, help='in-sample months')
+    parser.add_argument('--out-sample', type=int, default=6, help='out-of-sample months')
+    parser.add_argument('--objective', default='sharpe')
+    parser.add_argument('--samples', type=int, help='random sample of the parameter grid')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--out', help='write the window report to this CSV')
+    args = parser.parse_args()
+
+    space = param_sweep.DEFAULT_SPACE
+    parameter_sets = param_sweep.sample(space, args.samples, args.seed) if args.samples else param_sweep.grid(space)
+    result = walk_forward(args.chains, parameter_sets, args.cache, args.in_sample, args.out_sample,
+                          objective=args.objective, workers=args.workers,
+                          cache_bytes=int(args.cache_mb * 2 ** 20) if args.cache_mb else None,
+                          progress=lambda done, total: print(f"\rwindow {done}/{total}", end='', flush=True))
+    print()
+    print(result.to_string(index=False))
+    if args.out:
+        result.to_csv(args.out, index=False)
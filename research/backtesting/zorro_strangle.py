@@ -0,0 +1,435 @@
+"""
+ZORRO_STRANGLE.PY
+Python port of ShortStrangles_45DTE_16Delta_v1_Zorro.c with parity and speed reports.
+
+The Zorro script trades SPY options on a daily bar at 15:20 ET:
+  * while a strangle is open, its open profit (premium received less the
+    ask to buy both legs back) is checked every bar; it is closed at the ask
+    when the profit reaches 50% of the premium or the loss 330% of it,
+  * options left at expiration settle at intrinsic value (Zorro exercises
+    them and contractSellUnderlying() sells the stock at market),
+  * with nothing open, it sells the call and the put expiring nearest 45
+    days out whose bid is the first between 0.10 and PREMIUM (0.50), walking
+    strikes outward from the price in 0.5 steps (findCall / findPut), and
+    enters both at the bid.
+
+run_backtest() is vectorized by trade rather than by bar: entry selection
+is a few NumPy calls on the entry day's chain, and each strangle's whole
+life (both legs' asks on every later day, the exit test, settlement) is one
+batched binary search into the memory-mapped chain data, so the Python loop
+runs once per trade instead of once per bar. run_reference() is a literal
+bar-by-bar translation of run() kept as the parity baseline when no Zorro
+log is at hand; parity_report() compares either one, or a Zorro trade list
+exported with LOGFILE, against the port.
+"""
+
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+import chain_data
+from strangle_backtest import BacktestResult, select_expiry
+
+# #defines and run() settings of the Zorro script
+PREMIUM = 0.50
+MIN_BID = 0.10
+EXPIRY_DAYS = 45
+TAKE_PROFIT = 0.50
+STOP_LOSS = 3.30
+STRIKE_STEP = 0.5
+STRIKE_STEPS = 1000
+START_DATE = '2011-02-01'
+END_DATE = '2022-12-30'
+
+# Trade list columns of Zorro's LOGFILE export (Log/<script>_trd.csv)
+ZORRO_TRADE_COLUMNS = {'type': 'Type', 'open': 'Open', 'close': 'Close', 'entry': 'Entry', 'exit': 'Exit',
+                       'profit': 'Profit'}
+
+_DAY_SHIFT = 40
+
+
+class ChainIndex:
+
+    '''
+    Day index and a global (date, expiry, right, strike) key over a chain data directory
+    :param chains: dict of chain columns, a ChainStore or a chain data directory
+    '''
+
+    def __init__(self, chains):
+        if isinstance(chains, str):
+            chains = chain_data.load_chains(chains)
+        if hasattr(chains, 'day_starts'):
+            self.days, self.starts = chains.days, chains.day_starts
+            self.ends = np.append(self.starts[1:], len(chains))
+            chains = chains.columns
+        else:
+            self.days, self.starts, self.ends = chain_data.day_index(chains['date'])
+        self.columns = chains
+        self.underlying = np.asarray(chains['underlying'])[self.starts] if self.days.size else np.empty(0)
+        # rows are sorted by (date, expiry, right, strike), so date << 40 | row_key is sorted too
+        self.keys = (np.asarray(chains['date'], dtype=np.int64) << _DAY_SHIFT) | \
+            chain_data.row_key(chains['expiry'], chains['right'], chains['strike'])
+
+    def quotes(self, days, expiry, right, strike, field='ask'):
+
+        '''
+        One contract's quotes over many days in one binary search
+        :return: float array, NaN on days the contract is not in the chain
+        '''
+
+        wanted = (np.asarray(days, dtype=np.int64) << _DAY_SHIFT) | chain_data.row_key(expiry, right, strike)
+        pos = np.minimum(np.searchsorted(self.keys, wanted), self.keys.size - 1)
+        values = np.asarray(self.columns[field])[pos]
+        return np.where(self.keys[pos] == wanted, values, np.nan)
+
+
+def find_contract(strikes, bids, price, direction, premium=PREMIUM, min_bid=MIN_BID):
+
+    '''
+    findCall / findPut: walk targets price +/- 0.5*i, take the strike closest to each and return the
+    first whose bid is between min_bid and premium
+    :param strikes: sorted strikes of one right and expiration
+    :param bids: their bids
+    :param direction: +1 for calls, -1 for puts
+    :return: index into strikes, or None
+    '''
+
+    if strikes.size == 0:
+        return None
+    first = _closest(strikes, price)
+    last = _closest(strikes, price + direction * STRIKE_STEP * (STRIKE_STEPS - 1))
+    # every strike between the two closest ones is visited by some 0.5 step target, in walking order
+    order = np.arange(first, last + 1) if direction > 0 else np.arange(first, last - 1, -1)
+    ok = (bids[order] >= min_bid) & (bids[order] <= premium)
+    return int(order[ok.argmax()]) if ok.any() else None
+
+
+def _closest(strikes, target):
+    i = int(np.clip(np.searchsorted(strikes, target), 1, strikes.size - 1)) if strikes.size > 1 else 0
+    if strikes.size > 1 and abs(strikes[i - 1] - target) <= abs(strikes[i] - target):
+        i -= 1
+    return i
+
+
+def entry_candidate(index, d, expiry_days=EXPIRY_DAYS, premium=PREMIUM, min_bid=MIN_BID):
+
+    '''
+    Contracts the script would enter on the d-th day
+    :return: (expiry, call strike, put strike, call bid, put bid), or None when findCall or findPut fails
+    '''
+
+    lo, hi = int(index.starts[d]), int(index.ends[d])
+    day = int(index.days[d])
+    cols = index.columns
+    exp_col = np.asarray(cols['expiry'][lo:hi])
+    listed = exp_col[np.concatenate(([0], np.flatnonzero(np.diff(exp_col)) + 1))]
+    listed = listed[listed >= day]
+    if listed.size == 0:
+        return None
+    exp = int(select_expiry(listed, day, expiry_days))
+    a, b = lo + np.searchsorted(exp_col, exp), lo + np.searchsorted(exp_col, exp, side='right')
+    split = a + int(np.searchsorted(np.asarray(cols['right'][a:b]) > 0, True))
+    strikes, bids = np.asarray(cols['strike'][a:b]), np.asarray(cols['bid'][a:b])
+    put_strikes, put_bids = strikes[:split - a], bids[:split - a]
+    call_strikes, call_bids = strikes[split - a:], bids[split - a:]
+
+    price = float(index.underlying[d])
+    c = find_contract(call_strikes, call_bids, price, 1, premium, min_bid)
+    p = find_contract(put_strikes, put_bids, price, -1, premium, min_bid)
+    if c is None or p is None:
+        return None
+    return exp, float(call_strikes[c]), float(put_strikes[p]), float(call_bids[c]), float(put_bids[p])
+
+
+def run_backtest(chains, premium=PREMIUM, min_bid=MIN_BID, expiry_days=EXPIRY_DAYS, take_profit=TAKE_PROFIT,
+                 stop_loss=STOP_LOSS, multiplier=100, start=None, end=None):
+
+    '''
+    Vectorized port of the Zorro script
+    :param chains: dict of chain columns, a ChainStore, a chain data directory or a ChainIndex
+    :param premium: highest bid accepted by findCall / findPut
+    :param min_bid: lowest bid accepted
+    :param expiry_days: target days to expiration
+    :param take_profit: close when the open profit reaches this fraction of the premium
+    :param stop_loss: close when the open loss reaches this multiple of the premium
+    :param multiplier: contract multiplier
+    :param start: first date (Zorro's StartDate), None for all data
+    :param end: last date (EndDate), None for all data
+    :return: strangle_backtest.BacktestResult
+    '''
+
+    started = time.perf_counter()
+    index = chains if isinstance(chains, ChainIndex) else ChainIndex(chains)
+    params = {'premium': premium, 'min_bid': min_bid, 'expiry_days': expiry_days, 'take_profit': take_profit,
+              'stop_loss': stop_loss}
+    first, last = _range(index, start, end)
+
+    realized = np.zeros(index.days.size)
+    unrealized = np.zeros(index.days.size)
+    trades = []
+    d = first
+    while d < last:
+        candidate = entry_candidate(index, d, expiry_days, premium, min_bid)
+        if candidate is None:
+            d += 1
+            continue
+        exp, ck, pk, call_bid, put_bid = candidate
+        credit = call_bid + put_bid
+
+        # every later bar up to the expiration date, both legs' asks in one lookup each
+        settle = int(np.searchsorted(index.days, exp, side='right'))
+        days = index.days[d:min(settle, last)]
+        ask = _ffill(index.quotes(days, exp, 1, ck) + index.quotes(days, exp, -1, pk))
+        ask[np.isnan(ask)] = credit
+        profit = credit - ask
+        hit = (profit[1:] >= credit * take_profit) | (profit[1:] <= -credit * stop_loss)
+
+        if hit.any():
+            x = d + 1 + int(hit.argmax())
+            exit_price = ask[x - d]
+            reason = 'take_profit' if profit[x - d] >= credit * take_profit else 'stop_loss'
+        elif settle < last:
+            # expired: intrinsic value at the last price on or before the expiration date
+            x = settle
+            S = index.underlying[settle - 1]
+            exit_price = max(S - ck, 0.0) + max(pk - S, 0.0)
+            reason = 'expired'
+        else:
+            # still open when the data ends
+            unrealized[d:last] = profit[:last - d] * multiplier
+            break
+
+        unrealized[d:x] = profit[:x - d] * multiplier
+        pnl = (credit - exit_price) * multiplier
+        realized[x] += pnl
+        trades.append((index.days[d], index.days[x], exp, ck, pk, 1, credit, exit_price, pnl,
+                       int(index.days[x] - index.days[d]), reason,
+                       _margin(index.underlying[d], ck, pk) * multiplier, index.underlying[d]))
+        d = x
+
+    return _result(index, trades, realized, unrealized, first, last, params, started)
+
+
+def run_reference(chains, premium=PREMIUM, min_bid=MIN_BID, expiry_days=EXPIRY_DAYS, take_profit=TAKE_PROFIT,
+                  stop_loss=STOP_LOSS, multiplier=100, start=None, end=None):
+
+    '''
+    Literal bar-by-bar translation of the script's run(), the parity baseline for run_backtest()
+    :return: strangle_backtest.BacktestResult
+    '''
+
+    started = time.perf_counter()
+    index = chains if isinstance(chains, ChainIndex) else ChainIndex(chains)
+    params = {'premium': premium, 'min_bid': min_bid, 'expiry_days': expiry_days, 'take_profit': take_profit,
+              'stop_loss': stop_loss}
+    first, last = _range(index, start, end)
+    cols = index.columns
+
+    realized = np.zeros(index.days.size)
+    unrealized = np.zeros(index.days.size)
+    trades = []
+    legs = None   # (entry index, expiry, call strike, put strike, credit, last ask)
+    for d in range(first, last):
+        day = int(index.days[d])
+        lo, hi = int(index.starts[d]), int(index.ends[d])
+        keys = chain_data.row_key(cols['expiry'][lo:hi], cols['right'][lo:hi], cols['strike'][lo:hi])
+        asks = np.asarray(cols['ask'][lo:hi])
+
+        if legs is not None:
+            e, exp, ck, pk, credit, last_ask = legs
+            if day > exp:
+                S = index.underlying[d - 1]
+                exit_price = max(S - ck, 0.0) + max(pk - S, 0.0)
+                realized[d] += (credit - exit_price) * multiplier
+                trades.append((index.days[e], day, exp, ck, pk, 1, credit, exit_price,
+                               (credit - exit_price) * multiplier, day - int(index.days[e]), 'expired',
+                               _margin(index.underlying[e], ck, pk) * multiplier, index.underlying[e]))
+                legs = None
+            else:
+                ask = 0.0
+                for right, strike in ((1, ck), (-1, pk)):
+                    i = np.searchsorted(keys, chain_data.row_key(exp, right, strike))
+                    ask += asks[i] if i < keys.size and keys[i] == chain_data.row_key(exp, right, strike) else np.nan
+                ask = last_ask if np.isnan(ask) else ask
+                val = credit - ask
+                if val >= credit * take_profit or val <= credit * -stop_loss:
+                    realized[d] += val * multiplier
+                    trades.append((index.days[e], day, exp, ck, pk, 1, credit, ask, val * multiplier,
+                                   day - int(index.days[e]), 'take_profit' if val >= credit * take_profit
+                                   else 'stop_loss', _margin(index.underlying[e], ck, pk) * multiplier,
+                                   index.underlying[e]))
+                    legs = None
+                else:
+                    unrealized[d] = val * multiplier
+                    legs = (e, exp, ck, pk, credit, ask)
+
+        if legs is None:
+            candidate = entry_candidate(index, d, expiry_days, premium, min_bid)
+            if candidate is not None:
+                exp, ck, pk, call_bid, put_bid = candidate
+                credit = call_bid + put_bid
+                ask = 0.0
+                for right, strike in ((1, ck), (-1, pk)):
+                    ask += asks[np.searchsorted(keys, chain_data.row_key(exp, right, strike))]
+                unrealized[d] = (credit - ask) * multiplier
+                legs = (d, exp, ck, pk, credit, ask)
+
+    return _result(index, trades, realized, unrealized, first, last, params, started)
+
+
+def _range(index, start, end):
+    first = 0 if start is None else int(np.searchsorted(index.days, chain_data.to_days([start])[0]))
+    last = index.days.size if end is None else \
+        int(np.searchsorted(index.days, chain_data.to_days([end])[0], side='right'))
+    return first, last
+
+
+def _ffill(values):
+    # carry the last quote over days a contract is missing from the chain
+    valid = ~np.isnan(values)
+    idx = np.where(valid, np.arange(values.size), 0)
+    np.maximum.accumulate(idx, out=idx)
+    return np.where(valid[idx], values[idx], np.nan)
+
+
+def _margin(price, call_strike, put_strike):
+    # MarginCost of the script, per share
+    return 0.5 * (0.15 * price - min(call_strike - price, price - put_strike))
+
+
+def _result(index, trades, realized, unrealized, first, last, params, started):
+    columns = ['entry_date', 'exit_date', 'expiry', 'call_strike', 'put_strike', 'quantity', 'credit', 'exit_price',
+               'pnl', 'days_held', 'reason', 'margin', 'underlying']
+    frame = pd.DataFrame(trades, columns=columns)
+    for col in ('entry_date', 'exit_date', 'expiry'):
+        frame[col] = chain_data.from_days(frame[col].to_numpy(dtype=np.int64))
+    equity = np.cumsum(realized[first:last]) + unrealized[first:last]
+    equity = pd.Series(equity, index=chain_data.from_days(index.days[first:last]), name='equity')
+    return BacktestResult(frame, equity, params, time.perf_counter() - started)
+
+
+def read_zorro_trades(path, columns=None):
+
+    '''
+    Load a Zorro trade list and pair the call and put legs into strangles by open time
+    :param path: CSV exported by Zorro with LOGFILE (Log/<script>_trd.csv)
+    :param columns: overrides of ZORRO_TRADE_COLUMNS for other export layouts
+    :return: DataFrame with entry_date, exit_date, credit, exit_price and pnl per strangle
+    '''
+
+    names = {**ZORRO_TRADE_COLUMNS, **(columns or {})}
+    raw = pd.read_csv(path)
+    legs = pd.DataFrame({
+        'entry_date': pd.to_datetime(raw[names['open']]).dt.normalize(),
+        'exit_date': pd.to_datetime(raw[names['close']]).dt.normalize(),
+        'credit': pd.to_numeric(raw[names['entry']]),
+        'exit_price': pd.to_numeric(raw[names['exit']]),
+        'pnl': pd.to_numeric(raw[names['profit']]),
+    })
+    return legs.groupby('entry_date', as_index=False).agg(
+        {'exit_date': 'max', 'credit': 'sum', 'exit_price': 'sum', 'pnl': 'sum'})
+
+
+def parity_report(port, baseline, pnl_tolerance=0.01):
+
+    '''
+    Compare the trades and equity curves of two runs on the same data
+    :param port: BacktestResult of the Python port
+    :param baseline: BacktestResult (e.g. run_reference) or a trades DataFrame from read_zorro_trades
+    :param pnl_tolerance: per trade P&L difference (dollars) still counted as a match
+    :return: dict of parity statistics
+    '''
+
+    ours = port.trades
+    theirs = baseline.trades if hasattr(baseline, 'trades') else baseline
+    key = ['entry_date']
+    merged = pd.merge(ours, theirs, on=key, how='outer', suffixes=('', '_base'), indicator=True)
+    both = merged[merged['_merge'] == 'both']
+    pnl_diff = (both['pnl'] - both['pnl_base']).abs()
+    report = {
+        'trades_port': int(len(ours)),
+        'trades_baseline': int(len(theirs)),
+        'matched_entries': int(len(both)),
+        'only_port': int((merged['_merge'] == 'left_only').sum()),
+        'only_baseline': int((merged['_merge'] == 'right_only').sum()),
+        'same_exit_date': int((both['exit_date'] == both['exit_date_base']).sum()),
+        'pnl_matches': int((pnl_diff <= pnl_tolerance).sum()),
+        'max_trade_pnl_diff': float(pnl_diff.max()) if len(both) else 0.0,
+        'total_pnl_port': float(ours['pnl'].sum()),
+        'total_pnl_baseline': float(theirs['pnl'].sum()),
+    }
+
+    if hasattr(baseline, 'equity'):
+        base_equity = baseline.equity
+    else:
+        # closed trade equity from the trade list
+        base_equity = theirs.groupby('exit_date')['pnl'].sum().cumsum()
+        base_equity.index = pd.to_datetime(base_equity.index)
+        base_equity = base_equity.reindex(port.equity.index, method='ffill').fillna(0.0)
+    aligned = pd.concat([port.equity, base_equity], axis=1, join='inner').dropna()
+    if len(aligned):
+        a, b = aligned.iloc[:, 0].to_numpy(), aligned.iloc[:, 1].to_numpy()
+        report['equity_days'] = int(len(aligned))
+        report['equity_max_abs_diff'] = float(np.max(np.abs(a - b)))
+        report['equity_correlation'] = float(np.corrcoef(a, b)[0, 1]) if a.std() > 0 and b.std() > 0 else 1.0
+    return report
+
+
+def benchmark(chains, repeat=3, start=None, end=None, reference=True):
+
+    '''
+    Time the vectorized port (and the bar-by-bar reference) over the same data
+    :return: dict of best-of-repeat seconds and bars per second
+    '''
+
+    loading = time.perf_counter()
+    index = chains if isinstance(chains, ChainIndex) else ChainIndex(chains)
+    loading = time.perf_counter() - loading
+    first, last = _range(index, start, end)
+    bars = last - first
+    best = min(run_backtest(index, start=start, end=end).elapsed for _ in range(repeat))
+    result = {'bars': bars, 'rows': int(index.ends[last - 1] - index.starts[first]) if bars else 0,
+              'index_seconds': loading, 'port_seconds': best,
+              'port_bars_per_second': bars / best if best else float('inf')}
+    if reference:
+        ref = min(run_reference(index, start=start, end=end).elapsed for _ in range(repeat))
+        result.update({'reference_seconds': ref, 'reference_bars_per_second': bars / ref if ref else float('inf'),
+                       'speedup': ref / best if best else float('inf')})
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Python port of the Zorro 45DTE short strangle backtest')
+    parser.add_argument('chains', help='chain data directory')
+    parser.add_argument('--start', default=START_DATE, help='StartDate of the script')
+    parser.add_argument('--end', default=END_DATE, help='EndDate of the script')
+    parser.add_argument('--zorro-trades', help='Zorro trade list (Log/*_trd.csv) to check parity against')
+    parser.add_argument('--zorro-seconds', type=float, help="test time Zorro reported for the same period")
+    parser.add_argument('--benchmark', action='store_true', help='time the port against the bar-by-bar reference')
+    parser.add_argument('--trades-out', help='write the trade list to this CSV')
+    args = parser.parse_args()
+
+    index = ChainIndex(args.chains)
+    result = run_backtest(index, start=args.start, end=args.end)
+    for name, value in result.stats().items():
+        print(f"{name:>22}: {value:,.4f}" if isinstance(value, float) else f"{name:>22}: {value}")
+    print(f"{'elapsed':>22}: {result.elapsed:.3f}s")
+
+    baseline = read_zorro_trades(args.zorro_trades) if args.zorro_trades else \
+        run_reference(index, start=args.start, end=args.end)
+    print(f"\nparity vs {'Zorro' if args.zorro_trades else 'bar-by-bar reference'}:")
+    for name, value in parity_report(result, baseline).items():
+        print(f"{name:>22}: {value:,.4f}" if isinstance(value, float) else f"{name:>22}: {value}")
+
+    if args.benchmark:
+        print("\nbenchmark:")
+        timing = benchmark(args.chains, start=args.start, end=args.end)
+        if args.zorro_seconds:
+            timing['zorro_seconds'] = args.zorro_seconds
+            timing['speedup_vs_zorro'] = args.zorro_seconds / timing['port_seconds']
+        for name, value in timing.items():
+            print(f"{name:>26}: {value:,.4f}" if isinstance(value, float) else f"{name:>26}: {value}")
+    if args.trades_out:
+        result.trades.to_csv(args.trades_out, index=False)